@@ -0,0 +1,285 @@
+##encoding=utf8
+
+"""
+可重复的性能测试。
+
+按 example_project.py 中的movie schema生成类似IMDB的合成数据(不需要movies.tab), 对不同的数据量和
+posting_format测量:
+
+- 导入速度 (文档数/秒), RSS峰值, 以及(--trace-memory)导入过程中python分配的内存峰值;
+- 每一种criterion, 以及几种组合查询的延迟的 p50 / p95 / p99 (毫秒), 包括读取全部结果的时间。
+
+所有随机数都来自 --seed, 相同的参数生成完全相同的数据和查询。 每一组 (数据量, posting_format) 
+在一个新的子进程中运行, 所以RSS峰值只属于这一组, 不同组之间, 不同版本之间可以比较。 结果写入一个
+JSON文件, 用于比较不同版本的性能。
+
+usage:
+    python benchmark.py --sizes 10000,100000 --formats text,bitmap --output bench.json
+    python benchmark.py --genres 200 --skew 1.2   # 更多的keyword, 分布更不均匀
+"""
+
+from __future__ import print_function
+from tala.fields import *
+from tala.engine import *
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+### IMDB数据中的genres, keyword数量更多时以 Genre<i> 补充
+GENRES = ["Drama", "Comedy", "Short", "Documentary", "Action", "Romance", "Animation"]
+WORDS = ["Love", "Night", "Man", "Story", "Life", "Day", "House", "Time", "Girl", "World", "Dead",
+         "King", "Return", "Last", "Blood", "City", "Dream", "War", "Star", "Moon", "Sun", "Black",
+         "White", "Secret", "Game", "Road", "Heart", "Fire", "Water", "Ghost", "Little", "Big"]
+
+def movie_schema(posting_format="text"):
+    """与 example_project.py 相同的schema
+    """
+    return Schema("movie",
+        Field("movie_id", Searchable_UUID, primary_key=True),
+        Field("title", Searchable_TEXT),
+        Field("year", Searchable_INTEGER),
+        Field("length", Searchable_INTEGER),
+        Field("rating", Searchable_REAL),
+        Field("votes", Searchable_INTEGER),
+        Field("genres", Searchable_KEYWORD),
+        posting_format=posting_format,
+        )
+
+def genre_vocabulary(n_genres):
+    return GENRES[:n_genres] + ["Genre%s" % i for i in range(len(GENRES), n_genres)]
+
+def zipf_weights(n, skew):
+    """第i个keyword被选中的权重正比于 1 / (i+1)^skew。 skew=0时均匀分布
+    """
+    return [1.0 / (i + 1) ** skew for i in range(n)]
+
+def generate_movies(n, n_genres=7, max_genres=3, skew=1.0, seed=0):
+    """生成n个类似IMDB的movie文档。 每个文档有 0 ~ max_genres 个genre, genre按skew的Zipf分布选取
+    """
+    rnd = random.Random(seed)
+    genres = genre_vocabulary(n_genres)
+    weights = zipf_weights(n_genres, skew)
+    for i in range(n):
+        n_doc_genres = min(rnd.randint(0, max_genres), n_genres)
+        doc_genres = set()
+        while len(doc_genres) < n_doc_genres:
+            doc_genres.add(rnd.choices(genres, weights)[0])
+        yield {
+            "movie_id": str(i),
+            "title": " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))),
+            "year": min(int(2005 - rnd.expovariate(1 / 25.0)), 2005) if rnd.random() > 0.01 else 1893,
+            "length": max(1, int(rnd.gauss(95, 30))),
+            "rating": round(rnd.uniform(1.0, 10.0), 1),
+            "votes": int(rnd.lognormvariate(4, 1.5)),
+            "genres": "&".join(sorted(doc_genres)),
+        }
+
+def query_shapes(n_genres, skew):
+    """{查询形状的名称: 由random.Random生成一个查询的函数 f(rnd, engine) -> (query, search的参数)}
+    """
+    genres = genre_vocabulary(n_genres)
+    weights = zipf_weights(n_genres, skew)
+    common = lambda rnd: rnd.choices(genres, weights)[0]
+    rare = lambda rnd: genres[-1 - rnd.randrange(max(1, n_genres // 3))]
+    def year(rnd):
+        return rnd.randint(1930, 2005)
+
+    def shape(*criterions, **kwargs):
+        def make(rnd, engine):
+            query = engine.create_query()
+            for criterion in criterions:
+                query.add(criterion(rnd, query))
+            return query, kwargs
+        return make
+
+    return {
+        "equal": shape(lambda rnd, q: q.query_equal("year", year(rnd))),
+        "greater": shape(lambda rnd, q: q.query_greater("votes", rnd.randint(100, 5000))),
+        "smaller": shape(lambda rnd, q: q.query_smaller("length", rnd.randint(5, 60))),
+        "between": shape(lambda rnd, q: q.query_between("year", *sorted([year(rnd), year(rnd)]))),
+        "startwith": shape(lambda rnd, q: q.query_startwith("title", rnd.choice(WORDS))),
+        "endwith": shape(lambda rnd, q: q.query_endwith("title", rnd.choice(WORDS))),
+        "like": shape(lambda rnd, q: q.query_like("title", rnd.choice(WORDS)[1:4])),
+        "contains_common": shape(lambda rnd, q: q.query_contains("genres", common(rnd))),
+        "contains_rare": shape(lambda rnd, q: q.query_contains("genres", rare(rnd))),
+        "contains_two": shape(lambda rnd, q: q.query_contains("genres", common(rnd), common(rnd))),
+        "contains_between": shape(lambda rnd, q: q.query_contains("genres", common(rnd)),
+                                  lambda rnd, q: q.query_between("year", 1990, 2000)),
+        "or_not": shape(lambda rnd, q: q.query_or(q.query_contains("genres", common(rnd)),
+                                                  q.query_contains("genres", rare(rnd))),
+                        lambda rnd, q: q.query_not(q.query_contains("genres", common(rnd)))),
+        "contains_top20_by_rating": shape(lambda rnd, q: q.query_contains("genres", common(rnd)),
+                                          order_by="rating", descending=True, limit=20),
+    }
+
+def percentile(sorted_values, p):
+    """nearest-rank百分位数
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+def latency_summary(seconds):
+    values = sorted(second * 1000.0 for second in seconds)
+    return {"n": len(values),
+            "p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95), "p99_ms": percentile(values, 99),
+            "mean_ms": sum(values) / len(values) if values else None}
+
+def peak_rss_mb():
+    """当前进程的RSS峰值 (MB), 不支持的平台上为None。 ru_maxrss是整个进程生命周期中的最大值, 
+    所以每一组测量都在新的子进程中进行, 见 run_in_child
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin": # macOS的单位是字节, linux是KB
+        peak /= 1024.0
+    return peak / 1024.0
+
+def disk_usage_mb(engine):
+    """数据库文件, 以及"segment"模式下的segment文件所占用的磁盘空间 (MB)
+    """
+    size = os.path.getsize(engine.database)
+    if engine.segment_dir and os.path.isdir(engine.segment_dir):
+        size += sum(os.path.getsize(os.path.join(engine.segment_dir, name)) for name in os.listdir(engine.segment_dir))
+    return size / 1024.0 / 1024.0
+
+def remove_database(path):
+    """删除数据库文件, 以及它的WAL文件和segment目录
+    """
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.rmtree(path + ".segments", ignore_errors=True)
+
+def load_corpus(path, posting_format, documents):
+    remove_database(path)
+    engine = SearchEngine(path, movie_schema(posting_format))
+    with redirect_stdout(io.StringIO()): # add_all会打印进度
+        engine.add_all(documents)
+    return engine
+
+def trace_ingest(path, posting_format, size, args):
+    """在tracemalloc下导入size个文档, 返回python分配的内存峰值 (MB)。 tracemalloc会使内存分配变慢, 
+    所以与 bench_ingest 分开在另一个子进程中运行, 不影响导入速度和RSS的测量
+    """
+    documents = list(generate_movies(size, args.genres, args.max_genres, args.skew, args.seed))
+    tracemalloc.start()
+    try:
+        load_corpus(path, posting_format, documents)
+        return tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+    finally:
+        tracemalloc.stop()
+        remove_database(path)
+
+def bench_ingest(path, posting_format, size, args):
+    """导入size个文档, 返回 (engine, 导入的测量结果)
+    """
+    documents = list(generate_movies(size, args.genres, args.max_genres, args.skew, args.seed))
+    st = time.perf_counter()
+    engine = load_corpus(path, posting_format, documents)
+    elapsed = time.perf_counter() - st
+    return engine, {"documents": size, "seconds": elapsed, "docs_per_sec": size / elapsed,
+                    "disk_mb": disk_usage_mb(engine)}
+
+def bench_queries(engine, args):
+    """每一种查询形状执行args.repeat次(不同的随机参数), 测量读取全部结果的延迟
+    """
+    results = dict()
+    for name, make in sorted(query_shapes(args.genres, args.skew).items()):
+        rnd = random.Random("%s-%s" % (args.seed, name))
+        queries = [make(rnd, engine) for _ in range(args.repeat)]
+        for query, kwargs in queries[:args.warmup]:
+            list(engine.search(query, **kwargs))
+        seconds, n_results = list(), 0
+        for query, kwargs in queries:
+            st = time.perf_counter()
+            n_results += len(list(engine.search(query, **kwargs)))
+            seconds.append(time.perf_counter() - st)
+        results[name] = dict(latency_summary(seconds), mean_results=n_results / float(len(queries)))
+    return results
+
+def bench_run(path, posting_format, size, args):
+    """一组 (数据量, posting_format) 的完整测量, 在子进程中运行
+    """
+    engine, ingest = bench_ingest(path, posting_format, size, args)
+    queries = bench_queries(engine, args)
+    return {"size": size, "posting_format": posting_format, "ingest": ingest,
+            "queries": queries, "peak_rss_mb": peak_rss_mb()}
+
+def run_in_child(func, *args):
+    """在一个新启动(spawn)的子进程中运行func, 返回它的结果
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(func, *args).result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tala benchmark")
+    parser.add_argument("--sizes", default="10000,100000", help="comma separated corpus sizes")
+    parser.add_argument("--formats", default="text,bitmap,table", help="comma separated posting formats")
+    parser.add_argument("--genres", type=int, default=7, help="keyword cardinality of genres")
+    parser.add_argument("--max-genres", type=int, default=3, help="max genres per document")
+    parser.add_argument("--skew", type=float, default=1.0, help="zipf exponent of the genre distribution")
+    parser.add_argument("--repeat", type=int, default=200, help="queries per query shape")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed queries per query shape")
+    parser.add_argument("--trace-memory", action="store_true", help="also measure peak python memory of ingest")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="where to put the databases, default a temp dir")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tala_bench_")
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "config": dict((key, value) for key, value in vars(args).items() if key not in ("workdir", "output")),
+        "runs": list(),
+    }
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            for posting_format in args.formats.split(","):
+                path = os.path.join(workdir, "movies_%s_%s.db" % (posting_format, size))
+                run = run_in_child(bench_run, path, posting_format, size, args)
+                ingest = run["ingest"]
+                ingest["peak_python_mb"] = None
+                if args.trace_memory:
+                    ingest["peak_python_mb"] = run_in_child(trace_ingest, path + ".trace", posting_format, size, args)
+                report["runs"].append(run)
+
+                print("{:=^80}".format(" %s documents, posting_format=%s " % (size, posting_format)))
+                print("ingest: %.0f docs/sec, peak RSS %s MB" % (ingest["docs_per_sec"], run["peak_rss_mb"]))
+                if ingest["peak_python_mb"] is not None:
+                    print("peak python memory of ingest: %.1f MB" % ingest["peak_python_mb"])
+                for name, summary in sorted(run["queries"].items()):
+                    print("\t%-28s p50 %8.3f  p95 %8.3f  p99 %8.3f ms" % (
+                        name, summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("results are written to %s" % args.output)
+    return report
+
+if __name__ == "__main__":
+    main()
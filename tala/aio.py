@@ -0,0 +1,228 @@
+##encoding=utf8
+
+"""
+asyncio版本的查询接口。
+
+SearchEngine的查询是阻塞的, 在协程中直接调用会卡住整个event loop。 AsyncSearchEngine把所有的SQLite
+操作放到一个有上限的线程池中执行, search按批读取结果, 每一批都是一次await, 所以慢查询只占用
+线程池中的一个线程, 不会阻塞同一个event loop上的其他请求。
+
+查询被取消(task.cancel())或者超时时, 正在执行的SQL语句会被 sqlite3.Connection.interrupt() 中断,
+借出的连接随后被归还。
+
+AsyncSearchEngine需要一个并发模式的SearchEngine(concurrent=True), 因为查询会在不同的线程中执行。
+
+import:
+    from tala.aio import AsyncSearchEngine
+
+usage:
+    engine = SearchEngine("movies.db", movie_schema, concurrent=True)
+    aengine = AsyncSearchEngine(engine, timeout=5.0)
+
+    async def handler():
+        query = aengine.create_query()
+        query.add(query.query_contains("genres", "Drama"))
+        async for document in aengine.search_document(query, limit=20):
+            ...
+        n = await aengine.count(query)
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import itertools
+import threading
+import time
+
+class _ReadTask(object):
+    """在线程池中执行的一个查询。 记录借出的连接, 以便在取消或超时时中断正在执行的SQL语句
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.reader = None
+        self.rows = None
+        self.spent = 0.0 # 已经花在SQLite上的时间, 用于计算剩余的timeout
+        self.future = None # 正在线程池中执行的操作
+        self._lock = threading.Lock()
+
+    def call(self, func, *args):
+        """借出一个连接, 在该连接上执行func(*args)
+        """
+        engine = self.engine
+        reader = engine._checkout() # 可能需要等待空闲的连接, 不能在_lock中进行
+        with self._lock:
+            self.reader = reader
+        previous = engine._bind(self.reader)
+        try:
+            return func(*args)
+        finally:
+            engine._bind(previous)
+            self.close()
+
+    def fetch(self, open_rows, batch_size):
+        """第一次调用时借出连接并打开open_rows()返回的generator, 之后每次读取batch_size个结果。
+        读取完毕时归还连接
+        """
+        engine = self.engine
+        if self.rows is None:
+            reader = engine._checkout()
+            with self._lock:
+                self.reader = reader
+                self.rows = engine._read_rows(open_rows(), reader)
+        batch = list(itertools.islice(self.rows, batch_size))
+        if len(batch) < batch_size:
+            self.close()
+        return batch
+
+    def interrupt(self):
+        with self._lock:
+            if self.reader is not None:
+                self.reader[0].interrupt()
+
+    def close(self):
+        with self._lock:
+            if self.rows is not None:
+                self.rows.close()
+                self.rows = None
+            if self.reader is not None:
+                self.engine.pool.release(self.reader[0])
+                self.reader = None
+
+class AsyncSearchEngine(object):
+    """SearchEngine的asyncio包装
+
+    AsyncSearchEngine.engine
+        被包装的, concurrent=True的SearchEngine
+
+    AsyncSearchEngine.executor
+        执行SQLite操作的线程池, 默认线程数等于engine.pool的大小, 这样线程不会因为等待连接而被阻塞
+
+    AsyncSearchEngine.batch_size
+        search每次在线程池中读取多少个结果
+
+    AsyncSearchEngine.timeout
+        每个查询在SQLite上最多花费多少秒, 超时抛出asyncio.TimeoutError。 None表示不限制。
+        每个方法也可以用timeout参数单独指定
+    """
+    def __init__(self, engine, max_workers=None, batch_size=100, timeout=None):
+        if engine.pool is None:
+            raise Exception("ERROR! AsyncSearchEngine requires SearchEngine(..., concurrent=True)")
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers or engine.pool.size)
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    def create_query(self):
+        return self.engine.create_query()
+
+    async def _submit(self, task, timeout, func, *args):
+        """在线程池中执行func(*args)并等待结果。 被取消或超时时中断task, 并在func结束之后关闭task
+        """
+        if timeout is not None and task.spent >= timeout:
+            task.close()
+            raise asyncio.TimeoutError()
+        future = task.future = self.executor.submit(func, *args)
+        st = time.time()
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          None if timeout is None else timeout - task.spent)
+        except BaseException: # CancelledError, TimeoutError, 以及查询本身的错误
+            task.interrupt()
+            future.add_done_callback(lambda _: task.close())
+            raise
+        finally:
+            task.spent += time.time() - st
+
+    async def search(self, query, order_by=None, limit=None, search_after=None, descending=False,
+                     fields=None, timeout=None):
+        """SearchEngine.search的async generator版本, 参数的含义相同
+        """
+        engine = self.engine
+        timeout = self.timeout if timeout is None else timeout
+        open_rows = lambda: engine._search_rows(query, order_by, limit, search_after, descending, fields)
+        task = _ReadTask(engine)
+        try:
+            while True:
+                batch = await self._submit(task, timeout, task.fetch, open_rows, self.batch_size)
+                for row in batch:
+                    yield row
+                if len(batch) < self.batch_size:
+                    return
+        finally:
+            ### 调用者没有读完所有的结果。 如果还有正在执行的操作, 由_submit在它结束之后关闭task
+            if task.future is None or task.future.done():
+                task.close()
+
+    async def search_document(self, query, order_by=None, limit=None, search_after=None,
+                              descending=False, fields=None, timeout=None):
+        """SearchEngine.search_document的async generator版本, 参数的含义相同
+        """
+        keys = list(self.engine.fields) if fields is None else list(fields)
+        async for row in self.search(query, order_by=order_by, limit=limit, search_after=search_after,
+                                     descending=descending, fields=fields, timeout=timeout):
+            yield OrderedDict(zip(keys, row))
+
+    async def count(self, query, timeout=None):
+        """SearchEngine.count的async版本
+        """
+        timeout = self.timeout if timeout is None else timeout
+        task = _ReadTask(self.engine)
+        return await self._submit(task, timeout, task.call, self.engine.count, query)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+if __name__ == "__main__":
+    from .engine import SearchEngine
+    from .fields import *
+    import os
+    import shutil
+    import tempfile
+    
+    def unittest_timeout():
+        """超时的查询抛出asyncio.TimeoutError, 正在执行的SQL语句被中断, 借出的连接被归还, 
+        之后的查询不受影响
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            schema = Schema("movie",
+                Field("movie_id", Searchable_UUID, primary_key=True),
+                Field("title", Searchable_TEXT),
+                Field("genres", Searchable_KEYWORD),
+                )
+            engine = SearchEngine(os.path.join(directory, "movie.db"), schema, concurrent=True, pool_size=2)
+            engine.add_all([{"movie_id": str(i), "title": "Movie %s" % i, "genres": "Drama" if i % 2 else "Comedy"}
+                            for i in range(100000)])
+            aengine = AsyncSearchEngine(engine)
+            
+            async def main():
+                query = aengine.create_query()
+                query.add(query.query_like("title", "Movie 9999")) # 没有全文索引, 扫描整个主表
+                st = time.time()
+                assert await aengine.count(query) == 11
+                elapsed = time.time() - st
+                async def search():
+                    return [row async for row in aengine.search(query, timeout=0.001)]
+                for run in (lambda: aengine.count(query, timeout=0.001), search):
+                    try:
+                        await run()
+                    except asyncio.TimeoutError:
+                        pass
+                    else:
+                        raise AssertionError("query did not time out, a full run took %.3f seconds" % elapsed)
+                for _ in range(100): # 被中断的SQL语句结束之后连接被归还
+                    if engine.pool._queue.qsize() == engine.pool.size:
+                        break
+                    await asyncio.sleep(0.01)
+                assert engine.pool._queue.qsize() == engine.pool.size
+                assert len([row async for row in aengine.search(query)]) == 11
+                print("a full run took %.3f seconds" % elapsed)
+            
+            asyncio.run(main())
+            aengine.close()
+            engine.pool.close()
+        finally:
+            shutil.rmtree(directory)
+    
+    unittest_timeout()
@@ -0,0 +1,63 @@
+##encoding=utf8
+
+"""
+把search的结果按列转换为numpy数组, 用于 SearchEngine.search_arrays。
+
+每个单元的dtype由 Field.numpy_dtype 决定 (见 tala/fields.py):
+
+    Integer     -> int64, 含有NULL时返回 numpy.ma.MaskedArray
+    REAL        -> float64, NULL为nan
+    Date        -> datetime64[D], NULL为NaT
+    DateTime    -> datetime64[us], NULL为NaT
+    TEXT        -> object
+    PickleType  -> object, 元素为LazyObject
+
+numpy是可选的依赖, 只有调用search_arrays时才需要。
+
+import:
+    from tala.arrays import ColumnBuilder
+"""
+
+from __future__ import print_function
+try:
+    import numpy as np
+except ImportError: # numpy是可选的
+    np = None
+
+def require_numpy():
+    if np is None:
+        raise Exception("ERROR! search_arrays requires numpy, please install it first (pip install numpy)")
+
+class ColumnBuilder(object):
+    """逐批接收一列的值(一个tuple), 每一批直接转换为一个numpy数组, 最后拼接成一个数组
+    """
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.chunks = list()
+        self.masks = list() # 与chunks一一对应, 只有整数列中含有NULL时才不为None
+
+    def append(self, values):
+        mask = None
+        if self.dtype.kind == "O":
+            array = np.empty(len(values), dtype=object)
+            array[:] = values
+        elif self.dtype.kind == "i":
+            try:
+                array = np.array(values, dtype=self.dtype)
+            except TypeError: # 含有NULL
+                mask = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+                array = np.array([0 if value is None else value for value in values], dtype=self.dtype)
+        else:
+            array = np.array(values, dtype=self.dtype)
+        self.chunks.append(array)
+        self.masks.append(mask)
+
+    def to_array(self):
+        if not self.chunks:
+            return np.empty(0, dtype=self.dtype)
+        array = np.concatenate(self.chunks)
+        if any(mask is not None for mask in self.masks):
+            mask = np.concatenate([np.zeros(len(chunk), dtype=bool) if mask is None else mask \
+                                   for chunk, mask in zip(self.chunks, self.masks)])
+            return np.ma.masked_array(array, mask=mask)
+        return array
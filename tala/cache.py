@@ -0,0 +1,196 @@
+##encoding=utf8
+
+"""
+SearchEngine内部使用的缓存。
+
+import:
+    from tala.cache import LRUCache, LFUCache, estimate_size
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import sys
+import threading
+
+def estimate_size(obj):
+    """粗略估计一个 row(tuple) / list / dict / 标量 所占用的内存字节数
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        for item in obj:
+            size += estimate_size(item)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key) + estimate_size(value)
+    return size
+
+class LRUCache(object):
+    """容量有上限的LRU(Least Recently Used)缓存
+
+    LRUCache.maxsize
+        缓存的容量上限, 超出时淘汰最久没有被访问的条目
+
+    LRUCache.sizeof
+        计算每个条目占用多少容量的函数。 默认每个条目占用1, 即maxsize是条目数的上限;
+        使用 estimate_size 时maxsize就是内存字节数的上限
+
+    LRUCache.currsize
+        当前已占用的容量
+
+    LRUCache.hits, LRUCache.misses
+        命中和未命中的次数, 用于评估缓存的大小是否合适
+    """
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # {key: (value, size)}
+        self._lock = threading.RLock() # SearchEngine的并发模式下会被多个线程同时访问
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None):
+        """size为该条目占用的容量, 缺省时由 LRUCache.sizeof 计算
+        """
+        if size is None:
+            size = 1 if self.sizeof is None else self.sizeof(value)
+        with self._lock:
+            if size > self.maxsize: # 比整个缓存还大的条目不缓存
+                return
+            self.pop(key)
+            self._data[key] = (value, size)
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.currsize -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                _, size = self._data.pop(key)
+                self.currsize -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currsize = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "%s(size=%s, currsize=%s, maxsize=%s, hits=%s, misses=%s)" % (
+            self.__class__.__name__, len(self), self.currsize, self.maxsize, self.hits, self.misses)
+
+class LFUCache(object):
+    """容量有上限的, 按访问频率淘汰的缓存。 适合缓存少数被反复访问的大对象, 例如热门keyword的倒排列表。
+
+    与LRUCache不同, 一次偶然的访问不会把频繁访问的条目挤出缓存:
+
+    - 淘汰时优先淘汰访问频率最低的条目, 频率相同时淘汰最久没有被访问的条目;
+    - 新条目的访问频率低于需要被淘汰的条目时, 新条目不会被放入缓存;
+    - 访问次数(包括未命中)每累计 aging_period 次, 所有频率减半, 使过去的热门条目可以逐渐被淘汰。
+
+    属性 maxsize, sizeof, currsize, hits, misses 的含义与LRUCache相同
+    """
+    def __init__(self, maxsize, sizeof=None, aging_period=1000):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.aging_period = aging_period
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # {key: (value, size)}, 按最近访问的时间排列
+        self._lock = threading.RLock()
+        self._frequency = dict() # {key: 访问频率}, 也记录不在缓存中的key
+        self._accesses = 0
+
+    def _touch(self, key):
+        self._frequency[key] = self._frequency.get(key, 0) + 1
+        self._accesses += 1
+        if self._accesses >= self.aging_period:
+            self._accesses = 0
+            for k in list(self._frequency):
+                frequency = self._frequency[k] // 2
+                if frequency or k in self._data:
+                    self._frequency[k] = frequency
+                else:
+                    del self._frequency[k]
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._touch(key)
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None):
+        """size为该条目占用的容量, 缺省时由 LFUCache.sizeof 计算。 返回是否被放入了缓存
+        """
+        if size is None:
+            size = 1 if self.sizeof is None else self.sizeof(value)
+        with self._lock:
+            if size > self.maxsize:
+                return False
+            self.pop(key)
+        
+            ### 按 (频率, 最近访问时间) 升序挑选需要淘汰的条目
+            victims = list()
+            free = self.maxsize - self.currsize
+            if free < size:
+                frequency = self._frequency.get(key, 0)
+                candidates = sorted(enumerate(self._data), 
+                                    key=lambda item: (self._frequency.get(item[1], 0), item[0]))
+                for _, victim in candidates:
+                    if self._frequency.get(victim, 0) > frequency: # 新条目不如已有的条目热门
+                        return False
+                    victims.append(victim)
+                    free += self._data[victim][1]
+                    if free >= size:
+                        break
+            for victim in victims:
+                self.pop(victim)
+            self._data[key] = (value, size)
+            self.currsize += size
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                _, size = self._data.pop(key)
+                self.currsize -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._frequency.clear()
+            self.currsize = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "%s(size=%s, currsize=%s, maxsize=%s, hits=%s, misses=%s)" % (
+            self.__class__.__name__, len(self), self.currsize, self.maxsize, self.hits, self.misses)
@@ -3,10 +3,31 @@
 from __future__ import print_function
 from sqlalchemy import create_engine
 from sqlalchemy.sql import select
+from sqlalchemy.pool import StaticPool
 from collections import OrderedDict
-from .util.iterable import grouper
+from functools import reduce
+from .util.iterable import grouper, grouper_list
+from .posting import Bitmap, encode_posting, decode_posting
+from .fields import DOC_ID, LazyObject
+from .planner import QueryPlanner
+from .cache import LRUCache, LFUCache, estimate_size
+from .pool import ConnectionPool
+from .arrays import ColumnBuilder, require_numpy
+from .segment import Segment, SegmentWriter, typecode_for, pick_segments, merge_segments
+from .profiler import Profiler
+from contextlib import contextmanager
+import itertools
+import heapq
+import logging
+import multiprocessing
+import os
+import pickle
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import uuid
 
 ##################################################
 #                                                #
@@ -14,7 +35,75 @@ import time
 #                                                #
 ##################################################
 
-class QueryEqual():
+LIKE_ESCAPE = "\\"
+
+def escape_like(text):
+    """转义LIKE模式中的通配符, 配合 ESCAPE '\\' 使用, 使得 % _ 被当作普通字符匹配
+    """
+    return text.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2).replace("%", LIKE_ESCAPE + "%").replace("_", LIKE_ESCAPE + "_")
+
+class SqlCriterion():
+    """对主表进行查询的criterion的基类
+    
+    子类定义 template 和 params()。template中所有的值都以 ? 占位, 由sqlite3绑定, 所以同一种
+    criterion作用在同一个单元上时, 无论值是什么, 生成的SQL语句都完全相同, SQLite只需要解析和规划
+    一次。 同时值中的引号等字符也不会破坏SQL语句。
+    """
+    template = None
+    
+    def params(self):
+        return []
+    
+    def uses_fulltext(self, schema):
+        """是否通过全文索引执行, 见 PatternCriterion
+        """
+        return False
+    
+    def shape(self, schema=None):
+        """与值无关的, 用于缓存SQL语句的键
+        """
+        return (self.template, self.field_name, self.uses_fulltext(schema))
+    
+    def to_sql(self, schema=None):
+        """返回 (带 ? 占位符的SQL条件, 绑定的值)
+        """
+        return self.template.format(self.field_name), self.params()
+    
+    def normalized(self):
+        """可哈希的规范形式, 语义相同的criterion的规范形式相同, 用作结果缓存的键
+        """
+        return (self.__class__.__name__, self.field_name, tuple(self.params()))
+
+FULLTEXT_MIN_LENGTH = 3 # trigram分词器只能用长度不小于3的片段进行索引查询
+
+class PatternCriterion(SqlCriterion):
+    """QueryStartwith, QueryEndwith, QueryLike的基类, 子类定义 text 属性
+    
+    LIKE '%x%' 无法利用B树索引。 如果单元在Schema中被声明为全文索引(Field(..., fulltext=True)),
+    并且片段的长度不小于FULLTEXT_MIN_LENGTH, 则先用FTS5 trigram索引 MATCH 出包含该片段的候选文档, 
+    再用原来的LIKE条件确认匹配的位置(开头/结尾/任意), 所以结果和直接使用LIKE完全相同。
+    """
+    template = "{0} LIKE ? ESCAPE '\\'"
+    text = None
+    
+    def uses_fulltext(self, schema):
+        return (schema is not None) and (self.field_name in schema.fulltext_fields) \
+            and (len(self.text) >= FULLTEXT_MIN_LENGTH)
+    
+    def to_sql(self, schema=None):
+        sqlcmd, params = SqlCriterion.to_sql(self)
+        if self.uses_fulltext(schema):
+            sqlcmd = "{0} IN (SELECT doc_key FROM {1} WHERE {1} MATCH ?)\n\tAND {2}".format(
+                schema.doc_key, schema.fulltext_table(self.field_name), sqlcmd)
+            params = ['"%s"' % self.text.replace('"', '""')] + params # 作为FTS5的短语进行匹配
+        return sqlcmd, params
+    
+    def selectivity(self, statistics):
+        return statistics.pattern_selectivity(self.field_name)
+
+class QueryEqual(SqlCriterion):
+    template = "{0} = ?"
+    
     def __init__(self, field_name, value):
         self.field_name = field_name
         self.value = value
@@ -23,8 +112,16 @@ class QueryEqual():
     def __str__(self):
         return "%s = %s" % (self.field_name,
                             repr(self.value))
+    
+    def params(self):
+        return [self.value]
+    
+    def selectivity(self, statistics):
+        return statistics.equal_selectivity(self.field_name)
         
-class QueryGreater():
+class QueryGreater(SqlCriterion):
+    template = "{0} >= ?"
+    
     def __init__(self, field_name, lowerbound):
         self.field_name = field_name
         self.lowerbound = lowerbound
@@ -33,8 +130,16 @@ class QueryGreater():
     def __str__(self):
         return "%s >= %s" % (self.field_name,
                              repr(self.lowerbound),)
+    
+    def params(self):
+        return [self.lowerbound]
+    
+    def selectivity(self, statistics):
+        return statistics.range_selectivity(self.field_name, self.lowerbound, None)
         
-class QuerySmaller():
+class QuerySmaller(SqlCriterion):
+    template = "{0} <= ?"
+    
     def __init__(self, field_name, upperbound):
         self.field_name = field_name
         self.upperbound = upperbound
@@ -43,8 +148,16 @@ class QuerySmaller():
     def __str__(self):
         return "%s <= %s" % (self.field_name,
                              repr(self.upperbound),)
+    
+    def params(self):
+        return [self.upperbound]
+    
+    def selectivity(self, statistics):
+        return statistics.range_selectivity(self.field_name, None, self.upperbound)
             
-class QueryBetween():
+class QueryBetween(SqlCriterion):
+    template = "{0} BETWEEN ? AND ?"
+    
     def __init__(self, field_name, lowerbound, upperbound):
         self.field_name = field_name
         self.lowerbound = lowerbound
@@ -55,8 +168,16 @@ class QueryBetween():
         return "%s BETWEEN %s AND %s" % (self.field_name,
                                          repr(self.lowerbound),
                                          repr(self.upperbound),)
+    
+    def params(self):
+        return [self.lowerbound, self.upperbound]
+    
+    def selectivity(self, statistics):
+        return statistics.range_selectivity(self.field_name, self.lowerbound, self.upperbound)
 
-class QueryStartwith():
+class QueryStartwith(PatternCriterion):
+    text = property(lambda self: self.prefix)
+    
     def __init__(self, field_name, prefix):
         self.field_name = field_name
         self.prefix = prefix
@@ -65,8 +186,13 @@ class QueryStartwith():
     def __str__(self):
         return "{0} LIKE '{1}%'".format(self.field_name,
                                         self.prefix)
+    
+    def params(self):
+        return [escape_like(self.prefix) + "%"]
         
-class QueryEndwith():
+class QueryEndwith(PatternCriterion):
+    text = property(lambda self: self.surfix)
+    
     def __init__(self, field_name, surfix):
         self.field_name = field_name
         self.surfix = surfix
@@ -75,8 +201,13 @@ class QueryEndwith():
     def __str__(self):
         return "{0} LIKE '%{1}'".format(self.field_name,
                                         self.surfix)
+    
+    def params(self):
+        return ["%" + escape_like(self.surfix)]
 
-class QueryLike():
+class QueryLike(PatternCriterion):
+    text = property(lambda self: self.piece)
+    
     def __init__(self, field_name, piece):
         self.field_name = field_name
         self.piece = piece
@@ -85,12 +216,132 @@ class QueryLike():
     def __str__(self):
         return "{0} LIKE '%{1}%'".format(self.field_name,
                                          self.piece)
+    
+    def params(self):
+        return ["%" + escape_like(self.piece) + "%"]
 
 class QueryContains():
     def __init__(self, field_name, *keywords):
         self.field_name = field_name
         self.subset = {keyword for keyword in keywords}
+        if len(self.subset) == 0: # 否则"table"模式下会被编译成不合法的SQL "()"
+            raise Exception("%s requires at least one keyword!" % self.__class__.__name__)
         self.issql = False
+        
+    def __str__(self):
+        return "%s CONTAINS %s" % (self.field_name, ", ".join(sorted(self.subset)))
+        
+    def normalized(self):
+        return (self.__class__.__name__, self.field_name, tuple(sorted(self.subset)))
+    
+    ### 以下方法只在 posting_format = "table" 模式下, 作为布尔表达式的一部分被编译成SQL时使用
+    def shape(self, schema=None):
+        return (self.__class__.__name__, self.field_name, len(self.subset))
+    
+    def to_sql(self, schema=None):
+        keywords = sorted(self.subset)
+        condition = "{0} IN (SELECT {1} FROM {2} WHERE keyword = ?)".format(
+            schema.doc_key, schema.posting_column, self.field_name)
+        return "(" + " AND ".join([condition] * len(keywords)) + ")", keywords
+    
+    def selectivity(self, statistics):
+        frequencies = statistics.keyword_frequencies(self.field_name, sorted(self.subset))
+        return float(min(frequencies.values())) / max(statistics.document_count, 1)
+
+class BooleanCriterion():
+    """QueryAnd, QueryOr, QueryNot的基类, 用于把criterion组合成任意嵌套的布尔表达式
+    
+    只由主表criterion组成的表达式(在"table"模式下也包括query_contains)会被编译成一个SQL条件, 和普通的
+    主表criterion一样参与查询规划。 包含query_contains的表达式在倒排列表上用集合运算求值: AND为交集, 
+    OR为并集, NOT为差集; 同一个节点下所有可以编译成SQL的子表达式合并为一条SQL语句。
+    
+    NOT的含义是 "不满足该条件的文档", 所以单元的值为NULL的文档也被包括在内, 这与集合运算的结果一致。
+    """
+    field_name = None
+    issql = False
+    children = ()
+    
+    def leaves(self):
+        for child in self.children:
+            if isinstance(child, BooleanCriterion):
+                for leaf in child.leaves():
+                    yield leaf
+            else:
+                yield child
+    
+    def compiles_to_sql(self, schema):
+        """是否可以整个编译成一个对主表的SQL条件
+        """
+        return all(leaf.issql or (schema.posting_format == "table") for leaf in self.leaves())
+    
+    def normalized(self):
+        return (self.__class__.__name__, 
+                tuple(sorted(set(child.normalized() for child in self.children), key=repr)))
+    
+    def shape(self, schema=None):
+        return (self.__class__.__name__, tuple(child.shape(schema) for child in self.children))
+
+class _JunctionCriterion(BooleanCriterion):
+    """QueryAnd和QueryOr的基类。 嵌套的同类节点会被展开, 重复的子表达式会被去掉
+    """
+    operator = None
+    
+    def __init__(self, *criterions):
+        self.children = list()
+        seen = set()
+        for criterion in criterions:
+            if isinstance(criterion, self.__class__):
+                children = criterion.children
+            else:
+                children = [criterion]
+            for child in children:
+                key = child.normalized()
+                if key not in seen:
+                    seen.add(key)
+                    self.children.append(child)
+        if len(self.children) == 0:
+            raise Exception("%s requires at least one criterion!" % self.__class__.__name__)
+    
+    def __str__(self):
+        return "(" + (" %s " % self.operator).join(str(child) for child in self.children) + ")"
+    
+    def to_sql(self, schema=None):
+        conditions, params = list(), list()
+        for child in self.children:
+            condition, child_params = child.to_sql(schema)
+            conditions.append(condition)
+            params.extend(child_params)
+        return "(" + (" %s " % self.operator).join(conditions) + ")", params
+
+class QueryAnd(_JunctionCriterion):
+    operator = "AND"
+    
+    def selectivity(self, statistics):
+        return reduce(lambda x, y: x * y, [child.selectivity(statistics) for child in self.children])
+
+class QueryOr(_JunctionCriterion):
+    operator = "OR"
+    
+    def selectivity(self, statistics):
+        miss = reduce(lambda x, y: x * y, [1.0 - child.selectivity(statistics) for child in self.children])
+        return 1.0 - miss
+
+class QueryNot(BooleanCriterion):
+    def __init__(self, criterion):
+        self.children = [criterion]
+    
+    def __str__(self):
+        return "NOT %s" % self.children[0]
+    
+    def normalized(self):
+        return (self.__class__.__name__, self.children[0].normalized())
+    
+    def to_sql(self, schema=None):
+        condition, params = self.children[0].to_sql(schema)
+        return "({0}) IS NOT 1".format(condition), params # 条件的值为0或NULL时都算作不满足
+    
+    def selectivity(self, statistics):
+        return 1.0 - self.children[0].selectivity(statistics)
 
 class Query():
     """抽象查询对象, 用于储存用户自定义的查询条件
@@ -102,6 +353,9 @@ class Query():
     2. 先用倒排索引筛选出所有的uuid_set, 然后依次检查主表查询的行结果, 如果行中的主键在uuid_set集合中, 
     则输出。
     经过试验证明, 无论什么情况, 方法1的速度都要远远优于方法2。
+    
+    当倒排索引给出的候选集合很小时, 直接带着主表条件按主键探测候选文档比以上两种做法都更快。
+    具体使用哪一种做法由 SearchEngine.planner 根据统计信息决定, 见 tala/planner.py。
     """
     def __init__(self, schema):
         self.schema = schema
@@ -115,24 +369,43 @@ class Query():
         self.query_endwith = QueryEndwith
         self.query_like = QueryLike
         self.query_contains = QueryContains
+        self.query_and = QueryAnd
+        self.query_or = QueryOr
+        self.query_not = QueryNot
         
     def add_criterion(self, criterion):
         """add a searching criterion 
         all criterions will be joint with AND operation by default.
+        
+        criterion也可以是由 query_and, query_or, query_not 组合而成的布尔表达式, 例如:
+            query.add(query.query_or(query.query_contains("genres", "Drama"),
+                                     query.query_contains("genres", "Comedy")))
+            query.add(query.query_not(query.query_contains("genres", "Short")))
         """
-        if criterion.field_name in self.schema.fields:
-            self.criterions.append(criterion)
+        if isinstance(criterion, BooleanCriterion):
+            leaves = list(criterion.leaves())
+            criterion.issql = criterion.compiles_to_sql(self.schema)
         else:
-            raise Exception("""criterion has to be applied to one of the searchable fields.
+            leaves = [criterion]
+        for leaf in leaves:
+            if leaf.field_name not in self.schema.fields:
+                raise Exception("""criterion has to be applied to one of the searchable fields.
             yours is = {0}
-            all valid fields = {1}""".format(repr(criterion.field_name),
+            all valid fields = {1}""".format(repr(leaf.field_name),
                                              list(self.schema.fields) ) )
+        self.criterions.append(criterion)
         
     def add(self, criterion):
         """just a wrapper for Query.add_criterion(criterion)
         """
         self.add_criterion(criterion)
         
+    def normalized(self):
+        """Query的规范形式: 所有criterion的规范形式排序去重后的tuple。 因为criterion之间是AND的关系,
+        添加的顺序和重复的criterion都不影响结果
+        """
+        return tuple(sorted(set(criterion.normalized() for criterion in self.criterions), key=repr))
+    
     def _split_SqlCriterions_and_KeywordCriterions(self):
         """分离对主表查询的criterion和对倒排索引表查询的criterion
         returns
@@ -153,30 +426,156 @@ class Query():
         """生成对主表进行查询的SQL语句和若干个对倒排索引表查询的SQL语句
         create one SQL command for the main_table and create several SQL command for invert index
         table
+        
+        所有的SQL语句都是参数化的, 返回值中的每一项都是 (sqlcmd, params):
+            main_sqlcmd, main_sqlcmd_select_all, keyword_sqlcmd_list = query.create_sql()
+            cursor.execute(*main_sqlcmd)
+        
+        posting_format = "segment"时倒排列表储存在segment文件中, 不在任何表中, keyword_sqlcmd_list为空
         """
         sql_criterions, keyword_criterions = self._split_SqlCriterions_and_KeywordCriterions()
         
         ### SQL command for the main table (which table_name = Engine.schema_name)
-        select_clause = "SELECT\t{0}\n".format(self.schema.uuid)
-        select_clause_all = "SELECT\t*\n"
+        main_sqlcmd = self.create_select_sql([self.schema.doc_key], sql_criterions)
+        main_sqlcmd_select_all = self.create_select_sql(list(self.schema.fields), sql_criterions)
         
-        from_clause = "FROM\t{0}\n".format(self.schema.schema_name)
-        if len(sql_criterions) >= 1:
-            where_clause = "WHERE\t" + "\n\tAND ".join([str(criterion) for criterion in sql_criterions])
-        else:
-            where_clause = ""
-        main_sqlcmd = select_clause + from_clause + where_clause
-        main_sqlcmd_select_all = select_clause_all + from_clause + where_clause
         ### SQL command for the invert index table (which table_name = Engine.keyword_fields)
         keyword_sqlcmd_list = list()
+        if self.schema.posting_column is None:
+            return main_sqlcmd, main_sqlcmd_select_all, keyword_sqlcmd_list
         for criterion in keyword_criterions:
+            if not isinstance(criterion, QueryContains): # 在倒排列表上求值的布尔表达式
+                continue
             for keyword in criterion.subset:
-                select_clause = "SELECT\t{0}\n".format("uuid_set")
+                select_clause = "SELECT\t{0}\n".format(self.schema.posting_column)
                 from_clause = "FROM\t{0}\n".format(criterion.field_name)
-                where_clause = "WHERE\t{0} = {1}".format("keyword", repr(keyword))
-                keyword_sqlcmd_list.append(select_clause + from_clause + where_clause)
+                where_clause = "WHERE\tkeyword = ?"
+                keyword_sqlcmd_list.append((select_clause + from_clause + where_clause, [keyword]))
         
         return main_sqlcmd, main_sqlcmd_select_all, keyword_sqlcmd_list
+    
+    def keyword_terms_by_field(self):
+        """返回所有keyword criterion中的keyword, 按单元分组并去重: OrderedDict({field_name: [keyword]})
+        """
+        terms = OrderedDict()
+        for criterion in self.criterions:
+            if isinstance(criterion, QueryContains):
+                keywords = terms.setdefault(criterion.field_name, list())
+                for keyword in criterion.subset:
+                    if keyword not in keywords:
+                        keywords.append(keyword)
+        return terms
+    
+    def create_where_params(self, sql_criterions, keyword_terms=()):
+        """create_where_clause所生成的条件中, 按顺序需要绑定的值
+        """
+        params = list()
+        for criterion in sql_criterions:
+            params.extend(criterion.to_sql(self.schema)[1])
+        for term in keyword_terms:
+            params.append(term[1])
+        return params
+    
+    def create_where_clause(self, sql_criterions, keyword_terms=()):
+        """把若干个对主表的criterion, 以及 keyword_terms [(field_name, keyword, ...)] 所对应的
+        DOC_ID IN (SELECT doc_id FROM keyword_table WHERE keyword = ?) 条件, 按给定的顺序用AND连接起来。
+        返回 (where_clause, params)
+        """
+        conditions = [criterion.to_sql(self.schema)[0] for criterion in sql_criterions]
+        for term in keyword_terms:
+            conditions.append("{0} IN (SELECT {1} FROM {2} WHERE keyword = ?)".format(
+                self.schema.doc_key, self.schema.posting_column, term[0]))
+        return "\n\tAND ".join(conditions), self.create_where_params(sql_criterions, keyword_terms)
+    
+    def create_select_sql(self, columns, sql_criterions, keyword_terms=()):
+        """生成 SELECT columns FROM 主表 WHERE ... 的参数化SQL语句, 返回 (sqlcmd, params)
+        """
+        where_clause, params = self.create_where_clause(sql_criterions, keyword_terms)
+        select_clause = "SELECT\t{0}\n".format(", ".join(columns))
+        from_clause = "FROM\t{0}\n".format(self.schema.schema_name)
+        if where_clause:
+            where_clause = "WHERE\t" + where_clause
+        return select_clause + from_clause + where_clause, params
+
+class Ordering():
+    """search结果的排序方式
+    
+    按单元order_by排序, 并以uuid作为第二排序键, 保证顺序是唯一确定的。 search_after是上一页最后
+    一个结果的 (order_by的值, uuid) (order_by就是uuid时只需要uuid), 用于keyset分页: 下一页直接从
+    这个位置之后开始, 而不需要像OFFSET那样先读取并跳过前面所有的行。
+    
+    与SQLite一致, 升序时NULL排在最前面, 降序时NULL排在最后面。
+    """
+    def __init__(self, schema, order_by, descending=False, columns=None):
+        """columns为查询结果中的列, 默认为所有的单元, 必须包含order_by和uuid
+        """
+        if order_by not in schema.fields:
+            raise Exception("order_by has to be one of %s, yours is %r" % (list(schema.fields), order_by))
+        self.order_by = order_by
+        self.uuid = schema.uuid
+        self.descending = descending
+        field_names = list(schema.fields) if columns is None else list(columns)
+        self.position = field_names.index(order_by)
+        self.uuid_position = field_names.index(schema.uuid)
+        
+    def order_clause(self):
+        direction = " DESC" if self.descending else ""
+        if self.order_by == self.uuid:
+            return self.uuid + direction
+        return "{0}{2}, {1}{2}".format(self.order_by, self.uuid, direction)
+    
+    def _normalize(self, search_after):
+        if self.order_by == self.uuid and not isinstance(search_after, (tuple, list)):
+            return (search_after, search_after)
+        if self.order_by == self.uuid:
+            return (search_after[0], search_after[0])
+        return tuple(search_after)
+    
+    def keyset_clause(self, search_after):
+        """返回 (只保留排在search_after之后的行的SQL条件, 绑定的值)
+        """
+        value, uuid = self._normalize(search_after)
+        op = "<" if self.descending else ">"
+        if self.order_by == self.uuid:
+            return "{0} {1} ?".format(self.uuid, op), [uuid]
+        if value is None:
+            if self.descending:
+                return "({0} IS NULL AND {1} < ?)".format(self.order_by, self.uuid), [uuid]
+            return "(({0} IS NULL AND {1} > ?) OR {0} IS NOT NULL)".format(self.order_by, self.uuid), [uuid]
+        clause = "({0} {2} ? OR ({0} = ? AND {1} {2} ?))".format(self.order_by, self.uuid, op)
+        if self.descending:
+            clause = "({0} OR {1} IS NULL)".format(clause, self.order_by)
+        return clause, [value, value, uuid]
+    
+    def keyset_shape(self, search_after):
+        if search_after is None:
+            return None
+        return self._normalize(search_after)[0] is None
+    
+    def _key(self, value, uuid):
+        return (value is not None, value if value is not None else 0, uuid)
+    
+    def sort_key(self, row):
+        """python中与SQL的ORDER BY一致的排序键
+        """
+        return self._key(row[self.position], row[self.uuid_position])
+    
+    def is_after(self, row, search_after):
+        after_key = self._key(*self._normalize(search_after))
+        if self.descending:
+            return self.sort_key(row) < after_key
+        return self.sort_key(row) > after_key
+    
+    def top(self, rows, limit, search_after=None):
+        """在python中对rows排序, 只保留search_after之后的前limit个。 limit不为None时使用大小为limit的堆
+        """
+        if search_after is not None:
+            rows = (row for row in rows if self.is_after(row, search_after))
+        if limit is None:
+            return sorted(rows, key=self.sort_key, reverse=self.descending)
+        if self.descending:
+            return heapq.nlargest(limit, rows, key=self.sort_key)
+        return heapq.nsmallest(limit, rows, key=self.sort_key)
 
 ##################################################
 #                                                #
@@ -184,10 +583,52 @@ class Query():
 #                                                #
 ##################################################
 
+compaction_logger = logging.getLogger("tala.compaction")
+
+### 少于这个数量的文档直接在本进程中制作倒排索引, 因为进程间传输数据的开销大于收益
+PARALLEL_MIN_DOCUMENTS = 10000
+
+def build_invert_index(keyword_fields, doc_keys, columns, posting=set):
+    """由一批文档的doc_key, 以及每个keyword单元的一列值 (与doc_keys一一对应, 是以 "&" 连接的字符串) 
+    制作倒排索引, 返回 {keyword_field_name: {keyword: posting(list_of_doc_key)}}
+    """
+    all_inv_dict = dict() # {keyword_field_name: invert_index}
+    for field_name, column in zip(keyword_fields, columns):
+        inv_dict = dict()
+        for doc_key, value in zip(doc_keys, column):
+            if not value:
+                continue
+            for key in value.split("&"):
+                if key in inv_dict:
+                    inv_dict[key].append(doc_key)
+                else:
+                    inv_dict[key] = [doc_key]
+        all_inv_dict[field_name] = dict((key, posting(keys)) for key, keys in inv_dict.items())
+    return all_inv_dict
+
+def _build_invert_index_task(args):
+    """multiprocessing.Pool中执行的任务, 必须是模块级的函数才能被pickle。 子进程只收到keyword单元的
+    值, 返回 {keyword_field_name: {keyword: 文档在这一份中的位置的Bitmap}}, 由本进程换算成doc_key
+    """
+    keyword_fields, columns = args
+    return build_invert_index(keyword_fields, range(len(columns[0])), columns, Bitmap.from_ids)
+
+def writer(method):
+    """SearchEngine的写操作在Engine._write_lock中执行, 同一时刻只有一个写入者
+    """
+    def wrapper(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
 class SearchEngine():
     """
     """
-    def __init__(self, database, schema):
+    def __init__(self, database, schema, statement_cache_size=256, result_cache_size=0,
+                 posting_cache_size=32 * 1024 * 1024, concurrent=False, pool_size=4, in_memory=False,
+                 segment_dir=None, merge_factor=4, segment_retention=60.0):
         """
         Engine.database
             数据库的文件路径
@@ -221,22 +662,166 @@ class SearchEngine():
             
         Engine.uuid
             wrapper for Engine.schema.uuid
+            
+        Engine.doc_key
+            wrapper for Engine.schema.doc_key
+            
+        Engine.merge_batch_size
+            add_all合并倒排列表时, 每次从倒排索引表中读取的keyword的数量
+            
+        Engine.fetch_batch_size
+            search根据doc_key从主表中取数据时, 每一批的doc_key的数量
+            
+        Engine.planner
+            QueryPlanner, 根据统计信息为每个查询生成执行计划
+            
+        Engine._generation
+            每次写入数据后加1, 所有依赖于数据内容的缓存都以它作为失效的依据
+            
+        Engine._statement_cache
+            LRUCache, {查询的形状: SQL语句}。 所有的查询都是参数化的, 形状相同(criterion的种类
+            和单元相同, 值不同)的查询生成完全相同的SQL语句, 直接从这里取出; sqlite3连接本身也会缓存
+            statement_cache_size条prepared statement, 所以重复形状的查询既不需要重新拼接SQL, 
+            也不需要SQLite重新解析和规划
+            
+        Engine.result_cache
+            LRUCache, 查询结果缓存, 容量为result_cache_size字节。 默认为0, 即不缓存结果。
+            缓存的键是查询的规范形式(Query.normalized)以及search的参数, 所以条件相同, 添加顺序不同的
+            查询共享同一个缓存条目。 任何写入(add_all等)都会使 Engine._generation 增加, 
+            从而使所有缓存的结果失效。 result_cache.hits / result_cache.misses 记录了命中和未命中的次数
+            
+        Engine.posting_caches
+            {keyword_field_name: LFUCache}, 每个keyword单元一个, 缓存已经解码的热门keyword的倒排列表,
+            每个缓存的容量为posting_cache_size字节, 为0时不缓存。 按访问频率淘汰, 所以 "Drama" 这样
+            几乎每个查询都会用到的大倒排列表会一直留在内存中。 add_all之后只有被修改过的keyword会失效
+            
+        Engine.pool
+            concurrent=True时为ConnectionPool, 否则为None。 并发模式下:
+            
+            - 数据库使用WAL日志模式, 导入数据时查询不会被阻塞;
+            - 每个查询(search/search_document/count/facets)从pool中借出一个只读连接, 在一个读事务中
+              完成, 所以同一个线程中交替进行的多个查询, 以及多个线程中的查询互不干扰, 并且每个查询
+              看到的都是同一个数据库快照。 search返回的generator在读取完毕或被关闭时归还连接;
+            - 写操作(add_all等)使用唯一的写连接, 由Engine._write_lock串行化。
+            
+            同时进行的查询的数量不能超过pool_size。
+            
+        Engine.in_memory
+            为True时, 启动时用sqlite3的backup API把database整个读入一个内存数据库(database不存在时
+            从空数据库开始), 之后的查询和写入都只在内存中进行, 与磁盘和page cache无关。 
+            内存中的数据只有调用 Engine.snapshot() 时才会被写回磁盘。 不能与concurrent=True同时使用
+            
+        Engine._postings
+            in_memory=True时为 {keyword_field_name: {keyword: 倒排列表}}, 启动时预先解码所有的倒排列表, 
+            查询时不再读取倒排索引表, 所以也不需要posting_caches。 "text"模式下为frozenset, 其中相同的
+            uuid字符串只储存一份; "bitmap"和"segment"模式下为Bitmap; "table"模式下为doc_id的frozenset。
+            写入之后被修改过的keyword会被重新读取。 in_memory=False时为None
+            
+        Engine.segment_dir
+            posting_format = "segment"时储存segment文件的目录, 默认为 database + ".segments"。
+            每次写入为每个keyword单元生成一个新的, 不可修改的segment文件, 写入的事务提交时才被登记到
+            Schema.segment_table中, 所以查询只会看到完整的segment。 segment文件通过mmap读取, 
+            查找keyword不经过SQL, 多个进程共享同一份page cache, 见 tala/segment.py。 查询时映射的倒排列表
+            直接转换为Bitmap (见 Bitmap.from_array), 与"bitmap"模式相同, 所以posting_caches中缓存的是
+            紧凑的位图, 而不是整数的set。 其他模式下为None
+            
+        Engine.merge_factor
+            "segment"模式下的合并策略: 大小相近的segment积累了merge_factor个时, 由 Engine.compact 
+            合并为一个, 见 segment.pick_segments。 所以每次写入只需要写一个小segment, 耗时与已有的
+            数据量无关; 同时每个keyword单元的segment数量只随文档总数对数增长, 查询不会因为写入的
+            次数变多而变慢
+            
+        Engine.segment_retention
+            被合并的segment先在segment表中标记为退役, 经过segment_retention秒之后才删除文件, 
+            所以在合并之前开始的查询(包括其他进程中的查询)仍然可以读取它们
+            
+        Engine.compaction_error
+            start_compaction启动的后台合并最近一次失败时抛出的异常, 没有失败过时为None。 失败同时以
+            ERROR级别写入 logging.getLogger("tala.compaction")
+            
+        Engine.profiler
+            Engine.enable_profiling() 之后为 profiler.Profiler, 记录每个查询在各个阶段的耗时以及
+            慢查询, 否则为None。 不剖析时查询没有任何额外的开销
         """
         self.database = database
         self.schema = schema
+        self.merge_batch_size = 500
+        self.fetch_batch_size = 500
+        self._generation = 0
         
-        self.connect = sqlite3.connect(self.database)
+        self.concurrent = concurrent
+        self.in_memory = in_memory
+        if in_memory:
+            if concurrent:
+                raise Exception("ERROR! in_memory=True can not be used together with concurrent=True")
+            self.connect = sqlite3.connect(":memory:", cached_statements=statement_cache_size)
+            if os.path.exists(self.database):
+                source = sqlite3.connect(self.database)
+                try:
+                    source.backup(self.connect)
+                finally:
+                    source.close()
+        else:
+            self.connect = sqlite3.connect(self.database, cached_statements=statement_cache_size,
+                                           check_same_thread=not concurrent)
         self.cursor = self.connect.cursor()
+        self._local = threading.local() # 当前线程正在执行的查询借出的 (连接, _generation)
+        self._write_lock = threading.RLock()
+        self._cache_lock = threading.RLock() # in_memory模式下_publish在持有它时会重新读取倒排列表
+        self._statement_cache = LRUCache(statement_cache_size)
+        if result_cache_size:
+            self.result_cache = LRUCache(result_cache_size, sizeof=estimate_size)
+        else:
+            self.result_cache = None
+        self._result_cache_generation = 0
+        self.posting_caches = dict()
+        if posting_cache_size and not in_memory:
+            for field_name in self.schema.keyword_fields:
+                self.posting_caches[field_name] = LFUCache(posting_cache_size, sizeof=estimate_size)
         
         self._create_all()
+        self.planner = QueryPlanner(self)
+        if self.schema.posting_format == "segment":
+            self.segment_dir = segment_dir or (self.database + ".segments")
+        else:
+            self.segment_dir = None
+        self.merge_factor = merge_factor
+        self.segment_retention = segment_retention
+        self._segments = dict() # {segment文件名: 已经映射的Segment}
+        self._compact_lock = threading.Lock() # 同一时刻只有一个合并在进行
+        self._compactor = None # (后台合并线程, 唤醒它的Event, 停止它的Event)
+        self.compaction_error = None
+        self._segment_snapshot = None # (_generation, 见 _read_segment_state)
+        self._postings = self._load_postings() if in_memory else None
+        self.profiler = None
+        if concurrent:
+            self.pool = ConnectionPool(self.database, pool_size, statement_cache_size)
+        else:
+            self.pool = None
         
     def _create_all(self):
         """根据schema, 在database中创建所有需要的表格
         """
-        engine = create_engine("sqlite:///%s" % self.database, echo=False)
+        if self.in_memory: # 与Engine.connect共享同一个内存数据库连接
+            engine = create_engine("sqlite://", echo=False, creator=lambda: self.connect,
+                                   poolclass=StaticPool)
+        elif self.concurrent:
+            engine = create_engine("sqlite:///%s" % self.database, echo=False,
+                                   connect_args={"check_same_thread": False})
+        else:
+            engine = create_engine("sqlite:///%s" % self.database, echo=False)
         self.engine = engine
         self.schema.metadata.create_all(self.engine)
         self._SAconn = self.engine.connect()
+        if self.concurrent:
+            self._SAconn.execute("PRAGMA journal_mode = WAL")
+        self._migrate_df_columns()
+        for field_name, sqlcmd in zip(self.schema.fulltext_fields, self.schema.create_fulltext_sqls()):
+            self._SAconn.execute(sqlcmd)
+            ### 在已有数据的数据库上新建的全文索引是空的, 先用主表填充, 否则模式查询会漏掉已有的文档
+            if self._SAconn.execute("SELECT 1 FROM {0} LIMIT 1".format(
+                    self.schema.fulltext_table(field_name))).fetchone() is None:
+                self._SAconn.execute(self.schema.populate_fulltext_sql(field_name))
         
         # add some name space wrapper to access table
         self.fields = self.schema.fields
@@ -244,120 +829,1427 @@ class SearchEngine():
         self.schema_name = self.schema.schema_name
         self.keyword_fields = self.schema.keyword_fields
         self.uuid = self.schema.uuid
+        self.doc_key = self.schema.doc_key
+        
+    def _migrate_df_columns(self):
+        """旧版本创建的倒排索引表没有df列: 加上df列, 并由已有的倒排列表计算每个keyword的df
+        """
+        if self.schema.posting_format not in ("text", "bitmap"):
+            return
+        posting_column = self.schema.posting_column
+        for field_name in self.schema.keyword_fields:
+            columns = [row[1] for row in self._SAconn.execute("PRAGMA table_info({0})".format(field_name))]
+            if "df" in columns:
+                continue
+            self._SAconn.execute("ALTER TABLE {0} ADD COLUMN df INTEGER".format(field_name))
+            records = [(len(self._decode_posting(posting)), keyword) for keyword, posting in \
+                       self._SAconn.execute("SELECT keyword, {0} FROM {1}".format(posting_column, field_name))]
+            if records:
+                self._SAconn.execute("UPDATE {0} SET df = ? WHERE keyword = ?".format(field_name), records)
+    
+    @writer
+    def snapshot(self, path=None):
+        """用sqlite3的backup API把当前的数据库完整地写入磁盘文件path, 得到的是一个一致的快照, 
+        可以直接用 SearchEngine(path, schema) 或 SearchEngine(path, schema, in_memory=True) 打开。
+        path默认为Engine.database, 只有in_memory=True时可以省略
+        """
+        if path is None:
+            if not self.in_memory:
+                raise Exception("ERROR! snapshot requires a path unless in_memory=True")
+            path = self.database
+        target = sqlite3.connect(path)
+        try:
+            self.connect.backup(target)
+        finally:
+            target.close()
         
     def get_table(self, table_name):
         """根据table得到一个表对象
         """
         return self.tables[table_name]
         
-    def add_all(self, documents):
-        """往表格中填充数据
+    @writer
+    def add_all(self, documents, processes=1):
+        """往表格中填充数据, 可以多次调用以增量的方式添加新的文档
         
         step 1. 往主表格填充数据
             主表格名称是 self.schema.schema_name
             主表格对象是 self.schema.tables[self.schema.schema_name]
             
-        step 2. 针对每一个Keyword_field对应的表, 制作倒排索引, 并往内填充数据
+        step 2. 只针对这一批新文档制作倒排索引, 并与倒排索引表中已有的倒排列表合并
+        
+            invert_index = {keyword: set_of_doc_key}
+            
+            posting_format = "text"时doc_key是uuid, 倒排列表以 "&" 连接的字符串储存;
+            posting_format = "bitmap"时doc_key是整数DOC_ID, 倒排列表以压缩位图储存;
+            posting_format = "table"时每个 (keyword, DOC_ID) 对储存为一行。
+            posting_format = "segment"时这一批文档的倒排索引被写成一个新的segment文件。
+            
+        所以每次调用的耗时只和这一批文档的数量, 以及被涉及到的keyword的倒排列表大小有关, 而与主表
+        的大小无关。 整个过程在一个事务中完成, 失败时不会留下只写了一半的索引。
         
-            invert_index = {keyword: set_of_uuid}
+        step 3. 创建主表上的二级索引 (见 Schema.indexes)
+            当这一批文档不少于主表中已有的文档时(例如第一次导入), 视为批量导入: 先删除二级索引, 
+            导入完成后再一次性创建, 这比在导入过程中逐行维护B树快得多。
+            
+        processes大于1时, step 2 中的倒排索引由processes个进程并行制作。 在Windows上调用者的代码
+        需要放在 if __name__ == "__main__": 之下。
         """
-        st = time.clock()
-        print("正在往主表格 %s 中填充数据..." % self.schema_name)
-        ins = self.tables[self.schema_name].insert()
-        self._SAconn.execute(ins, documents)
-        print("\t填充完毕, 一共插入了 %s 条数据" % len(documents))
+        st = time.time()
+        documents = list(documents)
+        if len(documents) == 0:
+            return
+        bulk_load = len(documents) >= self.planner.statistics.document_count
         
-        print("正在为 %s 创建倒排索引..." % self.keyword_fields)
-        all_inv_dict = dict() # {keyword_field_name: invert_index}
-        for field_name in self.schema.keyword_fields: # initialize a empty dict for invert index
-            all_inv_dict[field_name] = dict()
+        with self._SAconn.begin():
+            if bulk_load:
+                self.drop_indexes()
+            print("正在往主表格 %s 中填充数据..." % self.schema_name)
+            documents = self._insert_documents(documents)
+            print("\t填充完毕, 一共插入了 %s 条数据" % len(documents))
+            
+            print("正在为 %s 更新倒排索引..." % self.keyword_fields)
+            if processes > 1:
+                with multiprocessing.Pool(processes) as pool:
+                    all_inv_dict = self._build_invert_index(documents, pool, processes)
+            else:
+                all_inv_dict = self._build_invert_index(documents)
+            for field_name, inv_dict in all_inv_dict.items():
+                self._merge_invert_index(field_name, inv_dict)
+            
+            if self.schema.indexes:
+                print("正在为 %s 创建二级索引..." % list(self.schema.indexes))
+                self.create_indexes()
+        self._publish(all_inv_dict)
+        if bulk_load: # 让SQLite根据新的数据分布更新查询规划所用的统计信息
+            self._SAconn.execute("PRAGMA optimize")
         
-        ### 为了制作倒排索引, 我们只需要从主表中选择 uuid 和 keyword field 对应的列即可, 其他列可不管
+        print("\t数据库准备完毕, 可以进行搜索了! 一共耗时 %s 秒" % (time.time() - st,) )
         
-        main_table = self.get_table(self.schema_name) # 得到主表
-        selected_columns = list() # 待选的列
-        selected_columns.append(main_table.c[self.schema.uuid]) # 先选择 uuid 列
-        for field_name in self.schema.keyword_fields: # 再选择所有的 keyword field 对应的列
-            selected_columns.append(main_table.c[field_name])
+    @writer
+    def add_stream(self, documents, chunk_size=10000, max_buffered_postings=1000000, spill_dir=None,
+                   processes=1):
+        """以固定的内存占用导入任意大小的文档流, documents可以是任何iterable, 包括generator
         
-        ### 从主表中选择数据, 构建倒排索引
-        for row in self._SAconn.execute( select(selected_columns) ):
-            dict_row = dict(row) # 将行记录字典化, 这样就可以通过 dict[field_name] 来访问值
+        step 1. 每次从documents中取出chunk_size个文档, 写入主表和全文索引表并提交事务, 
+            所以内存中最多只有一个chunk的文档。
+            
+        step 2. 每个chunk的倒排索引累积在内存中, 当累积的 (keyword, doc_key) 对超过
+            max_buffered_postings时, 按 (单元, keyword) 排序后写入spill_dir中的临时文件。
+            
+        step 3. 所有文档写入之后, 对内存中剩下的部分以及所有的临时文件做多路归并, 每个keyword只
+            与倒排索引表合并一次。 "table"模式下不需要读取-合并-重写, 所以每个chunk直接写入。
+        
+        processes大于1时, 每个chunk的倒排索引由同一个进程池并行制作, 见add_all。
+        
+        与add_all不同, 主表按chunk提交, 倒排索引在最后才完整。 中途出错时已经提交的文档仍然会被
+        加入倒排索引, 然后再抛出异常。 导入之前主表为空时视为批量导入, 二级索引在最后才创建。
+        """
+        st = time.time()
+        bulk_load = self.planner.statistics.document_count == 0
+        if bulk_load:
+            with self._SAconn.begin():
+                self.drop_indexes()
+        
+        buffer = dict() # {keyword_field_name: {keyword: list_of_doc_key}}
+        buffered = 0
+        runs = list() # 已经写入磁盘的, 按 (单元, keyword) 排序的临时文件
+        total = 0
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            for chunk in grouper_list(documents, chunk_size):
+                with self._SAconn.begin():
+                    chunk = self._insert_documents(chunk)
+                    all_inv_dict = self._build_invert_index(chunk, pool, processes)
+                    if self.schema.posting_format == "table":
+                        for field_name, inv_dict in all_inv_dict.items():
+                            self._merge_invert_index(field_name, inv_dict)
+                total += len(chunk)
+                print("\t已经导入了 %s 条数据" % total)
+                
+                if self.schema.posting_format == "table":
+                    self._publish(all_inv_dict)
+                    continue
+                self._publish()
+                for field_name, inv_dict in all_inv_dict.items():
+                    field_buffer = buffer.setdefault(field_name, dict())
+                    for keyword, doc_keys in inv_dict.items():
+                        field_buffer.setdefault(keyword, list()).extend(doc_keys)
+                        buffered += len(doc_keys)
+                if buffered >= max_buffered_postings:
+                    runs.append(self._spill_invert_index(buffer, spill_dir))
+                    buffer, buffered = dict(), 0
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if buffer or runs:
+                print("正在为 %s 归并倒排索引..." % self.keyword_fields)
+                records = heapq.merge(self._iter_invert_index(buffer), 
+                                      *[self._iter_spilled(run) for run in runs], 
+                                      key=lambda record: record[:2])
+                with self._SAconn.begin():
+                    self._merge_sorted_invert_index(records)
+                for run in runs:
+                    run.close()
+                self._publish(clear_postings=True)
+            if bulk_load:
+                with self._SAconn.begin():
+                    self.create_indexes()
+                self._SAconn.execute("PRAGMA optimize")
+        
+        print("\t数据库准备完毕, 可以进行搜索了! 一共耗时 %s 秒" % (time.time() - st,) )
+        
+    @writer
+    def delete(self, uuids):
+        """删除uuid在uuids中的文档, 不存在的uuid被忽略。 返回实际删除的文档数量
+        
+        与add_all一样, 只有这一批文档涉及到的keyword的倒排列表会被读取和重写("table"模式下只删除
+        对应的行), 耗时与主表的大小无关, 整个过程在一个事务中完成。 "segment"模式下segment文件
+        不可修改, 被删除的doc_id被记录为tombstone, 查询时从倒排列表中去掉, 由 Engine.compact 在合并
+        时清理
+        """
+        with self._SAconn.begin():
+            n_deleted, all_inv_dict = self._delete_documents(uuids)
+        if n_deleted:
+            self._publish(all_inv_dict)
+        return n_deleted
+    
+    @writer
+    def upsert(self, documents):
+        """插入或替换文档: uuid已经存在的文档先被删除(见 delete), 再和其他文档一起插入(见 add_all), 
+        两步在同一个事务中完成, 查询不会看到只删除了一半的状态。 返回被替换的文档数量
+        """
+        documents = list(documents)
+        if len(documents) == 0:
+            return 0
+        with self._SAconn.begin():
+            n_replaced, deleted_inv_dict = self._delete_documents(document[self.uuid] for document in documents)
+            documents = self._insert_documents(documents)
+            all_inv_dict = self._build_invert_index(documents)
             for field_name, inv_dict in all_inv_dict.items():
-                uuid = dict_row[self.uuid]
-                for key in dict_row[field_name].split("&"):
-                    if key in inv_dict:
-                        inv_dict[key].add(uuid)
+                self._merge_invert_index(field_name, inv_dict)
+        for field_name, inv_dict in deleted_inv_dict.items(): # 两者涉及到的keyword都需要失效
+            for keyword, doc_keys in inv_dict.items():
+                all_inv_dict[field_name].setdefault(keyword, doc_keys)
+        self._publish(all_inv_dict)
+        return n_replaced
+    
+    def _delete_documents(self, uuids):
+        """在当前事务中从主表, 全文索引表和倒排索引中删除一批文档, 
+        返回 (删除的文档数量, 被删除的文档的倒排索引 {keyword_field_name: {keyword: set_of_doc_key}})
+        """
+        keyword_fields = list(self.keyword_fields)
+        records = list() # [(doc_key, (keyword单元1的值, keyword单元2的值, ...))]
+        sqlcmd = "SELECT {0} FROM {1} WHERE {2} IN ({{0}})".format(
+            ", ".join([self.doc_key] + keyword_fields), self.schema_name, self.uuid)
+        for chunk in grouper_list(list(OrderedDict.fromkeys(uuids)), self.merge_batch_size):
+            for row in self._SAconn.execute(sqlcmd.format(", ".join(["?"] * len(chunk))), tuple(chunk)):
+                records.append((row[0], tuple(row[1:])))
+        if not records:
+            return 0, dict()
+        
+        doc_keys = [record[0] for record in records]
+        for chunk in grouper_list(doc_keys, self.merge_batch_size):
+            self._SAconn.execute("DELETE FROM {0} WHERE {1} IN ({2})".format(
+                self.schema_name, self.doc_key, ", ".join(["?"] * len(chunk))), tuple(chunk))
+        if self.schema.fulltext_fields:
+            ### 全文索引表中的doc_key没有索引, 先把doc_key放进临时表, 这样每个全文索引表只需要扫描一次
+            self._SAconn.execute("CREATE TEMP TABLE IF NOT EXISTS tala_deleted (doc_key PRIMARY KEY)")
+            self._SAconn.execute("DELETE FROM temp.tala_deleted")
+            self._SAconn.execute("INSERT INTO temp.tala_deleted VALUES (?)", [(doc_key,) for doc_key in doc_keys])
+            for field_name in self.schema.fulltext_fields:
+                self._SAconn.execute("DELETE FROM {0} WHERE doc_key IN (SELECT doc_key FROM temp.tala_deleted)".format(
+                    self.schema.fulltext_table(field_name)))
+        
+        all_inv_dict = build_invert_index(keyword_fields, doc_keys, list(zip(*[record[1] for record in records])))
+        if self.schema.posting_format == "segment":
+            self._SAconn.execute("INSERT INTO {0} ({1}) VALUES (?)".format(self.schema.tombstone_table, DOC_ID),
+                                 [(doc_key,) for doc_key in doc_keys])
+        else:
+            for field_name, inv_dict in all_inv_dict.items():
+                self._remove_from_invert_index(field_name, inv_dict)
+        return len(records), all_inv_dict
+    
+    def _insert_documents(self, documents):
+        """把一批文档写入主表和全文索引表, 返回带有doc_key的文档列表
+        """
+        if self.doc_key == DOC_ID: # 预先分配DOC_ID, 这样就不用再从主表中把它们读出来
+            next_doc_id = self._next_doc_id()
+            documents = [dict(document, **{DOC_ID: next_doc_id + i}) \
+                         for i, document in enumerate(documents)]
+        ins = self.tables[self.schema_name].insert()
+        self._SAconn.execute(ins, documents)
+        for field_name in self.schema.fulltext_fields:
+            self._insert_fulltext(field_name, documents)
+        return documents
+    
+    def _iter_invert_index(self, buffer):
+        """按 (单元, keyword) 的顺序遍历内存中的倒排索引, 生成 (单元, keyword, list_of_doc_key)
+        """
+        for field_name in sorted(buffer):
+            field_buffer = buffer[field_name]
+            for keyword in sorted(field_buffer):
+                yield (field_name, keyword, field_buffer[keyword])
+    
+    def _spill_invert_index(self, buffer, spill_dir=None):
+        """把内存中的倒排索引按顺序写入一个临时文件, 返回该文件对象
+        """
+        run = tempfile.TemporaryFile(dir=spill_dir)
+        for record in self._iter_invert_index(buffer):
+            pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        return run
+    
+    def _iter_spilled(self, run):
+        """按顺序读出_spill_invert_index写入的记录
+        """
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+    
+    def _merge_sorted_invert_index(self, records):
+        """把按 (单元, keyword) 排序的 (单元, keyword, list_of_doc_key) 记录合并到倒排索引表中。
+        同一个keyword的记录是相邻的, 所以每次只需要在内存中保留merge_batch_size个keyword
+        """
+        if self.schema.posting_format == "segment":
+            self._write_segments(records)
+            return
+        inv_dict = dict()
+        current_field = None
+        for (field_name, keyword), group in itertools.groupby(records, key=lambda record: record[:2]):
+            if field_name != current_field or len(inv_dict) >= self.merge_batch_size:
+                if inv_dict:
+                    self._merge_invert_index(current_field, inv_dict)
+                inv_dict = dict()
+                current_field = field_name
+            doc_keys = set()
+            for record in group:
+                doc_keys.update(record[2])
+            inv_dict[keyword] = doc_keys
+        if inv_dict:
+            self._merge_invert_index(current_field, inv_dict)
+    
+    def _write_segments(self, records):
+        """把按 (单元, keyword) 排序的 (单元, keyword, list_of_doc_key) 记录写成每个单元一个新的
+        segment文件, 并在当前的事务中登记到Schema.segment_table。 事务回滚时登记也被回滚, 
+        留下的文件不会被读取
+        """
+        if not os.path.isdir(self.segment_dir):
+            os.makedirs(self.segment_dir)
+        typecode = typecode_for(self._next_doc_id())
+        tombstone_seq = self._last_tombstone_seq(self._SAconn) # 新文档不在任何tombstone中
+        writer, current_field = None, None
+        try:
+            for (field_name, keyword), group in itertools.groupby(records, key=lambda record: record[:2]):
+                if writer is not None and field_name != current_field:
+                    self._register_segment(writer, current_field, tombstone_seq)
+                    writer = None
+                if writer is None:
+                    name = "%s-%s.seg" % (field_name, uuid.uuid4().hex)
+                    writer = SegmentWriter(os.path.join(self.segment_dir, name), typecode)
+                    current_field = field_name
+                doc_keys = set()
+                for record in group:
+                    doc_keys.update(record[2])
+                writer.add(keyword, doc_keys)
+            if writer is not None:
+                self._register_segment(writer, current_field, tombstone_seq)
+                writer = None
+        finally:
+            if writer is not None:
+                writer.abort()
+    
+    def _register_segment(self, writer, field_name, tombstone_seq):
+        writer.close()
+        self._SAconn.execute(self.tables[self.schema.segment_table].insert(), 
+                             {"name": os.path.basename(writer.path), "field_name": field_name,
+                              "n_keywords": writer.n_keywords, "n_postings": writer.n_postings,
+                              "tombstone_seq": tombstone_seq})
+    
+    def _last_tombstone_seq(self, connect):
+        """最后一个tombstone的seq。 seq是AUTOINCREMENT的, 所以已经被清理的tombstone也计算在内
+        """
+        row = connect.execute("SELECT seq FROM sqlite_sequence WHERE name = ?",
+                              (self.schema.tombstone_table,)).fetchone()
+        return 0 if row is None else row[0]
+    
+    def _live_segments(self, field_name):
+        """当前查询可见的keyword单元field_name的所有segment
+        """
+        return self._read_segment_state()[0][field_name]
+    
+    def _read_segment_state(self):
+        """当前查询可见的 ({keyword_field_name: [Segment]}, 已删除的doc_id的集合, 最后一个tombstone的seq)。
+        segment表和tombstone表的内容按_generation缓存, 只有写入之后的第一次访问需要读取它们。 
+        每个segment文件只被映射一次
+        """
+        generation = self._read_generation
+        cached = self._segment_snapshot
+        if cached is None or cached[0] != generation:
+            lists = dict((name, list()) for name in self.keyword_fields)
+            sqlcmd = "SELECT name, field_name, tombstone_seq FROM {0} WHERE retired_at IS NULL ORDER BY name".format(
+                self.schema.segment_table)
+            for name, segment_field, tombstone_seq in self._reader.execute(sqlcmd).fetchall():
+                segment = self._segments.get(name)
+                if segment is None:
+                    segment = Segment(os.path.join(self.segment_dir, name))
+                    segment.tombstone_seq = tombstone_seq or 0
+                    self._segments[name] = segment
+                lists[segment_field].append(segment)
+            tombstones = self._new_posting(row[0] for row in self._reader.execute(
+                "SELECT {0} FROM {1}".format(DOC_ID, self.schema.tombstone_table)))
+            cached = (generation, (lists, tombstones, self._last_tombstone_seq(self._reader)))
+            with self._cache_lock:
+                if generation == self._generation:
+                    self._segment_snapshot = cached
+                    ### 不再有效的segment不再需要保持映射, 仍然在使用它们的查询持有自己的引用
+                    live = set(os.path.basename(segment.path) for segments in lists.values() for segment in segments)
+                    for name in list(self._segments):
+                        if name not in live:
+                            self._segments.pop(name, None)
+        return cached[1]
+    
+    def compact(self, full=False):
+        """按 Engine.merge_factor 的策略合并"segment"模式下的segment, 直到没有需要合并的segment为止。 
+        full=True时把每个keyword单元的所有segment合并为一个。 返回合并的次数
+        
+        读取和归并segment文件不需要持有写锁, 所以合并期间写入和查询都不会被阻塞; 只有最后在segment表
+        中用新的segment替换被合并的segment时才需要写锁, 这一步在一个事务中完成
+        
+        合并时去掉已经被删除(见 Engine.delete)的doc_id。 所有有效的segment都不再包含的tombstone
+        在最后被清理, full=True时所有的tombstone都会被清理
+        """
+        if self.schema.posting_format != "segment":
+            raise Exception("ERROR! compact only applies to posting_format='segment'")
+        n_merges = 0
+        with self._compact_lock:
+            for field_name in self.keyword_fields:
+                while True:
+                    with self._reading():
+                        lists, tombstones, tombstone_seq = self._read_segment_state()
+                    segments = list(lists[field_name])
+                    if full:
+                        if len(segments) == 1 and segments[0].tombstone_seq >= tombstone_seq:
+                            segments = []
                     else:
-                        inv_dict[key] = set([uuid])
+                        segments = pick_segments(segments, self.merge_factor)
+                    if not segments:
+                        break
+                    self._merge_segments(field_name, segments, tombstones, tombstone_seq)
+                    n_merges += 1
+                    if full:
+                        break
+            self._remove_retired_segments()
+            self._remove_tombstones()
+        return n_merges
+    
+    def _merge_segments(self, field_name, segments, tombstones, tombstone_seq):
+        """把同一个keyword单元的多个segment归并为一个新的segment, 并在segment表中替换它们
+        """
+        typecode = "Q" if any(segment.typecode == "Q" for segment in segments) else "I"
+        name = "%s-%s.seg" % (field_name, uuid.uuid4().hex)
+        writer = SegmentWriter(os.path.join(self.segment_dir, name), typecode)
+        try:
+            merge_segments(segments, writer, tombstones)
+        except BaseException:
+            writer.abort()
+            raise
+        with self._write_lock:
+            table = self.tables[self.schema.segment_table]
+            with self._SAconn.begin():
+                self._register_segment(writer, field_name, tombstone_seq)
+                self._SAconn.execute(table.update().where(
+                    table.c.name.in_([os.path.basename(segment.path) for segment in segments])),
+                    {"retired_at": time.time()})
+            self._publish()
+    
+    def _remove_retired_segments(self):
+        """删除退役超过 Engine.segment_retention 秒的segment文件以及它们在segment表中的记录
+        """
+        table = self.tables[self.schema.segment_table]
+        deadline = time.time() - self.segment_retention
+        with self._write_lock:
+            names = [row[0] for row in self._SAconn.execute(
+                select([table.c.name]).where(table.c.retired_at < deadline))]
+            if not names:
+                return
+            with self._SAconn.begin():
+                self._SAconn.execute(table.delete().where(table.c.name.in_(names)))
+        for name in names:
+            path = os.path.join(self.segment_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def _remove_tombstones(self):
+        """清理所有有效的segment都不再包含的tombstone。 segment创建时已经去掉了seq不超过它的
+        tombstone_seq的tombstone, doc_id又不会被重新使用, 所以seq不超过所有有效segment的tombstone_seq
+        的tombstone不再被需要
+        """
+        with self._write_lock:
+            oldest, n_segments = self._SAconn.execute(
+                "SELECT MIN(COALESCE(tombstone_seq, 0)), COUNT(*) FROM {0} WHERE retired_at IS NULL".format(
+                    self.schema.segment_table)).fetchone()
+            with self._SAconn.begin():
+                if n_segments == 0:
+                    self._SAconn.execute("DELETE FROM {0}".format(self.schema.tombstone_table))
+                else:
+                    self._SAconn.execute("DELETE FROM {0} WHERE seq <= ?".format(self.schema.tombstone_table),
+                                         (oldest,))
+    
+    def start_compaction(self, interval=1.0, max_failures=5):
+        """启动一个后台线程, 每次写入之后(以及每interval秒)调用一次 Engine.compact()。 
+        需要concurrent=True, 因为合并会在另一个线程中使用写连接
+        
+        合并失败时异常被记录在 Engine.compaction_error 中, 第n次连续失败之后等待 interval * 2**n 秒
+        (期间的写入不会提前唤醒它) 再重试; 连续失败max_failures次之后后台线程停止, 可以在排除问题
+        之后再次调用start_compaction
+        """
+        if self.schema.posting_format != "segment":
+            raise Exception("ERROR! compaction only applies to posting_format='segment'")
+        if not self.concurrent:
+            raise Exception("ERROR! background compaction requires SearchEngine(..., concurrent=True)")
+        if self._compactor is not None:
+            if self._compactor[0].is_alive():
+                return
+            self.stop_compaction() # 因为连续失败而停止了的线程
+        wakeup, stop = threading.Event(), threading.Event()
+        def run():
+            failures = 0
+            while not stop.is_set():
+                if failures:
+                    stop.wait(interval * 2 ** failures)
+                else:
+                    wakeup.wait(interval)
+                wakeup.clear()
+                if stop.is_set():
+                    break
+                try:
+                    self.compact()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    self.compaction_error = e
+                    if failures >= max_failures:
+                        compaction_logger.exception("合并segment连续失败%s次, 停止后台合并", failures)
+                        break
+                    compaction_logger.exception("合并segment失败, %s秒后重试", interval * 2 ** failures)
+        thread = threading.Thread(target=run, name="tala-compaction")
+        thread.daemon = True
+        self._compactor = (thread, wakeup, stop)
+        thread.start()
+    
+    def stop_compaction(self):
+        """停止后台合并线程, 等待正在进行的合并完成
+        """
+        if self._compactor is None:
+            return
+        thread, wakeup, stop = self._compactor
+        self._compactor = None
+        stop.set()
+        wakeup.set()
+        thread.join()
+    
+    def enable_profiling(self, callback=None, slow_query_threshold=None, explain=False, slow_query_log_size=100):
+        """开始剖析之后的每一个查询 (search/search_document/search_arrays/count/facets), 返回 Engine.profiler
+        
+        callback
+            每个查询结束时以该查询的 profiler.QueryProfile 为参数调用, 例如用于把剖析结果发送到
+            监控系统。 search的查询在generator读取完毕或被关闭时才结束
+        
+        slow_query_threshold
+            耗时不少于这么多秒的查询记录在 Engine.profiler.slow_queries 中, 并以WARNING级别写入 
+            logging.getLogger("tala.slow_query")。 默认不记录
+        
+        explain
+            是否记录每条主表SQL语句的 EXPLAIN QUERY PLAN, 它的耗时不计入剖析结果
+        
+        查询的耗时只包括在Engine中花费的时间, 不包括调用者处理search结果的时间。 命中result_cache的
+        count和facets不会被剖析
+        """
+        if self.profiler is not None:
+            self.disable_profiling()
+        self.profiler = Profiler(self, callback=callback, slow_query_threshold=slow_query_threshold,
+                                 explain=explain, slow_query_log_size=slow_query_log_size)
+        self.profiler.install()
+        return self.profiler
+    
+    def disable_profiling(self):
+        """停止剖析, 恢复所有被替换的方法。 已经开始的search会继续被剖析直到结束
+        """
+        if self.profiler is None:
+            return
+        self.profiler.uninstall()
+        self.profiler = None
+    
+    def _insert_fulltext(self, field_name, documents):
+        """把一批文档中单元field_name的文本加入全文索引表
+        """
+        records = [(document[field_name], document[self.doc_key]) for document in documents \
+                   if document.get(field_name) is not None]
+        if records:
+            self._SAconn.execute("INSERT INTO {0} (value, doc_key) VALUES (?, ?)".format(
+                self.schema.fulltext_table(field_name)), records)
+    
+    def create_indexes(self):
+        """创建Schema.indexes中所有尚不存在的二级索引
+        """
+        for sqlcmd in self.schema.create_index_sqls():
+            self._SAconn.execute(sqlcmd)
+            
+    def drop_indexes(self):
+        """删除Schema.indexes中的所有二级索引
+        """
+        for sqlcmd in self.schema.drop_index_sqls():
+            self._SAconn.execute(sqlcmd)
         
-        ### 将制作好的倒排索引中的数据填入对应的表
-        for field_name, inv_dict in all_inv_dict.items():
-            ins = self.schema.tables[field_name].insert()
-            ### 将所有的数据放入列表, 以进行bulk insert
+    def _next_doc_id(self):
+        """下一个可用的DOC_ID。因为主表是AUTOINCREMENT的, 所以同时参考sqlite_sequence, 
+        保证被删除的DOC_ID不会被重新使用
+        """
+        max_doc_id = self._SAconn.execute(
+            "SELECT MAX({0}) FROM {1}".format(DOC_ID, self.schema_name)).scalar() or 0
+        row = self._SAconn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?",
+                                   (self.schema_name,)).fetchone()
+        if row is not None:
+            max_doc_id = max(max_doc_id, row[0])
+        return max_doc_id + 1
+        
+    def _build_invert_index(self, documents, pool=None, processes=1):
+        """为一批文档制作倒排索引, 返回 {keyword_field_name: {keyword: 倒排列表}}。 倒排列表是
+        doc_key的set, 或者(并行制作时)Bitmap
+        
+        pool为multiprocessing.Pool时, 文档被分成 processes * 4 份, 由各个进程分别制作局部的倒排索引。 
+        传给子进程的只有keyword单元的值, 子进程返回文档在这一份中的位置的Bitmap, 本进程用
+        Bitmap.from_parts 把每个keyword的各份一次性 | 合并。 本批文档的DOC_ID是连续分配的 (见 
+        _insert_documents), 所以位置换算成DOC_ID只需要一次平移。 doc_key是uuid时 ("text"模式) 这个换算
+        要逐个取出doc_key, 与串行制作的开销相当, 所以不并行。 子进程不能自己从数据库中读取这些文档, 
+        因为它们在本进程尚未提交的事务中
+        """
+        keyword_fields = list(self.keyword_fields)
+        doc_keys = [document[self.doc_key] for document in documents]
+        columns = [[document.get(field_name) for document in documents] for field_name in keyword_fields]
+        if pool is None or len(doc_keys) < PARALLEL_MIN_DOCUMENTS or self.doc_key != DOC_ID or \
+                doc_keys != list(range(doc_keys[0], doc_keys[0] + len(doc_keys))):
+            return build_invert_index(keyword_fields, doc_keys, columns)
+        
+        n_slices = processes * 4
+        slice_size = (len(doc_keys) + n_slices - 1) // n_slices
+        starts = range(0, len(doc_keys), slice_size)
+        tasks = [(keyword_fields, [column[start:start + slice_size] for column in columns]) for start in starts]
+        all_parts = dict((field_name, dict()) for field_name in keyword_fields) # {field: {keyword: [(start, Bitmap)]}}
+        for start, partial in zip(starts, pool.imap(_build_invert_index_task, tasks)):
+            for field_name, inv_dict in partial.items():
+                parts = all_parts[field_name]
+                for key, posting in inv_dict.items():
+                    parts.setdefault(key, list()).append((start, posting))
+        return dict((field_name, dict((key, Bitmap.from_parts(parts[key], doc_keys[0])) for key in parts))
+                    for field_name, parts in all_parts.items())
+    
+    def _merge_invert_index(self, field_name, inv_dict):
+        """把一批文档的倒排索引合并到倒排索引表中。 只有被涉及到的keyword行会被读取和重写
+        """
+        if self.schema.posting_format == "segment": # 写成一个新的segment文件
+            self._write_segments(self._iter_invert_index({field_name: inv_dict}))
+            return
+        table = self.tables[field_name]
+        posting_column = self.schema.posting_column
+        if self.schema.posting_format == "table": # 只需要追加新的 (keyword, doc_id) 行
+            ins = table.insert().prefix_with("OR IGNORE")
             records = list()
-            for key, value in inv_dict.items():
-                records.append( {"keyword": key, "uuid_set": "&".join(value)} ) 
+            for key, doc_keys in inv_dict.items():
+                for doc_key in doc_keys:
+                    records.append( {"keyword": key, posting_column: doc_key} )
+            if records:
+                self._SAconn.execute(ins, records)
+            return
+        
+        ins = table.insert().prefix_with("OR REPLACE")
+        for keywords in grouper_list(list(inv_dict), self.merge_batch_size):
+            existing = self._existing_postings(field_name, keywords)
+            records = list()
+            for key in keywords:
+                posting = self._new_posting(inv_dict[key])
+                if key in existing:
+                    posting = existing[key] | posting
+                records.append( {"keyword": key, 
+                                 posting_column: self._encode_posting(posting),
+                                 "df": len(posting)} )
             self._SAconn.execute(ins, records) # 存入数据库
         
-        print("\t数据库准备完毕, 可以进行搜索了! 一共耗时 %s 秒" % (time.clock() - st,) )
+    def _existing_postings(self, field_name, keywords):
+        """在写连接上读取一批keyword当前的倒排列表, 返回 {keyword: 倒排列表}, 不包括不存在的keyword
+        """
+        table = self.tables[field_name]
+        existing = dict()
+        for row in self._SAconn.execute(
+                select([table.c.keyword, table.c[self.schema.posting_column]]).where(table.c.keyword.in_(keywords))):
+            existing[row[0]] = self._decode_posting(row[1])
+        return existing
+    
+    def _remove_from_invert_index(self, field_name, inv_dict):
+        """_merge_invert_index的逆运算: 从倒排索引表中去掉一批被删除的文档的doc_key。 只有被涉及到的
+        keyword行会被读取和重写, 变为空的keyword行被删除。 "segment"模式下segment文件不可修改, 
+        由Engine.delete记录tombstone
+        """
+        table = self.tables[field_name]
+        posting_column = self.schema.posting_column
+        if self.schema.posting_format == "table":
+            records = [(key, doc_key) for key, doc_keys in inv_dict.items() for doc_key in doc_keys]
+            if records:
+                self._SAconn.execute("DELETE FROM {0} WHERE keyword = ? AND {1} = ?".format(
+                    field_name, posting_column), records)
+            return
+        
+        ins = table.insert().prefix_with("OR REPLACE")
+        for keywords in grouper_list(list(inv_dict), self.merge_batch_size):
+            existing = self._existing_postings(field_name, keywords)
+            records, emptied = list(), list()
+            for key in keywords:
+                if key not in existing:
+                    continue
+                posting = existing[key] - self._new_posting(inv_dict[key])
+                if posting:
+                    records.append( {"keyword": key, 
+                                     posting_column: self._encode_posting(posting),
+                                     "df": len(posting)} )
+                else:
+                    emptied.append(key)
+            if records:
+                self._SAconn.execute(ins, records)
+            if emptied:
+                self._SAconn.execute(table.delete().where(table.c.keyword.in_(emptied)))
+        
+    def _encode_posting(self, doc_keys):
+        """把一组doc_key编码为倒排索引表中储存的值
+        """
+        if self.schema.posting_format == "text":
+            return "&".join(doc_keys)
+        else:
+            return encode_posting(doc_keys)
+        
+    def _decode_posting(self, value):
+        """_encode_posting的逆运算, "text"模式下返回set, "bitmap"模式下返回Bitmap。
+        两者都支持 & | - 运算, 所以下游的代码不需要区分
+        """
+        if self.schema.posting_format != "bitmap":
+            if value:
+                return set(value.split("&"))
+            else:
+                return set()
+        else:
+            return decode_posting(value)
         
+    def _new_posting(self, doc_keys):
+        """由一组doc_key创建与_decode_posting同类型的集合。 "segment"模式下也是Bitmap
+        """
+        if isinstance(doc_keys, Bitmap):
+            return doc_keys
+        if self.schema.posting_format not in ("bitmap", "segment"):
+            return set(doc_keys)
+        else:
+            return Bitmap.from_ids(doc_keys)
+        
+    def _publish(self, all_inv_dict=None, clear_postings=False):
+        """在写入的事务提交之后调用: 增加_generation, 并从posting_caches中移除被修改过的keyword
+        (clear_postings=True时移除全部)的倒排列表。 两者在_cache_lock中一起完成, 见_get_keyword_posting
+        """
+        with self._cache_lock:
+            self._generation += 1
+            if self._compactor is not None:
+                self._compactor[1].set()
+            if self._postings is not None:
+                if clear_postings:
+                    self._postings = self._load_postings()
+                elif all_inv_dict:
+                    for field_name, inv_dict in all_inv_dict.items():
+                        postings = self._postings[field_name]
+                        for keyword in inv_dict:
+                            postings[keyword] = self._freeze_posting(self._read_keyword_posting(field_name, keyword))
+            if clear_postings:
+                for cache in self.posting_caches.values():
+                    cache.clear()
+            elif all_inv_dict:
+                for field_name, inv_dict in all_inv_dict.items():
+                    cache = self.posting_caches.get(field_name)
+                    if cache is not None:
+                        for keyword in inv_dict:
+                            cache.pop(keyword)
+    
+    def _get_keyword_posting(self, field_name, keyword):
+        """读取一个keyword的倒排列表, 优先从posting_caches中读取。keyword不存在时返回空集合。 
+        返回的集合可能被缓存共享, 调用者不能修改它
+        """
+        if self._postings is not None:
+            posting = self._postings[field_name].get(keyword)
+            return self._empty_posting if posting is None else posting
+        cache = self.posting_caches.get(field_name)
+        if cache is None:
+            return self._read_keyword_posting(field_name, keyword)
+        posting = cache.get(keyword)
+        if posting is None:
+            posting = self._read_keyword_posting(field_name, keyword)
+            ### 并发模式下, 查询开始之后有新的写入提交时, 读到的可能是旧的倒排列表, 不能放入缓存
+            size = estimate_size(posting)
+            with self._cache_lock:
+                if self._read_generation == self._generation:
+                    cache.set(keyword, posting, size)
+        return posting
+    
+    def _read_keyword_posting(self, field_name, keyword):
+        """从倒排索引表中读取并解码一个keyword的倒排列表
+        """
+        if self.schema.posting_format == "segment": # 同一个keyword在各个segment中的倒排列表的并集
+            lists, tombstones, _ = self._read_segment_state()
+            posting = Bitmap()
+            for segment in lists[field_name]:
+                posting = posting | Bitmap.from_array(segment.posting(keyword))
+            if tombstones:
+                posting = posting - tombstones
+            return posting
+        sqlcmd = "SELECT {0} FROM {1} WHERE keyword = ?".format(self.schema.posting_column, field_name)
+        if self.schema.posting_format == "table": # 每一行是一个doc_id
+            return set(row[0] for row in self._reader.execute(sqlcmd, (keyword,)))
+        row = self._reader.execute(sqlcmd, (keyword,)).fetchone()
+        if row is None:
+            return self._decode_posting(None)
+        return self._decode_posting(row[0])
+    
+    def _iter_keyword_postings(self, field_name):
+        """遍历keyword单元field_name的所有 (keyword, 倒排列表)
+        """
+        if self._postings is not None:
+            return iter(list(self._postings[field_name].items()))
+        return self._read_all_keyword_postings(field_name)
+    
+    def _read_all_keyword_postings(self, field_name):
+        """从倒排索引表中读取并解码keyword单元field_name的所有倒排列表
+        """
+        if self.schema.posting_format == "segment":
+            lists, tombstones, _ = self._read_segment_state()
+            all_postings = dict()
+            for segment in lists[field_name]:
+                for keyword, posting in segment.items():
+                    posting = Bitmap.from_array(posting)
+                    if keyword in all_postings:
+                        all_postings[keyword] = all_postings[keyword] | posting
+                    else:
+                        all_postings[keyword] = posting
+            for keyword, posting in all_postings.items():
+                if tombstones:
+                    posting = posting - tombstones
+                if posting:
+                    yield keyword, posting
+            return
+        if self.schema.posting_format == "table":
+            sqlcmd = "SELECT keyword, {0} FROM {1} ORDER BY keyword".format(self.schema.posting_column, field_name)
+            for keyword, rows in itertools.groupby(self._reader.execute(sqlcmd), key=lambda row: row[0]):
+                yield keyword, set(row[1] for row in rows)
+            return
+        sqlcmd = "SELECT keyword, {0} FROM {1}".format(self.schema.posting_column, field_name)
+        for keyword, value in self._reader.execute(sqlcmd):
+            yield keyword, self._decode_posting(value)
+    
+    def _freeze_posting(self, posting):
+        """把倒排列表转换为常驻内存的紧凑形式, 见 Engine._postings
+        """
+        if self.schema.posting_format in ("bitmap", "segment"):
+            return posting
+        if self.schema.posting_format == "text": # 所有倒排列表共享同一个uuid字符串对象
+            return frozenset(sys.intern(doc_key) for doc_key in posting)
+        return frozenset(posting)
+    
+    @property
+    def _empty_posting(self):
+        return self._freeze_posting(self._new_posting(()))
+    
+    def _load_postings(self):
+        """读取并解码所有keyword单元的所有倒排列表, 返回 {keyword_field_name: {keyword: 倒排列表}}
+        """
+        all_postings = dict()
+        for field_name in self.keyword_fields:
+            all_postings[field_name] = dict((keyword, self._freeze_posting(posting)) \
+                                            for keyword, posting in self._read_all_keyword_postings(field_name))
+        return all_postings
+    
+    def _get_keyword_frequencies(self, field_name, keywords):
+        """返回 {keyword: 文档频率df}, 不存在的keyword的df为0。 只读取df, 不读取倒排列表本身
+        """
+        frequencies = dict.fromkeys(keywords, 0)
+        if self.schema.posting_format == "segment": # 只读取segment中的posting_offsets, 包括尚未清理的tombstone
+            for segment in self._live_segments(field_name):
+                for keyword in keywords:
+                    frequencies[keyword] += segment.df(keyword)
+        elif self.schema.posting_format == "table":
+            sqlcmd = "SELECT COUNT(*) FROM {0} WHERE keyword = ?".format(field_name)
+            for keyword in keywords:
+                frequencies[keyword] = self._reader.execute(sqlcmd, (keyword,)).fetchone()[0]
+        else:
+            for chunk in grouper_list(keywords, self.merge_batch_size):
+                sqlcmd = "SELECT keyword, df FROM {0} WHERE keyword IN ({1})".format(
+                    field_name, ", ".join(["?"] * len(chunk)))
+                for keyword, df in self._reader.execute(sqlcmd, chunk):
+                    frequencies[keyword] = df
+        return frequencies
+    
+    def _intersect_keyword_postings(self, keyword_terms):
+        """按QueryPlan.keyword_terms的顺序(df升序)对倒排列表求交集, 交集为空时立刻停止
+        """
+        result_set = None
+        for term in keyword_terms:
+            posting = self._get_keyword_posting(term[0], term[1])
+            if result_set is None:
+                result_set = posting
+            else:
+                result_set = result_set & posting
+            if not result_set:
+                break
+        return result_set
+        
+    def _candidate_set(self, plan):
+        """候选文档的doc_key集合: 按df升序对QueryPlan.keyword_terms求交集, 再依次与
+        QueryPlan.set_criterions中的布尔表达式求交集(顶层为NOT时求差集), 结果为空时立刻停止
+        """
+        result_set = None
+        if plan.keyword_terms:
+            result_set = self._intersect_keyword_postings(plan.keyword_terms)
+            if not result_set:
+                return result_set
+        memo = dict() # 同一个查询中相同的子表达式只求值一次
+        for criterion in plan.set_criterions:
+            if isinstance(criterion, QueryNot):
+                if result_set is None:
+                    result_set = self._all_doc_keys(memo)
+                result_set = result_set - self._evaluate(criterion.children[0], memo)
+            else:
+                posting = self._evaluate(criterion, memo)
+                result_set = posting if result_set is None else result_set & posting
+            if not result_set:
+                break
+        return result_set
+    
+    def _is_sql(self, criterion):
+        if isinstance(criterion, BooleanCriterion):
+            return criterion.compiles_to_sql(self.schema)
+        return criterion.issql
+    
+    def _all_doc_keys(self, memo):
+        """主表中所有文档的doc_key, 作为NOT的全集
+        """
+        if None not in memo:
+            sqlcmd = "SELECT {0} FROM {1}".format(self.doc_key, self.schema_name)
+            memo[None] = self._new_posting(row[0] for row in self._execute(sqlcmd))
+        return memo[None]
+    
+    def _evaluate(self, criterion, memo):
+        """对一个criterion或布尔表达式求值, 返回满足它的文档的doc_key集合。 
+        memo为 {criterion的规范形式: 结果}, 使不同分支中重复的子表达式只被计算一次
+        """
+        key = criterion.normalized()
+        if key in memo:
+            return memo[key]
+        
+        if self._is_sql(criterion): # 一条SQL语句
+            sqlcmd, params = self._compile_select(Query(self.schema), [self.doc_key], [criterion])
+            result_set = self._new_posting(row[0] for row in self._execute(sqlcmd, params))
+        
+        elif isinstance(criterion, QueryContains):
+            keywords = sorted(criterion.subset)
+            frequencies = self.planner.statistics.keyword_frequencies(criterion.field_name, keywords)
+            keywords.sort(key=lambda keyword: frequencies[keyword])
+            result_set = self._intersect_keyword_postings([(criterion.field_name, keyword) for keyword in keywords])
+            if result_set is None: # 没有任何keyword的query_contains对所有文档都成立
+                result_set = self._all_doc_keys(memo)
+        
+        elif isinstance(criterion, QueryNot):
+            result_set = self._all_doc_keys(memo) - self._evaluate(criterion.children[0], memo)
+        
+        else: # QueryAnd, QueryOr: 所有可以编译成SQL的子表达式合并为一条SQL语句
+            sql_children = [child for child in criterion.children if self._is_sql(child)]
+            children = [child for child in criterion.children if not self._is_sql(child)]
+            if len(sql_children) == 1:
+                children.insert(0, sql_children[0])
+            elif len(sql_children) > 1:
+                children.insert(0, criterion.__class__(*sql_children))
+            
+            result_set = None
+            if isinstance(criterion, QueryAnd):
+                negatives = [child.children[0] for child in children if isinstance(child, QueryNot)]
+                for child in children:
+                    if not isinstance(child, QueryNot):
+                        posting = self._evaluate(child, memo)
+                        result_set = posting if result_set is None else result_set & posting
+                        if not result_set:
+                            break
+                if result_set is None:
+                    result_set = self._all_doc_keys(memo)
+                for child in negatives:
+                    if not result_set:
+                        break
+                    result_set = result_set - self._evaluate(child, memo)
+            else:
+                for child in children:
+                    posting = self._evaluate(child, memo)
+                    result_set = posting if result_set is None else result_set | posting
+        
+        memo[key] = result_set
+        return result_set
+    
+    def _compile_select(self, query, columns, sql_criterions, keyword_terms=(),
+                        ordering=None, search_after=None, limit=None):
+        """生成 SELECT columns FROM 主表 WHERE ... [ORDER BY ...] [LIMIT ?] 的参数化SQL语句, 
+        返回 (sqlcmd, params)。 SQL语句只取决于查询的形状, 所以被缓存在 Engine._statement_cache 中
+        """
+        shape = (tuple(columns), 
+                 tuple(criterion.shape(self.schema) for criterion in sql_criterions),
+                 tuple(term[0] for term in keyword_terms),
+                 None if ordering is None else (ordering.order_clause(), ordering.keyset_shape(search_after)),
+                 limit is None)
+        sqlcmd = self._statement_cache.get(shape)
+        if sqlcmd is None:
+            sqlcmd, params = query.create_select_sql(columns, sql_criterions, keyword_terms)
+            if search_after is not None:
+                keyset_clause, _ = ordering.keyset_clause(search_after)
+                if sql_criterions or keyword_terms:
+                    sqlcmd += "\n\tAND " + keyset_clause
+                else:
+                    sqlcmd += "WHERE\t" + keyset_clause
+            if ordering is not None:
+                sqlcmd += "\nORDER BY\t" + ordering.order_clause()
+            if limit is not None:
+                sqlcmd += "\nLIMIT\t?"
+            self._statement_cache.set(shape, sqlcmd)
+        params = query.create_where_params(sql_criterions, keyword_terms)
+        if search_after is not None:
+            params.extend(ordering.keyset_clause(search_after)[1])
+        if limit is not None:
+            params.append(limit)
+        return sqlcmd, params
+    
+    def _get_rows(self, doc_keys, where_clause=None, where_params=(), columns=None):
+        """根据一组doc_key从主表中批量取出数据, 以流的方式返回row
+        
+        每 Engine.fetch_batch_size 个doc_key合并为一条 WHERE doc_key IN (...) 查询, 最后一批不足
+        的部分用NULL补齐, 这样所有的批次都是同一条SQL语句, 可以复用sqlite3缓存的prepared statement。
+        doc_key在排序后再分批, 使得每一批在主键B树上的访问尽量连续。
+        
+        给定where_clause (以及它的绑定值where_params) 时, 主表条件在探测的同时被检查, 只返回同时
+        满足条件的行。 columns默认为所有的单元。
+        """
+        if columns is None:
+            columns = self.fields
+        batch_size = self.fetch_batch_size
+        sqlcmd = "SELECT {0} FROM {1} WHERE {2} IN ({3})".format(", ".join(columns),
+                                                              self.schema_name,
+                                                              self.doc_key,
+                                                              ", ".join(["?"] * batch_size))
+        if where_clause:
+            sqlcmd += "\n\tAND " + where_clause
+        where_params = list(where_params)
+        for chunk in grouper(sorted(doc_keys), batch_size):
+            cursor = self._execute(sqlcmd, list(chunk) + where_params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        
+    ### ==================== 并发模式下读连接的借出与归还 ====================
+    @property
+    def _reader(self):
+        """当前查询所使用的读连接。 非并发模式下, 或者不在查询之中时, 为Engine.connect
+        """
+        reader = getattr(self._local, "reader", None)
+        return self.connect if reader is None else reader[0]
+    
+    def _execute(self, sqlcmd, params=()):
+        """查询主表的SQL语句都经过这里执行, 剖析时被 Profiler 替换以计时, 见 tala/profiler.py
+        """
+        return self._reader.execute(sqlcmd, params)
+    
+    @property
+    def _read_generation(self):
+        """当前查询开始时的_generation
+        """
+        reader = getattr(self._local, "reader", None)
+        return self._generation if reader is None else reader[1]
+    
+    def _checkout(self):
+        """从pool中借出一个连接。 先记录_generation再开始读事务, 所以读到的数据不会比记录的更旧
+        """
+        generation = self._generation
+        return (self.pool.acquire(), generation)
+    
+    def _bind(self, reader):
+        """把reader设为当前线程正在使用的读连接, 返回之前的读连接
+        """
+        previous = getattr(self._local, "reader", None)
+        self._local.reader = reader
+        return previous
+    
+    @contextmanager
+    def _reading(self):
+        """在with语句中的所有读操作使用同一个借出的连接。 非并发模式, 或者已经在一个查询之中时
+        什么都不做
+        """
+        if self.pool is None or getattr(self._local, "reader", None) is not None:
+            yield
+            return
+        reader = self._checkout()
+        self._bind(reader)
+        try:
+            yield
+        finally:
+            self._bind(None)
+            self.pool.release(reader[0])
+    
+    def _read_rows(self, rows, reader=None):
+        """包装search的generator: 借出一个连接, 每次从rows中取下一个结果时都把该连接设为当前线程的
+        读连接, 交出结果之前再恢复原来的值。 所以同一个线程中交替读取的多个search各自使用自己的连接。
+        
+        调用者也可以传入一个已经借出的reader, 此时由调用者负责归还
+        """
+        owner = reader is None
+        if owner:
+            reader = self._checkout()
+        try:
+            while True:
+                previous = self._bind(reader)
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    self._bind(previous)
+                yield row
+        finally:
+            previous = self._bind(reader)
+            try:
+                rows.close()
+            finally:
+                self._bind(previous)
+                if owner:
+                    self.pool.release(reader[0])
+    
     def create_query(self):
         """生成一个Query对象, 并把引擎所绑定的Schema传给Query
         使得Query能够自行找到Schema中的各个Fields
         """
         return Query(self.schema)
                    
-    def search(self, query):
-        """根据query进行单元搜索, 返回row
+    def search(self, query, order_by=None, limit=None, search_after=None, descending=False, fields=None):
+        """根据query进行单元搜索, 返回row的generator
+        
+        执行顺序由 Engine.planner 根据统计信息决定, 见 tala/planner.py
+        
+        order_by
+            按该单元排序, 以uuid作为第二排序键。 默认不排序, 结果的顺序不确定
+        
+        descending
+            是否降序排列
+        
+        limit
+            最多返回多少个结果
+        
+        search_after
+            keyset分页的游标, 上一页最后一个结果的 (order_by的值, uuid), 见 Ordering。 翻到很深的
+            页数时, 代价不会随着页数增加
+        
+        fields
+            只返回这些单元, row中的值按fields的顺序排列。 默认返回所有的单元。 SQL语句只读取需要的列, 
+            所以不读取大的Unsearchable_OBJECT单元时, 也不需要从磁盘读取它们的blob
+            
+        Unsearchable_OBJECT单元的值以 fields.LazyObject 返回, 访问 .value 时才会反序列化
         """
-        main_sqlcmd, main_sqlcmd_select_all, keyword_sqlcmd_list = query.create_sql()
-
-        ### 情况1, 主表和倒排索引表都要被查询
-        if (len(keyword_sqlcmd_list) >= 1) and ("WHERE" in main_sqlcmd):
-            # 得到查询主表所筛选出的 result_uuid_set
-            result_uuid_set = {row[0] for row in self.cursor.execute(main_sqlcmd) }
-            # 得到使用倒排索引所筛选出的 keyword_uuid_set
-            keyword_uuid_set = set.intersection(
-                *[set( self.cursor.execute(sqlcmd).fetchone()[0].split("&") ) \
-                  for sqlcmd in keyword_sqlcmd_list] )
-            # 对两者求交集
-            result_uuid_set.intersection_update(keyword_uuid_set)
-            # 根据结果中的uuid, 去主表中取数据
-            for uuid in result_uuid_set:
-                row = self.cursor.execute("SELECT * FROM {0} WHERE {1} = {2}".format(self.schema_name,
-                                                                                     self.uuid,
-                                                                                     repr(uuid),) ).fetchone()
+        rows = self._search_rows(query, order_by, limit, search_after, descending, fields)
+        if self.pool is None:
+            return rows
+        return self._read_rows(rows)
+    
+    def _search_rows(self, query, order_by, limit, search_after, descending, fields=None):
+        columns, n_output = self._projection(fields, order_by)
+        if order_by is None:
+            if search_after is not None:
+                raise Exception("search_after can only be used together with order_by!")
+            ordering = None
+        else:
+            ordering = Ordering(self.schema, order_by, descending, columns)
+        
+        if self.result_cache is not None:
+            key = self._result_cache_key("search", query, order_by, limit, 
+                                         None if search_after is None else ordering._normalize(search_after),
+                                         descending, None if fields is None else tuple(fields))
+            rows = self.result_cache.get(key)
+            if rows is not None:
+                for row in rows:
+                    yield row
+                return
+        
+        rows = self._search(query, ordering, limit, search_after, columns)
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+        rows = self._project(rows, columns, n_output)
+        
+        if self.result_cache is None:
+            for row in rows:
+                yield row
+        else:
+            ### 边输出边收集结果, 只有结果被完整读取, 并且没有超出缓存的容量时才放入缓存
+            collected = list()
+            size = 0
+            for row in rows:
+                if collected is not None:
+                    collected.append(row)
+                    size += estimate_size(row)
+                    if size > self.result_cache.maxsize:
+                        collected = None
                 yield row
+            if collected is not None:
+                self.result_cache.set(key, collected, size)
+    
+    def _projection(self, fields, order_by=None):
+        """返回 (查询需要读取的列, 其中前多少列是输出给调用者的)。 排序需要的order_by和uuid列
+        如果不在fields中, 会被附加在最后, 输出之前再去掉
+        """
+        if fields is None:
+            return list(self.fields), len(self.fields)
+        columns = list(fields)
+        for field_name in columns:
+            if field_name not in self.fields:
+                raise Exception("ERROR! fields have to be in %s, yours is %r" % (list(self.fields), field_name))
+        n_output = len(columns)
+        if order_by is not None:
+            for field_name in (order_by, self.uuid):
+                if field_name not in columns:
+                    columns.append(field_name)
+        return columns, n_output
+    
+    def _project(self, rows, columns, n_output):
+        """去掉只为了排序而读取的列, 并把Unsearchable_OBJECT单元的blob包装为LazyObject
+        """
+        object_positions = [i for i, field_name in enumerate(columns[:n_output]) if self.fields[field_name].is_object]
+        if not object_positions:
+            if n_output == len(columns):
+                return rows
+            return (row[:n_output] for row in rows)
+        return (self._wrap_objects(row, n_output, object_positions) for row in rows)
+    
+    def _wrap_objects(self, row, n_output, object_positions):
+        row = list(row[:n_output])
+        for i in object_positions:
+            if row[i] is not None:
+                row[i] = LazyObject(row[i])
+        return tuple(row)
+    
+    def _result_cache_key(self, kind, query, *args):
+        """结果缓存的键。 写入之后第一次访问时清空整个缓存; 键中也包含_generation, 
+        这样在写入之前开始, 写入之后才结束的查询不会把过期的结果放进缓存
+        """
+        if self._result_cache_generation != self._generation:
+            self.result_cache.clear()
+            self._result_cache_generation = self._generation
+        return (self._generation, kind, query.normalized()) + args
+    
+    def _cached(self, key, func):
+        """从结果缓存中取出key对应的值, 不存在时调用func计算并放入缓存
+        """
+        value = self.result_cache.get(key)
+        if value is None:
+            value = func()
+            self.result_cache.set(key, value)
+        return value
+    
+    def _search(self, query, ordering, limit, search_after, columns=None):
+        if columns is None:
+            columns = list(self.fields)
+        plan = self.planner.plan(query)
+        if plan.is_empty: # 某个keyword不存在, 结果必然为空
+            return
         
-        ### 情况2, 只对倒排索引表查询
-        elif (len(keyword_sqlcmd_list) >= 1) and ("WHERE" not in main_sqlcmd):
-            keyword_uuid_set = set.intersection(
-                *[set( self.cursor.execute(sqlcmd).fetchone()[0].split("&") ) \
-                  for sqlcmd in keyword_sqlcmd_list] )
-            for uuid in keyword_uuid_set:
-                row = self.cursor.execute("SELECT * FROM {0} WHERE {1} = {2}".format(self.schema_name,
-                                                                                     self.uuid,
-                                                                                     repr(uuid),) ).fetchone()
+        ### 情况4, 空查询
+        if plan.is_unconstrained():
+            return
+        
+        ### "table"模式下, 整个查询被编译成一条SQL语句, 由SQLite自行规划执行 (包括排序和LIMIT)
+        if self.schema.posting_format == "table":
+            sqlcmd, params = self._compile_select(query, columns, plan.sql_criterions, plan.keyword_terms,
+                                                  ordering, search_after, limit)
+            for row in self._execute(sqlcmd, params):
                 yield row
+            return
         
-        ### 情况3, 只对主表查询
-        elif (len(keyword_sqlcmd_list) == 0) and ("WHERE" in main_sqlcmd):
-            for row in self.cursor.execute(main_sqlcmd_select_all):
+        ### 情况3, 只对主表查询, 排序在有索引时由索引完成
+        if not plan.uses_postings():
+            sqlcmd, params = self._compile_select(query, columns, plan.sql_criterions, (),
+                                                  ordering, search_after, limit)
+            for row in self._execute(sqlcmd, params):
                 yield row
+            return
         
-        ### 情况4, 空查询
+        # 从最小的倒排列表开始求交集, 再对布尔表达式求值, 得到候选的 keyword_set
+        keyword_set = self._candidate_set(plan)
+        if not keyword_set:
+            return
+        
+        if ordering is not None:
+            rows = self._search_ordered(query, plan, keyword_set, ordering, limit, search_after, columns)
+        
+        ### 情况2, 只对倒排索引表查询
+        elif len(plan.sql_criterions) == 0:
+            rows = self._get_rows(keyword_set, columns=columns)
+        
+        ### 情况1, 主表和倒排索引表都要被查询
+        ### 1a. 候选集合较小, 直接按doc_key探测主表, 同时检查主表条件
+        elif plan.should_probe(len(keyword_set)):
+            where_clause, where_params = query.create_where_clause(plan.sql_criterions)
+            rows = self._get_rows(keyword_set, where_clause, where_params, columns)
+        
+        ### 1b. 候选集合较大, 用WHERE查询主表得到 result_set, 求交集之后再按doc_key取数据
         else:
-            pass
+            sqlcmd, params = self._compile_select(query, [self.doc_key], plan.sql_criterions)
+            result_set = self._new_posting(row[0] for row in self._execute(sqlcmd, params))
+            rows = self._get_rows(result_set & keyword_set, columns=columns)
+        
+        for row in rows:
+            yield row
+    
+    def _search_ordered(self, query, plan, keyword_set, ordering, limit, search_after, columns):
+        """对倒排索引求交集之后的候选文档排序, 有两种做法:
+        
+        1. 候选文档很多且排序的单元有索引时, 沿着索引按顺序扫描主表, 只输出在候选集合中的行, 
+        凑够limit个就停止。
+        2. 否则按doc_key探测候选文档(同时检查主表条件和search_after), 用大小为limit的堆选出前limit个。
+        """
+        if plan.should_scan_ordered(len(keyword_set), limit) and \
+                (ordering.order_by in self.planner.statistics.indexed_columns()):
+            n_fields = len(columns)
+            columns = list(columns)
+            if self.doc_key not in columns:
+                columns.append(self.doc_key)
+            key_position = columns.index(self.doc_key)
+            candidates = set(keyword_set)
+            sqlcmd, params = self._compile_select(query, columns, plan.sql_criterions, (),
+                                                  ordering, search_after)
+            def ordered_scan():
+                for row in self._execute(sqlcmd, params):
+                    if row[key_position] in candidates:
+                        yield row[:n_fields]
+            return ordered_scan()
+        
+        where_clause, where_params = query.create_where_clause(plan.sql_criterions)
+        if search_after is not None:
+            keyset_clause, keyset_params = ordering.keyset_clause(search_after)
+            where_clause = "\n\tAND ".join([clause for clause in [where_clause, keyset_clause] if clause])
+            where_params = where_params + keyset_params
+        return ordering.top(self._get_rows(keyword_set, where_clause, where_params, columns), limit)
+    
+    def _result_set(self, query, plan):
+        """返回满足query的所有文档的doc_key集合 (set或Bitmap), 不读取主表中的其他列。 
+        用于只需要统计数量, 不需要文档内容的场合
+        """
+        if not plan.uses_postings():
+            sqlcmd, params = self._compile_select(query, [self.doc_key], plan.sql_criterions)
+            return self._new_posting(row[0] for row in self._execute(sqlcmd, params))
+        
+        keyword_set = self._candidate_set(plan)
+        if (not keyword_set) or (len(plan.sql_criterions) == 0):
+            return keyword_set
+        
+        if plan.should_probe(len(keyword_set)):
+            where_clause, where_params = query.create_where_clause(plan.sql_criterions)
+            return self._new_posting(row[0] for row in self._get_rows(
+                keyword_set, where_clause, where_params, columns=[self.doc_key]))
+        
+        sqlcmd, params = self._compile_select(query, [self.doc_key], plan.sql_criterions)
+        return self._new_posting(row[0] for row in self._execute(sqlcmd, params)) & keyword_set
+        
+    def count(self, query):
+        """返回满足query的文档数量, 与 len(list(Engine.search(query))) 相同, 但是不读取任何文档。
+        只涉及倒排索引时直接数倒排列表交集的大小; 只涉及主表时使用 SELECT COUNT(*)
+        """
+        with self._reading():
+            if self.result_cache is not None:
+                return self._cached(self._result_cache_key("count", query), lambda: self._count(query))
+            return self._count(query)
     
-    def search_document(self, query):
+    def _count(self, query):
+        plan = self.planner.plan(query)
+        if plan.is_empty or plan.is_unconstrained():
+            return 0
+        
+        if self.schema.posting_format == "table" or not plan.uses_postings():
+            sqlcmd, params = self._compile_select(query, ["COUNT(*)"], plan.sql_criterions, plan.keyword_terms)
+            return self._execute(sqlcmd, params).fetchone()[0]
+        
+        return len(self._result_set(query, plan))
+    
+    def facets(self, query, field_name):
+        """对满足query的文档, 统计keyword单元field_name中每一个keyword出现的次数, 例如每一种
+        genres各有多少个结果。 返回按次数降序排列的 OrderedDict({keyword: count}), 不包括次数为0的keyword
+        
+        计数由倒排列表与结果集合求交集得到 ("table"模式下由一条GROUP BY语句得到), 不读取任何文档
+        """
+        if field_name not in self.keyword_fields:
+            raise Exception("ERROR! field_name has to be in %s, yours is %s" % (self.keyword_fields, 
+                                                                                field_name))
+        with self._reading():
+            if self.result_cache is not None:
+                return OrderedDict(self._cached(self._result_cache_key("facets", query, field_name), 
+                                                lambda: self._facets(query, field_name)))
+            return self._facets(query, field_name)
+    
+    def _facets(self, query, field_name):
+        plan = self.planner.plan(query)
+        counts = list()
+        if plan.is_empty or plan.is_unconstrained():
+            pass
+        
+        elif self.schema.posting_format == "table":
+            subquery, params = self._compile_select(query, [self.doc_key], plan.sql_criterions, plan.keyword_terms)
+            sqlcmd = "SELECT keyword, COUNT(*) FROM {0} WHERE {1} IN ({2}) GROUP BY keyword".format(
+                field_name, self.schema.posting_column, subquery)
+            counts = self._execute(sqlcmd, params).fetchall()
+        
+        else:
+            result_set = self._result_set(query, plan)
+            if result_set:
+                for keyword, posting in self._iter_keyword_postings(field_name):
+                    counts.append((keyword, len(posting & result_set)))
+        
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        return OrderedDict((keyword, count) for keyword, count in counts if count)
+        
+    def search_document(self, query, order_by=None, limit=None, search_after=None, descending=False,
+                        fields=None):
         """根据query进行单元搜索, 返回 document = dict({field_name: field_value})
+        参数的含义与 search 相同, document中只包含fields中的单元
+        """
+        keys = list(self.fields) if fields is None else list(fields)
+        for row in self.search(query, order_by=order_by, limit=limit, 
+                               search_after=search_after, descending=descending, fields=fields):
+            yield OrderedDict(zip(keys, row))
+        
+    def search_arrays(self, query, fields, order_by=None, limit=None, search_after=None, descending=False):
+        """根据query进行单元搜索, 按列返回结果: OrderedDict({field_name: numpy数组}), 
+        数组的dtype由 Field.numpy_dtype 决定, 见 tala/arrays.py。 其他参数的含义与 search 相同
+        
+        结果每 Engine.fetch_batch_size 行为一批, 每一批的每一列直接转换为numpy数组, 不会为每一行
+        创建dict。 需要安装numpy
         """
-        document = OrderedDict()
-        for row in self.search(query):
-            for key, value in zip(self.fields, row):
-                document[key] = value
-            yield document
+        require_numpy()
+        fields = list(fields)
+        builders = [ColumnBuilder(self.fields[field_name].numpy_dtype) for field_name in self._projection(fields)[0]]
+        rows = self.search(query, order_by=order_by, limit=limit, search_after=search_after, 
+                           descending=descending, fields=fields)
+        while True:
+            batch = list(itertools.islice(rows, self.fetch_batch_size))
+            if not batch:
+                break
+            for builder, column in zip(builders, zip(*batch)):
+                builder.append(column)
+        return OrderedDict((field_name, builder.to_array()) for field_name, builder in zip(fields, builders))
         
     ### ==================== 下面的函数用于打印帮助信息 ====================
     def display_searchable_fields(self):
@@ -378,6 +2270,9 @@ class SearchEngine():
         print("\t%s" % query.query_endwith.__name__)
         print("\t%s" % query.query_like.__name__)
         print("\t%s" % query.query_contains.__name__)
+        print("\t%s" % query.query_and.__name__)
+        print("\t%s" % query.query_or.__name__)
+        print("\t%s" % query.query_not.__name__)
     
     def display_keyword_fields(self):
         """打印所有支持倒排索引的单元名和具体类定义"""
@@ -392,7 +2287,8 @@ class SearchEngine():
         根据field_name得到该field下所有出现过的keyword
         """
         if field_name in self.keyword_fields:
-            all_keywords = [row[0] for row in self.cursor.execute("SELECT keyword FROM %s" % field_name)]
+            with self._reading():
+                all_keywords = [row[0] for row in self._reader.execute("SELECT DISTINCT keyword FROM %s" % field_name)]
             return all_keywords
         else:
             raise Exception("ERROR! field_name has to be in %s, yours is %s" % (self.keyword_fields, 
@@ -440,8 +2336,9 @@ def create_search_engine(database, schema):
 
 
 if __name__ == "__main__":
-    from fields import *
+    from .fields import *
     from datetime import date
+    import shutil
     
     def unittest_criterion():
         q = QueryGreater("value", 10)
@@ -494,4 +2391,247 @@ if __name__ == "__main__":
             print("\n{:=^100}".format("keyword_sqlcmd"))
             print(sqlcmd)
             
-#     unittest_Query()
\ No newline at end of file
+#     unittest_Query()
+
+    GENRES = ["Drama", "Comedy", "Short"]
+    
+    def movie(i):
+        """第i部电影: i是2的倍数时为Drama, 3的倍数时为Comedy, 4的倍数时为Short
+        """
+        return {"movie_id": str(i), "title": "Movie %s" % i, "year": 1950 + i % 50,
+                "genres": "&".join(GENRES[j] for j in range(3) if i % (j + 2) == 0)}
+    
+    def movie_ids(rows):
+        return set(row[0] for row in rows)
+    
+    def movie_schema(posting_format="text", fulltext=False):
+        return Schema("movie",
+            Field("movie_id", Searchable_UUID, primary_key=True),
+            Field("title", Searchable_TEXT, fulltext=fulltext),
+            Field("year", Searchable_INTEGER),
+            Field("genres", Searchable_KEYWORD),
+            posting_format=posting_format,
+            )
+    
+    def movie_engine(directory, posting_format="text", n=200, fulltext=False, **kwargs):
+        """在directory中创建一个有n部电影的SearchEngine, 用于下面的测试
+        """
+        engine = SearchEngine(os.path.join(directory, "movie_%s.db" % posting_format),
+                              movie_schema(posting_format, fulltext), **kwargs)
+        engine.add_all([movie(i) for i in range(n)])
+        return engine
+    
+    def unittest_search_after():
+        """用list作为search_after按keyset翻页(升序和降序), 开启结果缓存时结果与不缓存时相同
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            for posting_format in POSTING_FORMATS:
+                engine = movie_engine(directory, posting_format, result_cache_size=10 ** 6)
+                query = engine.create_query()
+                query.add(query.query_contains("genres", "Drama"))
+                for descending in (False, True):
+                    expected = sorted(engine.search(query), key=lambda row: (row[2], row[0]), reverse=descending)
+                    for _ in range(2): # 第二次全部命中缓存
+                        pages, cursor = list(), None
+                        while True:
+                            page = list(engine.search(query, order_by="year", limit=7, search_after=cursor,
+                                                      descending=descending))
+                            if not page:
+                                break
+                            pages.extend(page)
+                            cursor = [page[-1][2], page[-1][0]]
+                        assert pages == expected, (posting_format, descending)
+        finally:
+            shutil.rmtree(directory)
+        
+    def unittest_empty_contains():
+        """没有keyword的query_contains在创建时就报错, 而不是在"table"模式下生成不合法的SQL
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            engine = movie_engine(directory, "table")
+            query = engine.create_query()
+            try:
+                query.query_or(query.query_contains("genres"), query.query_contains("genres", "Short"))
+            except Exception as e:
+                assert "at least one keyword" in str(e)
+            else:
+                raise AssertionError("empty query_contains was accepted")
+            query.add(query.query_or(query.query_contains("genres", "Drama"), query.query_contains("genres", "Short")))
+            assert engine.count(query) == len([i for i in range(200) if i % 2 == 0 or i % 4 == 0])
+        finally:
+            shutil.rmtree(directory)
+        
+    def unittest_compaction_errors():
+        """后台合并失败时记录日志和 Engine.compaction_error, 连续失败max_failures次之后停止
+        """
+        class Records(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = list()
+            def emit(self, record):
+                self.records.append(record)
+        handler = Records()
+        compaction_logger.addHandler(handler)
+        directory = tempfile.mkdtemp()
+        try:
+            engine = movie_engine(directory, "segment", concurrent=True)
+            def compact():
+                raise IOError("disk full")
+            engine.compact = compact
+            engine.start_compaction(interval=0.01, max_failures=3)
+            engine._compactor[0].join(10)
+            assert not engine._compactor[0].is_alive()
+            assert isinstance(engine.compaction_error, IOError)
+            assert len(handler.records) == 3 and all(record.exc_info for record in handler.records)
+            del engine.compact # 排除问题之后可以重新启动
+            engine.start_compaction(interval=0.01)
+            assert engine._compactor[0].is_alive()
+            engine.stop_compaction()
+        finally:
+            compaction_logger.removeHandler(handler)
+            shutil.rmtree(directory)
+        
+    def unittest_cache_invalidation():
+        """写入之后result_cache中的结果失效, posting_caches中只有被修改过的keyword失效
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            for posting_format in POSTING_FORMATS:
+                engine = movie_engine(directory, posting_format, result_cache_size=10 ** 6)
+                drama, short = engine.create_query(), engine.create_query()
+                drama.add(drama.query_contains("genres", "Drama"))
+                short.add(short.query_contains("genres", "Short"))
+                for query in (drama, short):
+                    list(engine.search(query))
+                assert engine.count(drama) == 100
+                hits = engine.result_cache.hits
+                assert engine.count(drama) == 100 and engine.result_cache.hits == hits + 1
+                ### "table"模式下query_contains直接由SQL求值, 不读取倒排列表
+                cache = engine.posting_caches["genres"] if posting_format != "table" else None
+                assert cache is None or ("Drama" in cache and "Short" in cache)
+                
+                engine.add_all([movie(i) for i in (201, 203, 205, 206)]) # 只有206是Drama, 没有Short
+                assert cache is None or ("Drama" not in cache and "Short" in cache)
+                assert engine.count(drama) == 101
+                assert movie_ids(engine.search(drama)) == set(str(i) for i in list(range(0, 200, 2)) + [206])
+                
+                assert engine.delete(["0", "2", "201"]) == 3
+                assert cache is None or ("Drama" not in cache and "Short" not in cache)
+                assert engine.count(drama) == 99
+                assert engine.count(short) == 49
+        finally:
+            shutil.rmtree(directory)
+    
+    def unittest_boolean_not():
+        """NOT包括单元的值为空的文档, 与AND, OR, 以及主表条件组合时结果正确
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            for posting_format in POSTING_FORMATS:
+                engine = movie_engine(directory, posting_format)
+                def check(expected, *criterions):
+                    query = engine.create_query()
+                    for criterion in criterions:
+                        query.add(criterion)
+                    assert movie_ids(engine.search(query)) == set(str(i) for i in range(200) if expected(i)), \
+                        (posting_format, [str(criterion) for criterion in criterions])
+                    assert engine.count(query) == len([i for i in range(200) if expected(i)])
+                q = engine.create_query()
+                check(lambda i: i % 4 != 0,
+                      q.query_not(q.query_contains("genres", "Short")))
+                check(lambda i: i % 2 == 0 and i % 4 != 0,
+                      q.query_contains("genres", "Drama"), q.query_not(q.query_contains("genres", "Short")))
+                check(lambda i: i % 3 == 0 or i % 2 != 0,
+                      q.query_or(q.query_contains("genres", "Comedy"), q.query_not(q.query_contains("genres", "Drama"))))
+                check(lambda i: i % 2 != 0 and i % 3 != 0 and 1960 <= 1950 + i % 50 <= 1970,
+                      q.query_not(q.query_or(q.query_contains("genres", "Drama"), q.query_contains("genres", "Comedy"))),
+                      q.query_between("year", 1960, 1970))
+                check(lambda i: i % 2 != 0 or i % 3 != 0,
+                      q.query_not(q.query_contains("genres", "Drama", "Comedy")))
+        finally:
+            shutil.rmtree(directory)
+    
+    def unittest_segment_compaction():
+        """删除的文档被记录为tombstone, 合并之后从segment中去掉, tombstone被清理
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            engine = movie_engine(directory, "segment", n=0, merge_factor=2)
+            for start in range(0, 200, 50): # 每次写入生成一个新的segment
+                engine.add_all([movie(i) for i in range(start, start + 50)])
+            engine.delete([str(i) for i in range(0, 200, 8)])
+            count_rows = lambda sqlcmd: engine.connect.execute(sqlcmd).fetchone()[0]
+            live_segments = "SELECT COUNT(*) FROM %s WHERE retired_at IS NULL" % engine.schema.segment_table
+            tombstones = "SELECT COUNT(*) FROM %s" % engine.schema.tombstone_table
+            assert count_rows(live_segments) == 4 and count_rows(tombstones) == 25
+            
+            query = engine.create_query()
+            query.add(query.query_contains("genres", "Drama"))
+            expected = set(str(i) for i in range(0, 200, 2) if i % 8 != 0)
+            assert movie_ids(engine.search(query)) == expected
+            
+            assert engine.compact() > 0
+            assert count_rows(live_segments) == 1
+            assert movie_ids(engine.search(query)) == expected
+            engine.compact(full=True)
+            assert count_rows(tombstones) == 0
+            lists, _, _ = engine._read_segment_state()
+            assert set(lists["genres"][0].posting("Drama")) == set(int(doc_id) + 1 for doc_id in expected)
+            assert movie_ids(engine.search(query)) == expected
+        finally:
+            shutil.rmtree(directory)
+    
+    def unittest_in_memory_snapshot():
+        """in_memory=True时写入只在内存中, snapshot之后才能从磁盘上读到
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            for posting_format in ("text", "bitmap", "table"):
+                engine = movie_engine(directory, posting_format, in_memory=True)
+                assert not os.path.exists(engine.database)
+                engine.snapshot()
+                engine.add_all([movie(i) for i in range(200, 210)])
+                query = engine.create_query()
+                query.add(query.query_contains("genres", "Drama"))
+                assert engine.count(query) == 105
+                
+                on_disk = SearchEngine(engine.database, movie_schema(posting_format))
+                assert on_disk.count(query) == 100
+                engine.snapshot(os.path.join(directory, "copy.db"))
+                copy = SearchEngine(os.path.join(directory, "copy.db"), movie_schema(posting_format), in_memory=True)
+                assert movie_ids(copy.search(query)) == movie_ids(engine.search(query))
+                os.remove(os.path.join(directory, "copy.db"))
+        finally:
+            shutil.rmtree(directory)
+    
+    def unittest_migration():
+        """打开旧版本创建的数据库: 补上倒排索引表的df列, 为新加的全文索引填充已有的文档
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            for posting_format in ("text", "bitmap", "table"):
+                engine = movie_engine(directory, posting_format)
+                if posting_format != "table":
+                    engine._SAconn.execute("ALTER TABLE genres DROP COLUMN df") # 旧版本没有df列
+                del engine
+                
+                engine = SearchEngine(os.path.join(directory, "movie_%s.db" % posting_format),
+                                      movie_schema(posting_format, fulltext=True))
+                frequencies = engine.planner.statistics.keyword_frequencies("genres", GENRES + ["Western"])
+                assert frequencies == {"Drama": 100, "Comedy": 67, "Short": 50, "Western": 0}
+                query = engine.create_query()
+                query.add(query.query_like("title", "ie 12"))
+                assert movie_ids(engine.search(query)) == set(["12"] + [str(i) for i in range(120, 130)])
+        finally:
+            shutil.rmtree(directory)
+        
+    unittest_search_after()
+    unittest_empty_contains()
+    unittest_compaction_errors()
+    unittest_cache_invalidation()
+    unittest_boolean_not()
+    unittest_segment_compaction()
+    unittest_in_memory_snapshot()
+    unittest_migration()
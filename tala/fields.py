@@ -2,8 +2,20 @@
 
 from __future__ import print_function
 from sqlalchemy import Table, Column, MetaData
-from sqlalchemy import Integer, REAL, TEXT, DateTime, Date, PickleType
+from sqlalchemy import Integer, REAL, TEXT, DateTime, Date, PickleType, LargeBinary
 from collections import OrderedDict
+import pickle
+
+### posting_format = "text"时, 倒排索引表以 "&" 连接的uuid字符串储存倒排列表
+### posting_format = "bitmap"时, 主表多出一个稠密整数id列DOC_ID, 倒排列表以压缩位图的blob储存
+### posting_format = "table"时, 倒排索引表的每一行是一个 (keyword, doc_id) 对, 整个查询可以编译成一条SQL
+### posting_format = "segment"时, 倒排列表储存在数据库之外的只读segment文件中, 通过mmap读取, 见 tala/segment.py
+POSTING_FORMATS = ("text", "bitmap", "table", "segment")
+DOC_ID = "_doc_id"
+
+### 具有这些可搜索数据类型的单元会被自动建立B树索引, 以支持 =, >=, <=, BETWEEN 查询
+INDEXED_SEARCHABLE_TYPES = ("Searchable_ID", "Searchable_INTEGER", "Searchable_REAL",
+                            "Searchable_DATE", "Searchable_DATETIME")
 
 class SEARCHABLE_TYPE():
     def __repr__(self):
@@ -14,48 +26,56 @@ class _Searchable_UUID(SEARCHABLE_TYPE):
     name = "Searchable_UUID"
     sqlite_dtype = TEXT
     sqlite_dtype_name = "TEXT"
+    numpy_dtype = "O"
     
 class _Searchable_ID(SEARCHABLE_TYPE):
     """字符串精确匹配"""
     name = "Searchable_ID"
     sqlite_dtype = TEXT
     sqlite_dtype_name = "TEXT"
+    numpy_dtype = "O"
     
 class _Searchable_TEXT(SEARCHABLE_TYPE):
     """模糊字符串匹配"""
     name = "Searchable_TEXT"
     sqlite_dtype = TEXT
     sqlite_dtype_name = "TEXT"
+    numpy_dtype = "O"
     
 class _Searchable_KEYWORD(SEARCHABLE_TYPE):
     """字符串集合匹配"""
     name = "Searchable_KEYWORD"
     sqlite_dtype = TEXT
     sqlite_dtype_name = "TEXT"
+    numpy_dtype = "O"
     
 class _Searchable_DATE(SEARCHABLE_TYPE):
     """日期逻辑匹配"""
     name = "Searchable_DATE"
     sqlite_dtype = Date
     sqlite_dtype_name = "Date"
+    numpy_dtype = "datetime64[D]"
     
 class _Searchable_DATETIME(SEARCHABLE_TYPE):
     """日期时间逻辑匹配"""
     name = "Searchable_DATETIME"
     sqlite_dtype = DateTime
     sqlite_dtype_name = "DateTime"
+    numpy_dtype = "datetime64[us]"
     
 class _Searchable_INTEGER(SEARCHABLE_TYPE):
     """整数逻辑匹配"""
     name = "Searchable_INTEGER"
     sqlite_dtype = Integer
     sqlite_dtype_name = "Integer"
+    numpy_dtype = "int64"
     
 class _Searchable_REAL(SEARCHABLE_TYPE):
     """实数逻辑匹配"""
     name = "Searchable_REAL"
     sqlite_dtype = REAL
     sqlite_dtype_name = "REAL"
+    numpy_dtype = "float64"
     
 
 class _Unsearchable_OBJECT(SEARCHABLE_TYPE):
@@ -63,6 +83,40 @@ class _Unsearchable_OBJECT(SEARCHABLE_TYPE):
     name = "Unsearchable_OBJECT"
     sqlite_dtype = PickleType
     sqlite_dtype_name = "PickleType"
+    numpy_dtype = "O"
+
+class LazyObject(object):
+    """search返回的Unsearchable_OBJECT单元的值。 数据库中储存的是pickle之后的blob, 
+    只有在第一次访问 LazyObject.value 时才会被反序列化, 所以只列出部分单元的查询不需要为大对象付出代价
+    """
+    __slots__ = ("blob", "_value", "_loaded")
+    
+    def __init__(self, blob):
+        self.blob = blob
+        self._value = None
+        self._loaded = False
+    
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = pickle.loads(self.blob)
+            self._loaded = True
+        return self._value
+    
+    def __eq__(self, other):
+        if isinstance(other, LazyObject):
+            return self.blob == other.blob
+        return self.value == other
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        if self._loaded:
+            return "LazyObject(%r)" % (self._value,)
+        return "LazyObject(<%s bytes>)" % len(self.blob)
 
 Searchable_UUID = _Searchable_UUID()
 Searchable_ID = _Searchable_ID()
@@ -84,7 +138,8 @@ class Field():
     """Field可能有多种SEARCHABLE_TYPE, 但是只能有一种sqlite_dtype
     所以必须保证Field.search_types的sqlite_dtype都相同。
     """
-    def __init__(self, field_name, *list_of_searchable_type, primary_key=False, nullable=True):
+    def __init__(self, field_name, *list_of_searchable_type, primary_key=False, nullable=True, index=None,
+                 fulltext=False):
         """
         Field.field_name
             string type, 单元名称, 对应数据表中的column_name 
@@ -97,18 +152,50 @@ class Field():
         
         Field.nullable
             boolean type, 该列是否允许为NULL
+        
+        Field.index
+            boolean type, 是否为该列建立B树索引。 默认为None, 即search_types中包含
+            INDEXED_SEARCHABLE_TYPES中的任何一种时自动建立索引
+        
+        Field.fulltext
+            boolean type, 是否为该列建立FTS5 trigram全文索引, 只对Searchable_TEXT有效。 
+            QueryLike, QueryStartwith, QueryEndwith会自动通过全文索引执行
         """
         self.field_name = field_name
         self.search_types = {searchable_type.name: searchable_type for searchable_type in list_of_searchable_type}
         self.primary_key = primary_key
         self.nullable = nullable
+        if index is None:
+            index = any(name in self.search_types for name in INDEXED_SEARCHABLE_TYPES)
+        self.index = index
+        self.fulltext = fulltext
         
         self.self_validate()
     
+    @property
+    def sqlite_dtype_name(self):
+        """该单元在数据库中的数据类型, 由self_validate保证所有的search_types都相同
+        """
+        for searchable_type in self.search_types.values():
+            return searchable_type.sqlite_dtype_name
+    
+    @property
+    def numpy_dtype(self):
+        """search_arrays返回该单元时使用的numpy dtype
+        """
+        for searchable_type in self.search_types.values():
+            return searchable_type.numpy_dtype
+    
+    @property
+    def is_object(self):
+        return "Unsearchable_OBJECT" in self.search_types
+    
     def self_validate(self):
         sqlite_dtype_set = {searchable_type.sqlite_dtype_name for searchable_type in self.search_types.values()}
         if len(sqlite_dtype_set) != 1:
             raise Exception("%s have different sqlite dtype!" % list(self.search_types.keys()))
+        if self.fulltext and ("Searchable_TEXT" not in self.search_types):
+            raise Exception("fulltext index can only be applied to Searchable_TEXT field!")
         
     def __str__(self):
         return "Field(field_name='%s', search_types=%s, primary_key=%s, nullable=%s)" % (self.field_name,
@@ -132,11 +219,14 @@ class Schema():
     """
     有且只有一个Field的search_types中包含Searchable_ID, 而且该Field必须是PRIMARY KEY
     """
-    def __init__(self, schema_name, *Fields):
+    def __init__(self, schema_name, *Fields, posting_format="text", composite_indexes=()):
         """
         Schema.schema_name 
             string type, 储存主表的名称
             
+        Schema.posting_format
+            string type, 倒排列表的储存方式, 见 POSTING_FORMATS
+            
         Schema.fields
             OrderedDict type, 储存 {Field名称: Field对象} 的字典
             
@@ -146,6 +236,29 @@ class Schema():
         Schema.keyword_fields
             list type, 储存关键字类的 单元/列 的名称
             
+        Schema.doc_key
+            string type, 倒排列表中用来指代文档的列名。"text"模式下为uuid, 其他模式下为DOC_ID
+            
+        Schema.posting_column
+            string type, 倒排索引表中储存倒排列表的列名。"table"模式下为储存单个doc_id的列名,
+            "segment"模式下没有倒排索引表, 为None
+            
+        Schema.segment_table
+            string type, "segment"模式下登记所有有效的segment文件的表的名称, 其他模式下为None
+            
+        Schema.tombstone_table
+            string type, "segment"模式下记录已经删除, 但是仍然存在于segment文件中的doc_id的表的名称, 
+            其他模式下为None
+            
+        Schema.indexes
+            OrderedDict type, 储存主表上的二级索引 {索引名称: [列名]}。 包括每一个 Field.index 为True
+            的单元上的单列索引, 以及composite_indexes中声明的多列索引, 例如
+            composite_indexes=[("year", "rating")]。 这些索引不会在建表时创建, 而是由
+            SearchEngine在批量导入数据之后再创建, 见 SearchEngine.create_indexes
+            
+        Schema.fulltext_fields
+            list type, 储存建立了全文索引的 单元/列 的名称, 全文索引表的名称见 Schema.fulltext_table
+            
         Schema.tables
             dict type, 储存 {Table名称: Table对象}
             
@@ -154,6 +267,7 @@ class Schema():
         """
         # get self.schema_name
         self.schema_name = schema_name
+        self.posting_format = posting_format
         # get self.fields
         self.fields = OrderedDict()
         for field in Fields: # OrderedDict({field.name: field object})
@@ -166,6 +280,36 @@ class Schema():
                 self.uuid = field.field_name
             if "Searchable_KEYWORD" in field.search_types:
                 self.keyword_fields.append(field.field_name)
+        # get self.doc_key and self.posting_column
+        if self.posting_format == "text":
+            self.doc_key = self.uuid
+            self.posting_column = "uuid_set"
+        elif self.posting_format == "table":
+            self.doc_key = DOC_ID
+            self.posting_column = "doc_id"
+        elif self.posting_format == "segment":
+            self.doc_key = DOC_ID
+            self.posting_column = None
+        else:
+            self.doc_key = DOC_ID
+            self.posting_column = "postings"
+                
+        if self.posting_format == "segment":
+            self.segment_table = "%s_segments" % self.schema_name
+            self.tombstone_table = "%s_tombstones" % self.schema_name
+        else:
+            self.segment_table = None
+            self.tombstone_table = None
+        
+        # get self.indexes
+        self.indexes = OrderedDict()
+        for field in self.fields.values():
+            if field.index and not field.primary_key:
+                self.indexes["ix_%s_%s" % (self.schema_name, field.field_name)] = [field.field_name]
+        for columns in composite_indexes:
+            self.indexes["ix_%s_%s" % (self.schema_name, "_".join(columns))] = list(columns)
+        # get self.fulltext_fields
+        self.fulltext_fields = [field.field_name for field in self.fields.values() if field.fulltext]
                 
         self._create_all_tables()
         self.self_validate()
@@ -178,30 +322,73 @@ class Schema():
         for field in self.fields.values():
             for searchable_type in field.search_types.values():
                 break
-            column = Column(field.field_name, # column.name = field.name
-                            searchable_type.sqlite_dtype, # column.dtype =
-                            primary_key=field.primary_key, # column.primary_key = field.primary_key
-                            nullable=field.nullable) # column.nullable = field.nullable
+            if self.doc_key == DOC_ID and field.primary_key:
+                ### DOC_ID成为主键, 原主键降级为唯一索引
+                column = Column(field.field_name,
+                                searchable_type.sqlite_dtype,
+                                unique=True,
+                                nullable=False)
+            else:
+                column = Column(field.field_name, # column.name = field.name
+                                searchable_type.sqlite_dtype, # column.dtype =
+                                primary_key=field.primary_key, # column.primary_key = field.primary_key
+                                nullable=field.nullable) # column.nullable = field.nullable
             all_columns.append(column)
+        if self.doc_key == DOC_ID:
+            ### INTEGER PRIMARY KEY是rowid的别名, 在VACUUM时也不会改变, 可以安全的被倒排列表引用
+            all_columns.append(Column(DOC_ID, Integer, primary_key=True))
         return all_columns
     
     def _create_all_tables(self):
         """创建Schema中所要用到的表。以 {Table.name: Table} 的形式存储在 self.tables中
         1. 存储文档数据的主表
         2. 若干个针对Field.search_types中包含Searchable_KEYWORD所涉及的倒排索引表
+           ("segment"模式下为一个登记segment文件的表)
         """
         metadata = MetaData()
         self.tables = dict()
         # 创建主表
         all_columns = self._create_SqlAlchemy_columns()
-        self.tables[self.schema_name] = Table(self.schema_name, metadata, *all_columns )
+        ### sqlite_autoincrement保证被删除的DOC_ID不会被重新分配
+        self.tables[self.schema_name] = Table(self.schema_name, metadata, *all_columns,
+                                              sqlite_autoincrement=(self.doc_key == DOC_ID))
+        
+        if self.posting_format == "segment": # 倒排列表在segment文件中, 这里只记录有哪些文件
+            self.tables[self.segment_table] = Table(self.segment_table, metadata,
+                Column("name", TEXT, primary_key=True),
+                Column("field_name", TEXT),
+                Column("n_keywords", Integer),
+                Column("n_postings", Integer),
+                Column("retired_at", REAL), # 被合并之后退役的时间, 为NULL的是有效的segment
+                Column("tombstone_seq", Integer), # 创建时已经从segment中去掉的最后一个tombstone的seq
+                )
+            ### seq只增不减, 不会被重新使用, 见 SearchEngine.compact
+            self.tables[self.tombstone_table] = Table(self.tombstone_table, metadata,
+                Column("seq", Integer, primary_key=True),
+                Column(DOC_ID, Integer),
+                sqlite_autoincrement=True,
+                )
         
         # 为KEYWORD属性的列创建索引表
         for field_name in self.keyword_fields:
-            self.tables[field_name] = Table(field_name, metadata,
-                Column("keyword", TEXT, primary_key=True),
-                Column("uuid_set", TEXT),
-                )
+            if self.posting_format == "segment":
+                break
+            if self.posting_format == "table":
+                ### 联合主键 (keyword, doc_id) 自带索引, 按keyword查询doc_id只需要扫描索引
+                self.tables[field_name] = Table(field_name, metadata,
+                    Column("keyword", TEXT, primary_key=True),
+                    Column(self.posting_column, Integer, primary_key=True, autoincrement=False),
+                    )
+            else:
+                if self.posting_format == "text":
+                    posting_dtype = TEXT
+                else:
+                    posting_dtype = LargeBinary
+                self.tables[field_name] = Table(field_name, metadata,
+                    Column("keyword", TEXT, primary_key=True),
+                    Column(self.posting_column, posting_dtype),
+                    Column("df", Integer), # 文档频率, 用于查询规划
+                    )
         
         self.metadata = metadata
 
@@ -210,6 +397,44 @@ class Schema():
         """
         if not self.uuid:
             raise Exception("One and only one Fields can have only one Searchable_UUID!")
+        for index_name, columns in self.indexes.items():
+            for column in columns:
+                if column not in self.fields:
+                    raise Exception("index %s refers to unknown field %r!" % (index_name, column))
+        if self.posting_format not in POSTING_FORMATS:
+            raise Exception("posting_format has to be one of %s, yours is %r" % (POSTING_FORMATS,
+                                                                                self.posting_format))
+        
+    def create_index_sqls(self):
+        """返回创建所有二级索引的SQL语句
+        """
+        return ["CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(index_name, 
+                                                                   self.schema_name, 
+                                                                   ", ".join(columns)) \
+                for index_name, columns in self.indexes.items()]
+    
+    def drop_index_sqls(self):
+        """返回删除所有二级索引的SQL语句
+        """
+        return ["DROP INDEX IF EXISTS {0}".format(index_name) for index_name in self.indexes]
+        
+    def fulltext_table(self, field_name):
+        """单元field_name的全文索引表的名称
+        """
+        return "%s_%s_fts" % (self.schema_name, field_name)
+    
+    def create_fulltext_sqls(self):
+        """返回创建所有全文索引表的SQL语句。 全文索引表有两列: 被索引的文本value, 以及不被索引的doc_key
+        """
+        return ["CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5(value, doc_key UNINDEXED, tokenize='trigram')".format(
+                    self.fulltext_table(field_name)) for field_name in self.fulltext_fields]
+    
+    def populate_fulltext_sql(self, field_name):
+        """返回用主表中已有的数据填充单元field_name的全文索引表的SQL语句, 用于在已有数据的数据库上
+        新建全文索引
+        """
+        return "INSERT INTO {0} (value, doc_key) SELECT {1}, {2} FROM {3} WHERE {1} IS NOT NULL".format(
+            self.fulltext_table(field_name), field_name, self.doc_key, self.schema_name)
         
     def displayFields(self):
         pass
@@ -0,0 +1,304 @@
+##encoding=utf8
+
+"""
+基于选择度(selectivity)的查询规划。
+
+SearchEngine在执行一个Query之前, 先由QueryPlanner根据统计信息生成一个QueryPlan:
+
+1. 每个keyword的文档频率(document frequency, df)来自倒排索引表的df列 ("table"模式下为COUNT(*))。
+   任何一个keyword的df为0时, 整个查询的结果必然为空, 无需再访问任何表。
+2. keyword按df升序求交集, 从最小的倒排列表开始, 交集为空时立刻停止, 不再读取剩下的(往往很大的)倒排列表。
+3. 主表criterion按照估计的选择度排序, 最有筛选力的条件放在WHERE的最前面。
+4. 得到候选文档集合之后, 比较 "按doc_key逐批探测主表" 和 "用WHERE扫描主表再求交集" 两种做法的
+   估计代价, 选择较小的一种。
+
+所有的统计信息都按 SearchEngine._generation 缓存, 每次写入之后自动失效。
+"""
+
+from __future__ import print_function
+
+### 没有统计信息可用时使用的默认选择度
+DEFAULT_EQUAL_SELECTIVITY = 0.01
+DEFAULT_RANGE_SELECTIVITY = 1.0 / 3
+DEFAULT_PATTERN_SELECTIVITY = 0.1
+
+### 通过主键探测一行的代价, 相当于顺序扫描多少行
+PROBE_COST = 4
+
+class Statistics(object):
+    """主表和倒排索引表的统计信息, 全部惰性计算并缓存, engine写入数据后失效
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self._generation = None
+        self._cache = dict()
+
+    def _current(self, generation):
+        """持有engine._cache_lock时调用: engine写入之后清空缓存, 返回缓存是否属于generation
+        """
+        if self._generation != self.engine._generation:
+            self._cache.clear()
+            self._generation = self.engine._generation
+        return generation == self._generation
+
+    def _cached(self, key, func):
+        """并发模式下查询读的是自己开始时的快照(Engine._read_generation), 查询开始之后有新的写入
+        提交时, 算出的统计信息是旧的, 只返回给这个查询, 不放入缓存。 与 Engine._get_keyword_posting 相同
+        """
+        engine = self.engine
+        generation = engine._read_generation
+        with engine._cache_lock:
+            if self._current(generation) and key in self._cache:
+                return self._cache[key]
+        value = func()
+        with engine._cache_lock:
+            if self._current(generation):
+                self._cache[key] = value
+        return value
+
+    def _scalar(self, sqlcmd, params=()):
+        return self.engine._reader.execute(sqlcmd, params).fetchone()[0]
+
+    @property
+    def document_count(self):
+        return self._cached(("count",), lambda: self._scalar(
+            "SELECT COUNT(*) FROM {0}".format(self.engine.schema_name)))
+
+    def indexed_columns(self):
+        """主表中作为某个索引的第一列的列名集合, 以及建立了全文索引的列名, 这些列上的条件不需要全表扫描
+        """
+        def compute():
+            columns = {self.engine.doc_key}
+            columns.update(self.engine.schema.fulltext_fields)
+            cursor = self.engine._reader
+            for row in cursor.execute("PRAGMA index_list({0})".format(self.engine.schema_name)).fetchall():
+                index_info = cursor.execute("PRAGMA index_info({0})".format(row[1])).fetchall()
+                for seqno, cid, column_name in index_info:
+                    if seqno == 0:
+                        columns.add(column_name)
+            return columns
+        return self._cached(("indexed",), compute)
+
+    def column_range(self, field_name):
+        """(最小值, 最大值), 只对数值列有意义; 其他情况返回None
+        """
+        def compute():
+            low, high = self.engine._reader.execute("SELECT MIN({0}), MAX({0}) FROM {1}".format(
+                field_name, self.engine.schema_name)).fetchone()
+            if isinstance(low, (int, float)) and isinstance(high, (int, float)):
+                return low, high
+            return None
+        return self._cached(("range", field_name), compute)
+
+    def distinct_count(self, field_name):
+        return self._cached(("distinct", field_name), lambda: self._scalar(
+            "SELECT COUNT(DISTINCT {0}) FROM {1}".format(field_name, self.engine.schema_name)))
+
+    def keyword_frequencies(self, field_name, keywords):
+        """返回 {keyword: df}, 不存在的keyword的df为0
+        """
+        engine = self.engine
+        generation = engine._read_generation
+        result = dict()
+        missing = list()
+        with engine._cache_lock:
+            current = self._current(generation)
+            for keyword in keywords:
+                key = ("df", field_name, keyword)
+                if current and key in self._cache:
+                    result[keyword] = self._cache[key]
+                else:
+                    missing.append(keyword)
+        if missing:
+            frequencies = engine._get_keyword_frequencies(field_name, missing)
+            result.update(frequencies)
+            with engine._cache_lock:
+                if self._current(generation):
+                    for keyword, df in frequencies.items():
+                        self._cache[("df", field_name, keyword)] = df
+        return result
+
+    ### ==================== 选择度估计, 由各个criterion的selectivity方法调用 ====================
+    def equal_selectivity(self, field_name):
+        if field_name == self.engine.uuid:
+            return 1.0 / max(self.document_count, 1)
+        if field_name not in self.indexed_columns(): # 避免为了规划而对未索引的列做一次全表扫描
+            return DEFAULT_EQUAL_SELECTIVITY
+        return 1.0 / max(self.distinct_count(field_name), 1)
+
+    def range_selectivity(self, field_name, lowerbound, upperbound):
+        column_range = self.column_range(field_name)
+        if column_range is None:
+            return DEFAULT_RANGE_SELECTIVITY
+        low, high = column_range
+        try:
+            if lowerbound is not None:
+                low = max(low, lowerbound)
+            if upperbound is not None:
+                high = min(high, upperbound)
+        except TypeError: # 与数值列比较的不是数值
+            return DEFAULT_RANGE_SELECTIVITY
+        if high < low:
+            return 0.0
+        if column_range[1] == column_range[0]:
+            return 1.0
+        return float(high - low) / (column_range[1] - column_range[0])
+
+    def pattern_selectivity(self, field_name):
+        return DEFAULT_PATTERN_SELECTIVITY
+
+class QueryPlan(object):
+    """QueryPlanner的输出
+
+    QueryPlan.sql_criterions
+        list type, 按估计选择度升序排列(最有筛选力的在前)的主表criterion
+
+    QueryPlan.keyword_terms
+        list type, [(field_name, keyword, df)], 按df升序排列
+
+    QueryPlan.is_empty
+        boolean type, 在不访问任何数据的情况下就能确定结果为空
+
+    QueryPlan.estimated_sql_matches
+        主表条件预计匹配的文档数
+
+    QueryPlan.estimated_scan_rows
+        用WHERE查询主表时预计需要读取的行数。 如果有条件落在索引列上, 则远小于主表的总行数
+        
+    QueryPlan.document_count
+        主表中的文档总数
+        
+    QueryPlan.set_criterions
+        list type, 需要在倒排列表上用集合运算求值的布尔表达式(见 engine.BooleanCriterion), 
+        不含NOT的在前, 顶层为NOT的在后(作为差集)
+    """
+    def __init__(self, sql_criterions, keyword_terms, is_empty,
+                 estimated_sql_matches, estimated_scan_rows, document_count, set_criterions=()):
+        self.sql_criterions = sql_criterions
+        self.keyword_terms = keyword_terms
+        self.is_empty = is_empty
+        self.estimated_sql_matches = estimated_sql_matches
+        self.estimated_scan_rows = estimated_scan_rows
+        self.document_count = document_count
+        self.set_criterions = list(set_criterions)
+        
+    def uses_postings(self):
+        """是否需要先在倒排列表上得到候选文档集合
+        """
+        return len(self.keyword_terms) + len(self.set_criterions) > 0
+    
+    def is_unconstrained(self):
+        """没有任何条件的空查询
+        """
+        return len(self.keyword_terms) + len(self.set_criterions) + len(self.sql_criterions) == 0
+
+    def should_probe(self, candidate_count):
+        """已知倒排索引给出了candidate_count个候选文档, 判断是逐个探测主表更便宜,
+        还是用WHERE扫描主表再求交集更便宜
+        """
+        return candidate_count * PROBE_COST < self.estimated_scan_rows
+    
+    def should_scan_ordered(self, candidate_count, limit):
+        """已知有candidate_count个候选文档, 只需要排序后的前limit个时, 判断沿着排序单元的索引顺序
+        扫描主表(平均每 document_count / candidate_count 行遇到一个候选文档, 凑够limit个即停止)是否
+        比探测全部候选文档再用堆排序更便宜
+        """
+        if limit is None:
+            return False
+        expected_scan_rows = limit * float(self.document_count) / max(candidate_count, 1)
+        return expected_scan_rows < candidate_count * PROBE_COST
+
+    def __repr__(self):
+        return "QueryPlan(sql_criterions=%s, keyword_terms=%s, set_criterions=%s, is_empty=%s, estimated_scan_rows=%s)" % (
+            [str(criterion) for criterion in self.sql_criterions],
+            self.keyword_terms, [str(criterion) for criterion in self.set_criterions], 
+            self.is_empty, self.estimated_scan_rows)
+
+class QueryPlanner(object):
+    """为Query生成QueryPlan
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.statistics = Statistics(engine)
+
+    def plan(self, query):
+        statistics = self.statistics
+        sql_criterions, keyword_criterions = query._split_SqlCriterions_and_KeywordCriterions()
+
+        ### keyword按df升序排列
+        keyword_terms = list()
+        for field_name, keywords in query.keyword_terms_by_field().items():
+            for keyword, df in statistics.keyword_frequencies(field_name, keywords).items():
+                keyword_terms.append((field_name, keyword, df))
+        keyword_terms.sort(key=lambda term: term[2])
+        is_empty = len(keyword_terms) >= 1 and keyword_terms[0][2] == 0
+        
+        ### 布尔表达式: 先求交集, 再求差集
+        set_criterions = [criterion for criterion in keyword_criterions if getattr(criterion, "children", ())]
+        set_criterions.sort(key=lambda criterion: criterion.__class__.__name__ == "QueryNot")
+
+        ### 主表criterion按选择度升序排列, 并估计需要扫描的行数
+        document_count = statistics.document_count
+        selectivities = [(criterion.selectivity(statistics), i, criterion) \
+                         for i, criterion in enumerate(sql_criterions)]
+        selectivities.sort(key=lambda item: item[:2])
+        estimated_sql_matches = float(document_count)
+        estimated_scan_rows = float(document_count)
+        indexed_columns = statistics.indexed_columns() if selectivities else set()
+        for selectivity, _, criterion in selectivities:
+            estimated_sql_matches *= selectivity
+            if criterion.field_name in indexed_columns:
+                estimated_scan_rows = min(estimated_scan_rows, document_count * selectivity)
+
+        return QueryPlan([criterion for _, _, criterion in selectivities], keyword_terms, is_empty,
+                         estimated_sql_matches, estimated_scan_rows, document_count, set_criterions)
+
+if __name__ == "__main__":
+    from .engine import SearchEngine
+    from .fields import *
+    import os
+    import shutil
+    import tempfile
+    
+    def unittest_plan():
+        """keyword按df升序排列, 主表criterion按选择度升序排列; 有keyword的df为0时不读取任何倒排列表
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            schema = Schema("movie",
+                Field("movie_id", Searchable_UUID, primary_key=True),
+                Field("year", Searchable_INTEGER),
+                Field("genres", Searchable_KEYWORD),
+                )
+            engine = SearchEngine(os.path.join(directory, "movie.db"), schema)
+            engine.add_all([{"movie_id": str(i), "year": 1950 + i % 50,
+                             "genres": "&".join(genre for genre, k in [("Drama", 2), ("Short", 4)] if i % k == 0)}
+                            for i in range(200)])
+            
+            query = engine.create_query()
+            query.add(query.query_between("year", 1950, 1990))
+            query.add(query.query_equal("movie_id", "8"))
+            query.add(query.query_contains("genres", "Drama", "Short"))
+            plan = engine.planner.plan(query)
+            assert [term[1:] for term in plan.keyword_terms] == [("Short", 50), ("Drama", 100)]
+            assert [criterion.field_name for criterion in plan.sql_criterions] == ["movie_id", "year"]
+            assert not plan.is_empty
+            assert [row[0] for row in engine.search(query)] == ["8"]
+            
+            postings_read = list()
+            def get_keyword_posting(field_name, keyword):
+                postings_read.append(keyword)
+                return SearchEngine._get_keyword_posting(engine, field_name, keyword)
+            engine._get_keyword_posting = get_keyword_posting
+            query = engine.create_query()
+            query.add(query.query_contains("genres", "Drama", "Western"))
+            assert engine.planner.plan(query).is_empty
+            assert list(engine.search(query)) == [] and engine.count(query) == 0
+            assert postings_read == []
+            query = engine.create_query()
+            query.add(query.query_contains("genres", "Short"))
+            assert len(list(engine.search(query))) == 50 and postings_read == ["Short"]
+        finally:
+            shutil.rmtree(directory)
+    
+    unittest_plan()
@@ -0,0 +1,72 @@
+##encoding=utf8
+
+"""
+只读sqlite3连接池, 用于SearchEngine的并发模式。
+
+数据库使用WAL日志模式时, 读连接之间, 以及读连接与唯一的写连接之间互不阻塞。 每个查询从池中借出
+一个连接, 在一个读事务中完成全部的读取, 所以在整个查询期间看到的是同一个数据库快照。
+
+import:
+    from tala.pool import ConnectionPool
+"""
+
+from __future__ import print_function
+import os
+import sqlite3
+try:
+    import queue
+    from urllib.request import pathname2url
+except ImportError: # python2
+    import Queue as queue
+    from urllib import pathname2url
+
+class ConnectionPool(object):
+    """固定大小的只读sqlite3连接池
+
+    ConnectionPool.size
+        连接的数量, 也就是最多能同时执行的查询的数量
+
+    ConnectionPool.timeout
+        所有连接都被借出时, acquire最多等待多少秒, None表示一直等待
+    """
+    def __init__(self, database, size=4, cached_statements=256, timeout=30.0):
+        if size < 1:
+            raise Exception("ERROR! pool size has to be at least 1, yours is %s" % size)
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self._queue = queue.LifoQueue() # 后进先出, 最近用过的连接的statement cache更可能是热的
+        self._connections = list()
+        uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(database))
+        for _ in range(size):
+            connect = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                                      cached_statements=cached_statements, timeout=timeout)
+            connect.execute("PRAGMA query_only = ON")
+            self._connections.append(connect)
+            self._queue.put(connect)
+
+    def acquire(self):
+        """借出一个连接, 并在其上开始一个读事务
+        """
+        try:
+            connect = self._queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Exception("ERROR! no free connection in the pool after %s seconds, "
+                            "try a larger pool size" % self.timeout)
+        connect.execute("BEGIN")
+        return connect
+
+    def release(self, connect):
+        """结束读事务, 并归还连接
+        """
+        if connect.in_transaction:
+            connect.rollback()
+        self._queue.put(connect)
+
+    def close(self):
+        for connect in self._connections:
+            connect.close()
+
+    def __repr__(self):
+        return "%s(database=%r, size=%s, free=%s)" % (
+            self.__class__.__name__, self.database, self.size, self._queue.qsize())
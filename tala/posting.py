@@ -0,0 +1,343 @@
+##encoding=utf8
+
+"""
+倒排列表(posting list)的压缩储存与集合运算。
+
+在 posting_format = "bitmap" 模式下, 主表中的每一个文档都会被分配一个稠密的整数id
+(见 fields.DOC_ID)。每一个keyword所对应的文档集合在内存中是一个 Bitmap 对象, 在数据库中则以
+压缩后的二进制blob形式储存, blob的第一个字节标明了编码方式:
+
+    b"B" + zlib.compress(位图的little-endian字节)    适用于稠密的倒排列表, 例如 "Drama"
+    b"V" + 升序文档id之差的varint编码                   适用于稀疏的倒排列表
+
+encode_posting根据文档数和id的范围估计两种编码的大小, 选择较小的一种。 在内存中, 稀疏的倒排列表以
+frozenset储存 (见 Bitmap, SPARSE_RATIO), 所以编码, 解码和缓存稀疏的倒排列表的代价都只与文档数有关。
+
+import:
+    from tala.posting import Bitmap, encode_posting, decode_posting
+"""
+
+from __future__ import print_function
+import re
+import zlib
+try:
+    import numpy as np
+except ImportError: # numpy是可选的, 只用于加快 Bitmap.from_array
+    np = None
+
+_BITMAP_TAG = b"B"
+_VARINT_TAG = b"V"
+
+### 每个字节值中为1的位的偏移量, 用于快速遍历位图
+_BYTE_OFFSETS = [tuple(offset for offset in range(8) if byte & (1 << offset)) for byte in range(256)]
+_NONZERO_RUNS = re.compile(b"[^\x00]+")
+
+### 文档id的范围 (最大id + 1) 超过文档数的SPARSE_RATIO倍时, Bitmap以稀疏的frozenset储存。 frozenset中
+### 每个id大约占用60个字节, 而位图中每个id占用1位, 所以更稀疏时位图反而更大, 运算也更慢
+SPARSE_RATIO = 256
+
+try:
+    _bit_count = int.bit_count # python3.10+
+except AttributeError:
+    def _bit_count(bits):
+        return bin(bits).count("1")
+
+def _is_sparse(n, max_id):
+    return max_id + 1 > SPARSE_RATIO * n
+
+def _bits_of(ids):
+    """一组非负整数文档id对应的位图整数
+    """
+    if not ids:
+        return 0
+    buffer = bytearray((max(ids) >> 3) + 1)
+    for doc_id in ids:
+        buffer[doc_id >> 3] |= 1 << (doc_id & 7)
+    return int.from_bytes(bytes(buffer), "little")
+
+def _iter_bits(bits):
+    """按升序遍历位图整数中所有为1的位, 跳过全为0的字节
+    """
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for match in _NONZERO_RUNS.finditer(data):
+        for byte_index in range(match.start(), match.end()):
+            base = byte_index << 3
+            for offset in _BYTE_OFFSETS[data[byte_index]]:
+                yield base + offset
+
+class Bitmap(object):
+    """文档id集合。 稠密时以python整数作为底层储存, 第i位为1表示文档id i在集合中; 稀疏时 (见 SPARSE_RATIO)
+    以frozenset储存, 所以只有一个id 10000000 的倒排列表不需要一个1MB的位图。 两种形式由集合的内容
+    唯一决定, 每次运算之后自动转换, 调用者不需要区分。
+
+    python整数的位运算是由C实现的, 所以对大集合求交集/并集/差集的速度远远快于set。Bitmap支持
+    与set相同的 &, |, -, ^, len(), in, iter() 操作, 所以SearchEngine可以用同一套代码处理
+    set和Bitmap两种倒排列表。
+
+    注意: 对一个很大的稠密Bitmap做大量的 in 判断是很慢的, 这种情况下应先转换成set。
+    """
+    __slots__ = ("bits", "ids") # 稠密时ids为None, 稀疏时bits为None
+
+    def __init__(self, bits=0):
+        self.bits, self.ids = bits, None
+        if bits and _is_sparse(_bit_count(bits), bits.bit_length() - 1):
+            self.bits, self.ids = None, frozenset(_iter_bits(bits))
+
+    @classmethod
+    def _from_frozenset(cls, ids):
+        if ids and not _is_sparse(len(ids), max(ids)):
+            return cls(_bits_of(ids))
+        bitmap = cls.__new__(cls)
+        bitmap.bits, bitmap.ids = (0, None) if not ids else (None, ids)
+        return bitmap
+
+    @classmethod
+    def from_ids(cls, ids):
+        """由一组非负整数文档id创建Bitmap
+        """
+        ids = list(ids)
+        if not ids:
+            return cls(0)
+        if _is_sparse(len(ids), max(ids)):
+            return cls._from_frozenset(frozenset(ids))
+        return cls(_bits_of(ids))
+
+    @classmethod
+    def from_array(cls, ids):
+        """由一个整数typecode的array或memoryview (例如segment文件中映射的倒排列表) 创建Bitmap。
+        安装了numpy时直接在原来的内存上构造位图, 不为每个id创建python整数
+        """
+        if np is None or len(ids) == 0:
+            return cls.from_ids(ids)
+        ids = np.frombuffer(ids, dtype=ids.format if isinstance(ids, memoryview) else ids.typecode)
+        max_id = int(ids.max())
+        if _is_sparse(len(ids), max_id):
+            return cls._from_frozenset(frozenset(ids.tolist()))
+        bits = np.zeros(max_id + 1, dtype=bool)
+        bits[ids] = True
+        return cls.from_bytes(np.packbits(bits, bitorder="little").tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(int.from_bytes(data, "little"))
+
+    def to_bytes(self):
+        bits = _bits_of(self.ids) if self.bits is None else self.bits
+        return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+    @property
+    def max_id(self):
+        """最大的文档id, 空集合为-1
+        """
+        if self.bits is None:
+            return max(self.ids)
+        return self.bits.bit_length() - 1
+
+    @classmethod
+    def from_parts(cls, parts, offset=0):
+        """由 [(start, Bitmap)] 创建Bitmap: 每一份中的文档id加上start, 合并之后再加上offset。 各份的
+        位图直接以整数 | 合并, 最后只转换一次形式, 所以很大的offset也不会产生中间的大位图
+        """
+        bits, ids = 0, list()
+        for start, bitmap in parts:
+            if bitmap.bits is None:
+                ids.extend(doc_id + start for doc_id in bitmap.ids)
+            else:
+                bits |= bitmap.bits << start
+        n = _bit_count(bits | _bits_of(ids)) if ids else _bit_count(bits)
+        max_id = max(bits.bit_length() - 1, max(ids) if ids else -1) + offset
+        if n and _is_sparse(n, max_id):
+            return cls._from_frozenset(frozenset(doc_id + offset for doc_id in ids).union(
+                doc_id + offset for doc_id in _iter_bits(bits)))
+        return cls((bits | _bits_of(ids)) << offset if ids else bits << offset)
+
+    def _select(self, ids):
+        """稠密的self中包含的那些ids
+        """
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")
+        n_bytes = len(data)
+        return frozenset(doc_id for doc_id in ids if (doc_id >> 3) < n_bytes and (data[doc_id >> 3] >> (doc_id & 7)) & 1)
+
+    def __and__(self, other):
+        if self.bits is not None and other.bits is not None:
+            return Bitmap(self.bits & other.bits)
+        if self.ids is not None and other.ids is not None:
+            return Bitmap._from_frozenset(self.ids & other.ids)
+        sparse, dense = (self, other) if self.ids is not None else (other, self)
+        return Bitmap._from_frozenset(dense._select(sparse.ids))
+
+    def __or__(self, other):
+        if self.bits is not None and other.bits is not None:
+            return Bitmap(self.bits | other.bits)
+        if self.ids is not None and other.ids is not None:
+            return Bitmap._from_frozenset(self.ids | other.ids)
+        sparse, dense = (self, other) if self.ids is not None else (other, self)
+        if _is_sparse(len(self) + len(other), max(self.max_id, other.max_id)):
+            return Bitmap._from_frozenset(sparse.ids.union(_iter_bits(dense.bits)))
+        return Bitmap(dense.bits | _bits_of(sparse.ids))
+
+    def __sub__(self, other):
+        if self.bits is not None and other.bits is not None:
+            return Bitmap(self.bits & ~other.bits)
+        if self.ids is not None and other.ids is not None:
+            return Bitmap._from_frozenset(self.ids - other.ids)
+        if self.ids is not None: # 稀疏 - 稠密
+            return Bitmap._from_frozenset(self.ids - other._select(self.ids))
+        limit = self.bits.bit_length()
+        return Bitmap(self.bits & ~_bits_of([doc_id for doc_id in other.ids if doc_id < limit]))
+
+    def __xor__(self, other):
+        return (self | other) - (self & other)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.bits == other.bits and self.ids == other.ids
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.bits, self.ids))
+
+    def __len__(self):
+        if self.bits is None:
+            return len(self.ids)
+        return _bit_count(self.bits)
+
+    def __bool__(self):
+        return self.ids is not None or self.bits != 0
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, doc_id):
+        if self.bits is None:
+            return doc_id in self.ids
+        return doc_id >= 0 and bool((self.bits >> doc_id) & 1)
+
+    def __iter__(self):
+        """按升序遍历所有的文档id
+        """
+        if self.bits is None:
+            return iter(sorted(self.ids))
+        return _iter_bits(self.bits)
+
+    def __sizeof__(self):
+        if self.bits is None: # frozenset本身, 以及其中的每一个int
+            return object.__sizeof__(self) + self.ids.__sizeof__() + len(self.ids) * (0).__sizeof__()
+        return object.__sizeof__(self) + self.bits.__sizeof__()
+
+    def __repr__(self):
+        return "Bitmap(%s documents)" % len(self)
+
+##################################################
+#                                                #
+#               encode / decode                  #
+#                                                #
+##################################################
+
+def encode_varint_deltas(ids):
+    """把升序的文档id序列编码为 相邻id之差 的varint字节串
+    """
+    out = bytearray()
+    previous = 0
+    for doc_id in ids:
+        delta = doc_id - previous
+        previous = doc_id
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+def decode_varint_deltas(data):
+    """encode_varint_deltas的逆运算, 返回升序的文档id列表
+    """
+    ids = list()
+    previous = 0
+    delta = 0
+    shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += delta
+            ids.append(previous)
+            delta = 0
+            shift = 0
+    return ids
+
+def encode_posting(posting):
+    """把一个Bitmap (或者任意整数文档id的集合) 编码为可储存在数据库中的blob
+    
+    编码方式由文档数和id的范围估计, 不需要先压缩位图: varint每个id占用 ceil(平均间隔的位数 / 7) 个字节,
+    位图 (压缩之前) 每个id的范围占用1位。 所以稀疏的倒排列表的编码代价只与文档数有关, 与最大id无关
+    """
+    if not isinstance(posting, Bitmap):
+        posting = Bitmap.from_ids(posting)
+    n = len(posting)
+    if n == 0:
+        return _VARINT_TAG
+    id_range = posting.max_id + 1
+    varint_size = n * max(1, ((id_range // n).bit_length() + 6) // 7)
+    if varint_size < (id_range + 7) // 8:
+        return _VARINT_TAG + encode_varint_deltas(posting)
+    return _BITMAP_TAG + zlib.compress(posting.to_bytes())
+
+def decode_posting(blob):
+    """encode_posting的逆运算, 返回Bitmap。blob为None时返回空的Bitmap
+    """
+    if not blob:
+        return Bitmap()
+    blob = bytes(blob)
+    tag, payload = blob[:1], blob[1:]
+    if tag == _BITMAP_TAG:
+        return Bitmap.from_bytes(zlib.decompress(payload))
+    elif tag == _VARINT_TAG:
+        return Bitmap.from_ids(decode_varint_deltas(payload))
+    else:
+        raise Exception("Unknown posting encoding %r!" % tag)
+
+if __name__ == "__main__":
+    import random
+
+    def unittest_Bitmap():
+        a = Bitmap.from_ids([1, 5, 9, 1000])
+        b = Bitmap.from_ids([5, 9, 77])
+        print(list(a & b), list(a | b), list(a - b), len(a), 1000 in a, 999 in a)
+
+#     unittest_Bitmap()
+
+    def unittest_encode_posting():
+        dense = Bitmap.from_ids(random.sample(range(100000), 60000))
+        sparse = Bitmap.from_ids([3, 50000, 99999])
+        for posting in [dense, sparse, Bitmap()]:
+            blob = encode_posting(posting)
+            print(blob[:1], len(blob), decode_posting(blob) == posting)
+
+#     unittest_encode_posting()
+
+    def unittest_sparse_and_dense():
+        """稠密和稀疏的Bitmap之间的运算与set相同, 编码解码后不变, 稀疏的倒排列表不会展开成位图
+        """
+        rnd = random.Random(0)
+        def sample():
+            n_ids = rnd.choice([0, 1, 5, 300, 5000])
+            id_range = rnd.choice([10, 1000, 10 ** 5, 10 ** 7])
+            return set(rnd.randrange(id_range) for _ in range(n_ids))
+        for _ in range(300):
+            x, y = sample(), sample()
+            a, b = Bitmap.from_ids(x), Bitmap.from_ids(y)
+            assert list(a) == sorted(x) and len(a) == len(x)
+            for op in ("__and__", "__or__", "__sub__", "__xor__"):
+                result = getattr(a, op)(b)
+                assert list(result) == sorted(getattr(x, op)(y))
+                assert result == Bitmap.from_ids(result) # 形式由内容唯一决定
+            assert decode_posting(encode_posting(a)) == a
+            assert list(Bitmap.from_parts([(0, a), (5, b)], 7)) == sorted(set(doc_id + 7 for doc_id in x) | set(doc_id + 12 for doc_id in y))
+        sparse = Bitmap.from_ids([10 ** 7])
+        assert sparse.bits is None and sparse.__sizeof__() < 1000
+        assert encode_posting(sparse) == _VARINT_TAG + encode_varint_deltas([10 ** 7])
+        assert decode_posting(encode_posting(sparse)).bits is None
+        assert 10 ** 7 in sparse and 10 ** 7 - 1 not in sparse
+
+    unittest_sparse_and_dense()
@@ -0,0 +1,361 @@
+##encoding=utf8
+
+"""
+查询的性能剖析。
+
+SearchEngine.enable_profiling() 之后, 每一个 search / search_document / count / facets 查询都会生成
+一个QueryProfile, 记录查询在各个阶段所花费的时间(互不重叠, 总和等于查询在SearchEngine中花费的
+时间, 不包括调用者处理结果的时间):
+
+    plan        查询规划, 包括读取统计信息
+    postings    读取和解码keyword的倒排列表 (包括posting_caches)
+    set_ops     倒排列表之间的交集/并集/差集运算
+    sql         对主表的SQL查询, 包括逐行读取结果
+    fetch_rows  按doc_key分批从主表中取出文档
+    other       其他python代码, 例如排序和包装结果
+
+以及候选集合和结果的大小, 执行过的SQL语句, 和(explain=True时)每条SQL语句的 EXPLAIN QUERY PLAN。
+
+剖析是通过在enable_profiling时替换SearchEngine实例上的几个方法实现的, disable_profiling之后这些
+方法被恢复, 所以不剖析时没有任何额外的开销。
+
+import:
+    from tala.profiler import Profiler, QueryProfile
+
+usage:
+    engine.enable_profiling(callback=print, slow_query_threshold=0.1)
+    ...
+    for profile in engine.profiler.slow_queries:
+        print(profile)
+"""
+
+from __future__ import print_function
+from collections import OrderedDict, deque
+import logging
+import re
+import time
+
+slow_query_logger = logging.getLogger("tala.slow_query")
+
+_PLACEHOLDERS = re.compile(r"\?(?:, \?){3,}")
+
+def _abbreviate(sqlcmd):
+    """把SQL语句中 IN (?, ?, ...) 的一长串占位符缩写, 用于打印
+    """
+    sqlcmd = " ".join(sqlcmd.split())
+    return _PLACEHOLDERS.sub(lambda match: "?, ... %s placeholders" % (match.group().count("?")), sqlcmd)
+
+### 这些阶段中执行的SQL语句的时间算作该阶段本身, 而不是sql
+_SQL_OWNING_STAGES = ("postings", "fetch_rows")
+
+class QueryProfile(object):
+    """一个查询的剖析结果
+
+    QueryProfile.kind
+        "search", "count" 或 "facets"
+
+    QueryProfile.query
+        查询条件的文字描述
+
+    QueryProfile.stages
+        OrderedDict({阶段: 秒数}), 各阶段的时间互不重叠
+
+    QueryProfile.counters
+        OrderedDict, 例如 candidates(倒排索引给出的候选文档数), results(结果数), postings_read
+        (读取的倒排列表数), posting_size(读取的倒排列表的总长度), rows_fetched, sql_statements
+
+    QueryProfile.plan
+        QueryPlan的文字描述
+
+    QueryProfile.statements
+        [(SQL语句, 绑定值, EXPLAIN QUERY PLAN的结果或None)], 相同的SQL语句只记录第一次
+    """
+    def __init__(self, kind, query):
+        self.kind = kind
+        self.query = ", ".join(str(criterion) for criterion in query.criterions)
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.plan = None
+        self.statements = list()
+        self.started = time.time()
+        self._stack = list()
+        self._last = None
+
+    def enter(self, stage):
+        now = time.perf_counter()
+        if self._stack:
+            self._charge(now)
+        self._stack.append(stage)
+        self._last = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self._charge(now)
+        self._stack.pop()
+        self._last = now
+
+    def skip(self):
+        """从上一次计时到现在的时间不计入任何阶段, 用于 EXPLAIN QUERY PLAN
+        """
+        self._last = time.perf_counter()
+
+    def _charge(self, now):
+        stage = self._stack[-1]
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last)
+
+    @property
+    def stage(self):
+        """当前所在的阶段
+        """
+        return self._stack[-1] if self._stack else None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @property
+    def elapsed(self):
+        return sum(self.stages.values())
+
+    def to_dict(self):
+        return OrderedDict([
+            ("kind", self.kind), ("query", self.query), ("started", self.started),
+            ("elapsed", self.elapsed), ("stages", OrderedDict(self.stages)),
+            ("counters", OrderedDict(self.counters)), ("plan", self.plan),
+            ("statements", [OrderedDict([("sql", sqlcmd), ("params", list(params)), ("explain", explain)]) \
+                            for sqlcmd, params, explain in self.statements]),
+        ])
+
+    def __str__(self):
+        lines = ["%s(%s) %.3f ms" % (self.kind, self.query, self.elapsed * 1000)]
+        lines.append("\t" + ", ".join("%s %.3f ms" % (stage, seconds * 1000) for stage, seconds in self.stages.items()))
+        lines.append("\t" + ", ".join("%s=%s" % item for item in self.counters.items()))
+        if self.plan:
+            lines.append("\t" + self.plan)
+        for sqlcmd, _, explain in self.statements:
+            lines.append("\t" + _abbreviate(sqlcmd))
+            for row in explain or ():
+                lines.append("\t\t" + str(row[-1]))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "QueryProfile(kind=%r, elapsed=%.6f, results=%s)" % (self.kind, self.elapsed, self.counters.get("results"))
+
+class _TimedCursor(object):
+    """sqlite3游标的包装, 读取结果的时间计入stage
+    """
+    def __init__(self, profile, stage, cursor):
+        self.profile = profile
+        self.stage = stage
+        self.cursor = cursor
+
+    def _timed(self, method, *args):
+        self.profile.enter(self.stage)
+        try:
+            return method(*args)
+        finally:
+            self.profile.exit()
+
+    def fetchone(self):
+        return self._timed(self.cursor.fetchone)
+
+    def fetchmany(self, size):
+        return self._timed(self.cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self._timed(self.cursor.fetchall)
+
+    def __iter__(self):
+        while True:
+            row = self._timed(self.cursor.fetchone)
+            if row is None:
+                return
+            yield row
+
+class Profiler(object):
+    """SearchEngine.profiler, 由 SearchEngine.enable_profiling 创建
+
+    Profiler.callbacks
+        每个查询结束时被调用的函数的列表, 参数为QueryProfile
+
+    Profiler.slow_query_threshold
+        耗时不少于这么多秒的查询被视为慢查询: 放入slow_queries, 并以WARNING级别写入
+        logging.getLogger("tala.slow_query")。 None表示不记录慢查询
+
+    Profiler.slow_queries
+        最近的slow_query_log_size个慢查询的QueryProfile
+
+    Profiler.explain
+        是否对每条SQL语句执行 EXPLAIN QUERY PLAN。 EXPLAIN的时间不计入任何阶段
+    """
+    ### {SearchEngine的方法: 阶段}, 这些方法在剖析时被替换为计时的版本
+    TIMED_METHODS = [("_get_keyword_posting", "postings"), ("_candidate_set", "set_ops")]
+
+    def __init__(self, engine, callback=None, slow_query_threshold=None, explain=False, slow_query_log_size=100):
+        self.engine = engine
+        self.callbacks = list() if callback is None else [callback]
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_queries = deque(maxlen=slow_query_log_size)
+        self.explain = explain
+        self._patched = list() # [(对象, 方法名)]
+
+    ### ==================== 替换与恢复SearchEngine的方法 ====================
+    def install(self):
+        engine = self.engine
+        for name, stage in self.TIMED_METHODS:
+            self._patch(engine, name, self._timed(stage, getattr(engine, name)))
+        self._patch(engine.planner, "plan", self._timed_plan(engine.planner.plan))
+        self._patch(engine, "_get_rows", self._timed_rows("fetch_rows", engine._get_rows))
+        self._patch(engine, "_execute", self._timed_execute(engine._execute))
+        self._patch(engine, "_search_rows", self._profiled_rows(engine._search_rows))
+        self._patch(engine, "_count", self._profiled_call("count", engine._count))
+        self._patch(engine, "_facets", self._profiled_call("facets", engine._facets))
+
+    def uninstall(self):
+        for obj, name in self._patched:
+            delattr(obj, name)
+        self._patched = list()
+
+    def _patch(self, obj, name, wrapper):
+        setattr(obj, name, wrapper)
+        self._patched.append((obj, name))
+
+    ### ==================== 当前线程正在剖析的查询 ====================
+    def _current(self):
+        return getattr(self.engine._local, "profile", None)
+
+    def _bind(self, profile):
+        previous = getattr(self.engine._local, "profile", None)
+        self.engine._local.profile = profile
+        return previous
+
+    def _finish(self, profile):
+        for callback in self.callbacks:
+            callback(profile)
+        if self.slow_query_threshold is not None and profile.elapsed >= self.slow_query_threshold:
+            self.slow_queries.append(profile)
+            slow_query_logger.warning("slow query:\n%s", profile)
+
+    ### ==================== 计时的包装 ====================
+    def _timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            profile = self._current()
+            if profile is None:
+                return func(*args, **kwargs)
+            profile.enter(stage)
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                profile.exit()
+            if stage == "postings":
+                profile.count("postings_read")
+                profile.count("posting_size", len(result))
+            elif stage == "set_ops" and result is not None:
+                profile.counters["candidates"] = len(result)
+            return result
+        return wrapper
+
+    def _timed_plan(self, func):
+        def wrapper(query):
+            profile = self._current()
+            if profile is None:
+                return func(query)
+            profile.enter("plan")
+            try:
+                plan = func(query)
+            finally:
+                profile.exit()
+            profile.plan = str(plan)
+            return plan
+        return wrapper
+
+    def _timed_rows(self, stage, func):
+        def wrapper(*args, **kwargs):
+            profile = self._current()
+            if profile is None:
+                return func(*args, **kwargs)
+            return self._timed_iter(profile, stage, func(*args, **kwargs))
+        return wrapper
+
+    def _timed_iter(self, profile, stage, rows):
+        try:
+            while True:
+                profile.enter(stage)
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    profile.exit()
+                profile.count("rows_fetched")
+                yield row
+        finally:
+            rows.close()
+
+    def _timed_execute(self, func):
+        def wrapper(sqlcmd, params=()):
+            profile = self._current()
+            if profile is None:
+                return func(sqlcmd, params)
+            if all(statement[0] != sqlcmd for statement in profile.statements):
+                explain = None
+                if self.explain:
+                    explain = [tuple(row) for row in self.engine._reader.execute("EXPLAIN QUERY PLAN " + sqlcmd, params)]
+                    profile.skip()
+                profile.statements.append((sqlcmd, tuple(params), explain))
+            profile.count("sql_statements")
+            stage = profile.stage if profile.stage in _SQL_OWNING_STAGES else "sql"
+            profile.enter(stage)
+            try:
+                cursor = func(sqlcmd, params)
+            finally:
+                profile.exit()
+            return _TimedCursor(profile, stage, cursor)
+        return wrapper
+
+    def _profiled_rows(self, func):
+        """包装 SearchEngine._search_rows: 每次取下一个结果时把profile设为当前线程的查询,
+        所以同一个线程中交替读取的多个search各自记录自己的时间
+        """
+        def wrapper(query, *args, **kwargs):
+            profile = QueryProfile("search", query)
+            return self._profile_iter(profile, func(query, *args, **kwargs))
+        return wrapper
+
+    def _profile_iter(self, profile, rows):
+        n_results = 0
+        try:
+            while True:
+                previous = self._bind(profile)
+                profile.enter("other")
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    profile.exit()
+                    self._bind(previous)
+                n_results += 1
+                yield row
+        finally:
+            previous = self._bind(profile)
+            try:
+                rows.close()
+            finally:
+                self._bind(previous)
+            profile.counters["results"] = n_results
+            self._finish(profile)
+
+    def _profiled_call(self, kind, func):
+        def wrapper(query, *args):
+            profile = QueryProfile(kind, query)
+            previous = self._bind(profile)
+            profile.enter("other")
+            try:
+                result = func(query, *args)
+            finally:
+                profile.exit()
+                self._bind(previous)
+            profile.counters["results"] = result if kind == "count" else len(result)
+            self._finish(profile)
+            return result
+        return wrapper
@@ -0,0 +1,205 @@
+##encoding=utf8
+
+"""
+posting_format = "segment" 模式下的倒排索引文件。
+
+每一个segment文件是不可修改的, 储存一个keyword单元中一批keyword的倒排列表。 文件在写入完成之后
+才被重命名为最终的文件名, 之后只会被整个删除, 不会被修改。 读取时通过mmap映射到内存, 查找keyword
+和取出倒排列表都直接在映射的内存上进行, 不需要经过SQL, 也不需要复制数据; 多个进程打开同一个文件时
+共享操作系统page cache中的同一份数据。
+
+文件格式 (所有整数都是little-endian):
+
+    b"TALASEG1"                               8字节, 文件头
+    doc_id数组                                 所有倒排列表首尾相连, 每个倒排列表内部升序,
+                                              每个doc_id占itemsize (4或8) 个字节
+    keyword数组                                按UTF-8字节升序排列的keyword首尾相连, 以0补齐到8的倍数
+    keyword_offsets                           (n_keywords + 1) 个uint64, 第i个keyword在keyword数组中的
+                                              起止位置为 [keyword_offsets[i], keyword_offsets[i+1])
+    posting_offsets                           (n_keywords + 1) 个uint64, 第i个keyword的倒排列表在
+                                              doc_id数组中的起止下标
+    footer                                    n_keywords, keyword数组的起始位置, keyword_offsets的起始
+                                              位置, itemsize, 各为uint64, 最后是 b"TALASEG1"
+
+import:
+    from tala.segment import Segment, SegmentWriter, pick_segments, merge_segments
+"""
+
+from __future__ import print_function
+from array import array
+import heapq
+import itertools
+import math
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"TALASEG1"
+_FOOTER = struct.Struct("<QQQQ8s")
+_TYPECODES = {4: "I", 8: "Q"}
+
+def typecode_for(max_doc_id):
+    """能够储存所有不超过max_doc_id的doc_id的最小的array typecode
+    """
+    return "I" if max_doc_id < 2 ** 32 else "Q"
+
+class SegmentWriter(object):
+    """按keyword升序, 逐个写入倒排列表, 所以内存中只需要保留keyword本身, 不需要保留倒排列表。
+    close之后文件才会出现在path
+    """
+    def __init__(self, path, typecode="I"):
+        self.path = path
+        self.typecode = typecode
+        self.n_keywords = 0
+        self.n_postings = 0
+        self._tmp_path = path + ".tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(MAGIC)
+        self._keywords = list()
+        self._keyword_offsets = array("Q", [0])
+        self._posting_offsets = array("Q", [0])
+
+    def add(self, keyword, doc_ids):
+        """写入一个keyword的倒排列表。 keyword必须比之前写入的keyword都大
+        """
+        keyword = keyword.encode("utf-8")
+        if self._keywords and keyword <= self._keywords[-1]:
+            raise Exception("ERROR! keywords have to be added in ascending order, %r is not" % keyword)
+        ids = array(self.typecode, sorted(doc_ids))
+        if sys.byteorder == "big":
+            ids.byteswap()
+        self._file.write(ids.tobytes())
+        self._keywords.append(keyword)
+        self.n_keywords += 1
+        self.n_postings += len(ids)
+        self._keyword_offsets.append(self._keyword_offsets[-1] + len(keyword))
+        self._posting_offsets.append(self.n_postings)
+
+    def close(self):
+        """写入keyword目录和footer, 然后把文件原子地重命名为path
+        """
+        keyword_base = self._file.tell()
+        blob = b"".join(self._keywords)
+        self._file.write(blob + b"\0" * (-len(blob) % 8))
+        index_base = self._file.tell()
+        for offsets in (self._keyword_offsets, self._posting_offsets):
+            if sys.byteorder == "big":
+                offsets.byteswap()
+            self._file.write(offsets.tobytes())
+        self._file.write(_FOOTER.pack(self.n_keywords, keyword_base, index_base,
+                                      array(self.typecode).itemsize, MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+class Segment(object):
+    """一个以mmap只读打开的segment文件。 posting返回的是映射内存上的memoryview, 不复制数据
+    """
+    def __init__(self, path):
+        if sys.byteorder == "big":
+            raise Exception("ERROR! segment files can only be mapped on little-endian machines")
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        n_keywords, keyword_base, index_base, itemsize, magic = _FOOTER.unpack(view[-_FOOTER.size:])
+        if view[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise Exception("ERROR! %r is not a segment file" % path)
+        self.n_keywords = n_keywords
+        self._keyword_base = keyword_base
+        index_size = (n_keywords + 1) * 8
+        self._keyword_offsets = view[index_base:index_base + index_size].cast("Q")
+        self._posting_offsets = view[index_base + index_size:index_base + 2 * index_size].cast("Q")
+        self.typecode = _TYPECODES[itemsize]
+        self._doc_ids = view[len(MAGIC):keyword_base].cast(self.typecode)
+        self.n_postings = len(self._doc_ids)
+
+    def _keyword(self, i):
+        base = self._keyword_base
+        return self._mmap[base + self._keyword_offsets[i]:base + self._keyword_offsets[i + 1]]
+
+    def find(self, keyword):
+        """二分查找keyword的下标, 不存在时返回-1
+        """
+        keyword = keyword.encode("utf-8")
+        low, high = 0, self.n_keywords
+        while low < high:
+            middle = (low + high) // 2
+            if self._keyword(middle) < keyword:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.n_keywords and self._keyword(low) == keyword:
+            return low
+        return -1
+
+    def _posting(self, i):
+        return self._doc_ids[self._posting_offsets[i]:self._posting_offsets[i + 1]]
+
+    def posting(self, keyword):
+        """keyword的倒排列表, 升序的doc_id的memoryview。 keyword不存在时为空
+        """
+        i = self.find(keyword)
+        if i < 0:
+            return self._doc_ids[0:0]
+        return self._posting(i)
+
+    def df(self, keyword):
+        i = self.find(keyword)
+        if i < 0:
+            return 0
+        return self._posting_offsets[i + 1] - self._posting_offsets[i]
+
+    def items(self):
+        """按keyword升序遍历 (keyword, 倒排列表)
+        """
+        for i in range(self.n_keywords):
+            yield self._keyword(i).decode("utf-8"), self._posting(i)
+
+    def __len__(self):
+        return self.n_keywords
+
+    def __repr__(self):
+        return "Segment(%r, keywords=%s, postings=%s)" % (os.path.basename(self.path), self.n_keywords, self.n_postings)
+
+##################################################
+#                                                #
+#                  compaction                    #
+#                                                #
+##################################################
+
+def pick_segments(segments, merge_factor=4):
+    """size-tiered合并策略: 按倒排列表的总长度n_postings把segment分层, 第k层的大小在 
+    [merge_factor^k, merge_factor^(k+1)) 之间。 某一层积累了merge_factor个segment时, 把这一层合并成一个
+    (属于更高的一层)。 返回最低的需要合并的一层的所有segment, 没有时返回空列表。
+    
+    所以每个文档的倒排列表最多被重写 log(文档总数) 次, 而segment的数量最多为 merge_factor * log(文档总数)
+    """
+    tiers = dict()
+    for segment in segments:
+        tier = int(math.log(max(segment.n_postings, 1), merge_factor))
+        tiers.setdefault(tier, list()).append(segment)
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= merge_factor:
+            return tiers[tier]
+    return []
+
+def merge_segments(segments, writer, tombstones=()):
+    """把多个segment按keyword归并, 同一个keyword的倒排列表取并集并去掉tombstones中的doc_id, 
+    写入writer。 内存中每次只有一个keyword的倒排列表
+    """
+    items = heapq.merge(*[segment.items() for segment in segments], key=lambda item: item[0])
+    for keyword, group in itertools.groupby(items, key=lambda item: item[0]):
+        doc_ids = set()
+        for _, posting in group:
+            doc_ids.update(posting)
+        if tombstones:
+            doc_ids.difference_update(tombstones)
+        if doc_ids:
+            writer.add(keyword, doc_ids)